@@ -1,79 +1,95 @@
-import datetime
+import base64
+import os
+import sys
 import urllib.parse
-import requests
 import json
 import time
 
-from functools import reduce
-from inspect import cleandoc
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from cr_cache import CrCacheError, get_cr_cache
+from deadline import get_deadline, start_deadline
+from http_client import HttpRequestError, get_client
+from metrics import timed
+from retry_policy import RetryPolicy
+from servicenow_core import (BaseServiceNowApi, first_record, request_token, run_phases, send_request,
+                              to_snake_case)
+from template_store import TemplateStore
 
 
 """ServiceNow CR creation module
 """
 
-class CRCreationError(Exception):
-    """Raised when http status is other than 200"""
-
+# CR states (display and numeric value) that allow moving to implement
+READY_STATES = ('scheduled', '-2')
+# Readiness polling: first interval, interval cap and overall wait in secs
+READY_INITIAL_INTERVAL = 1.0
+READY_MAX_INTERVAL = 5.0
+READY_MAX_WAIT = 60
+# Secs of the run deadline the readiness wait leaves for the update after it
+READY_UPDATE_RESERVE = 15
+# CRs packed into one Now Batch API request
+BATCH_SIZE = 25
+# Batch API replies meaning the instance does not offer it
+BATCH_UNAVAILABLE_STATUS = (400, 403, 404, 405, 501)
+# Concurrent single CR posts when batching is unavailable
+BULK_CREATE_WORKERS = 8
+# Fields the instance sets itself whatever a create asked for, e.g. state stays new until the CR is ready
+SERVER_CONTROLLED_FIELDS = ('state', 'approval')
+
+TEMPLATE_FILE = r'C:\Script\ServiceNow\Corp-CR-WebSite.json'
+# Parsed once per process, re-parsed only when the file changes
+TEMPLATES = TemplateStore(TEMPLATE_FILE, snapshot_path=TEMPLATE_FILE + '.snapshot')
 
 class Authenticator:
     """ServiceNow API authentication helper
     """
 
-    def __init__(self, params):
+    def __init__(self, params, client=None):
         """Initialise instance variables
         Args:
             params: dict() -> ServiceNow Authentication parameters
+            client: HttpClient -> Pooled HTTP client, defaults to the shared one
         """
         self.params = params
-        self.headers = {"Content-Type": "application/x-www-form-urlencoded"}
+        self.client = client or get_client()
 
+    @timed('get_token')
     def get_token(self):
         """Returns time bound token
         """
         print('BEGIN: Fetching authentication token')
-        payload = dict()
         token_data = ""
         try:
-            token_url = self.params['url'].split('/api/')[0] + "/oauth_token.do"
-            payload['grant_type'] = self.params['auth_grant_type']
-            payload['client_id'] = self.params['auth_client_id']
-            payload['client_secret'] = self.params['auth_client_secret']
-            payload['username'] = self.params['auth_username']
-            payload['password'] = self.params['auth_password']
-            payload_str='&'.join([k + "=" + urllib.parse.quote(v) for k,v in payload.items()])
-
-            token_data = request_with_retry('POST', token_url, headers=self.headers, data=payload_str)
+            token_data = request_token(self.params, self.client, send=request_with_retry)
         except KeyError as ke:
             failstep('Config key - %s doesnt exist' % ke)
         print('END: Fetching authentication token')
         return token_data
 
 
-class ServiceNowApi:
+class ServiceNowApi(BaseServiceNowApi):
     """ServiceNow API helper class
     """
 
-    def __init__(self, params):
+    def __init__(self, params, client=None):
         """Initialize instance variables
+        Args:
+            params: dict() -> ServiceNow API parameters
+            client: HttpClient -> Pooled HTTP client, defaults to the shared one
         """
-        self.cr_post_url = params['url']
-        self.cr_patch_url = params['url'] + "/number"
-        self.authenticator = Authenticator(params).get_token()
-        self.headers = {
-            'Authorization': ' '.join([self.authenticator['token_type'], self.authenticator['access_token']]),
-            'content-type': 'application/json'
-        }
-
-    def create_change_request(self, data):
-        """Method for creating ServiceNow change request
+        client = client or get_client()
+        super().__init__(params, Authenticator(params, client).get_token(), request_with_retry, client)
+        self.batch_url = params['url'].split('/api/')[0] + "/api/now/v1/batch"
+        # None until the first batch request tells whether the instance supports it
+        self.batch_supported = None
+
+    def build_change_data(self, data):
+        """Build the CR record for a deployment context
         Args:
             data: dict() -> Change request data dictionary
         Returns:
-            cr_number: str -> CR number
+            change_data: dict() -> CR fields
         """
-        print('BEGIN: Creating change request')
-        cr_number = None
-        cr_response = None
         cr_description = 'Project Name: {}'.format(data['project_name'])
         if 'web_site_name' in data:
             cr_description += ', WebSiteName: {}'.format(data['web_site_name'])
@@ -106,17 +122,170 @@ class ServiceNowApi:
 
         if 'deployment_created_by_username' in data:
             change_data['requested_by'] = data['deployment_created_by_username']
-        
-        change_data = json.dumps(change_data)
-        cr_response = request_with_retry('POST', self.cr_post_url, headers=self.headers, data=change_data)
-        if cr_response and 'result' in cr_response:
-            result = cr_response['result']
-            if 'status' in result and result['status'] == 'success':
-                cr_number = result['record_id']
+        return change_data
+
+    @timed('create_change_request')
+    def create_change_request(self, data):
+        """Method for creating ServiceNow change request
+        Args:
+            data: dict() -> Change request data dictionary
+        Returns:
+            cr_number: str -> CR number
+        """
+        print('BEGIN: Creating change request')
+        change_data = self.build_change_data(data)
+        # The plans make CR bodies large, gzip them
+        cr_response = request_with_retry('POST', self.cr_query_url, headers=self.headers,
+                                         data=json.dumps(change_data), client=self.client, compress=True,
+                                         auth=self.auth)
+        cr_number = get_record_id(cr_response)
+        if cr_number:
+            get_cr_cache().write_through(self.cr_query_url, cr_number, get_created_record(cr_response))
         print('END: Creating change request')
         return cr_number
 
+    @timed('create_change_requests')
+    def create_change_requests(self, contexts, batch_size=BATCH_SIZE):
+        """Method for creating many change requests, batched where the instance allows
+        Args:
+            contexts: list() -> Change request data dictionaries, e.g. one per site
+            batch_size: int -> CRs per batch request
+        Returns:
+            results: list() -> One dict per context, in input order, with
+                               'web_site_name', 'cr_number' and 'error' (None on success)
+        """
+        print('BEGIN: Creating change requests')
+        payloads = [json.dumps(self.build_change_data(context)) for context in contexts]
+        results = [{'web_site_name': context.get('web_site_name'), 'cr_number': None, 'error': None}
+                   for context in contexts]
+        # Create responses, the CR cache only takes what they confirm
+        responses = [None] * len(contexts)
+        singles = list(range(len(contexts)))
+        if self.batch_supported is not False:
+            singles = []
+            for start in range(0, len(contexts), batch_size):
+                indexes = list(range(start, min(start + batch_size, len(contexts))))
+                try:
+                    serviced = self._post_batch([payloads[i] for i in indexes])
+                except HttpRequestError as ex:
+                    if ex.status_code in BATCH_UNAVAILABLE_STATUS:
+                        print('Batch API unavailable (status %s), posting CRs one by one' % ex.status_code)
+                        self.batch_supported = False
+                        singles.extend(range(start, len(contexts)))
+                        break
+                    for i in indexes:
+                        results[i]['error'] = str(ex)
+                    continue
+                self.batch_supported = True
+                for offset, i in enumerate(indexes):
+                    item = serviced.get(str(offset))
+                    if item is None:
+                        # Left unserviced by the instance, post it on its own
+                        singles.append(i)
+                    elif item['status_code'] >= 400:
+                        results[i]['error'] = 'Status: {}, Error Response: {}'.format(item['status_code'], item['body'])
+                    else:
+                        results[i]['cr_number'] = get_record_id(item['body'])
+                        responses[i] = item['body']
+        if singles:
+            from concurrent.futures import ThreadPoolExecutor
+
+            with ThreadPoolExecutor(max_workers=BULK_CREATE_WORKERS) as executor:
+                posted = executor.map(self._post_single, [payloads[i] for i in singles])
+                for i, (cr_response, error) in zip(singles, posted):
+                    results[i]['cr_number'] = get_record_id(cr_response)
+                    results[i]['error'] = error
+                    responses[i] = cr_response
+        cache = get_cr_cache()
+        for result, cr_response in zip(results, responses):
+            if result['cr_number'] is not None:
+                cache.write_through(self.cr_query_url, result['cr_number'], get_created_record(cr_response))
+            elif result['error'] is None:
+                result['error'] = 'CR creation did not report success'
+        print('END: Creating change requests')
+        return results
+
+    def _post_single(self, change_data):
+        try:
+            return send_request('POST', self.cr_query_url, headers=self.headers, data=change_data,
+                                client=self.client, compress=True, auth=self.auth), None
+        except HttpRequestError as ex:
+            return None, str(ex)
 
+    def _post_batch(self, payloads):
+        """POST CR payloads through the Now Batch API
+        Returns:
+            serviced: dict() -> Serviced requests by id, bodies decoded
+        """
+        import uuid
+
+        url = urllib.parse.urlsplit(self.cr_query_url)
+        relative_url = url.path + ('?' + url.query if url.query else '')
+        headers = [{'name': 'Content-Type', 'value': 'application/json'},
+                   {'name': 'Accept', 'value': 'application/json'}]
+        batch = {
+            'batch_request_id': uuid.uuid4().hex,
+            'rest_requests': [{'id': str(offset), 'method': 'POST', 'url': relative_url, 'headers': headers,
+                               'body': base64.b64encode(payload.encode('utf-8')).decode('ascii')}
+                              for offset, payload in enumerate(payloads)]
+        }
+        batch_response = send_request('POST', self.batch_url, headers=self.headers, data=json.dumps(batch),
+                                      client=self.client, compress=True, auth=self.auth)
+        serviced = dict()
+        for item in batch_response.get('serviced_requests', []):
+            body = base64.b64decode(item.get('body') or '')
+            item['body'] = json.loads(body.decode('utf-8')) if body else None
+            serviced[item['id']] = item
+        return serviced
+
+    @timed('wait_for_state')
+    def wait_for_state(self, cr_number, states, max_wait=READY_MAX_WAIT,
+                       initial_interval=READY_INITIAL_INTERVAL, max_interval=READY_MAX_INTERVAL):
+        """Poll a Change Request until it reports one of the given states
+        Args:
+            cr_number: str -> CR number
+            states: list() -> Accepted state values, display or numeric
+            max_wait: float -> Maximum secs to wait, less when the run deadline is closer
+            initial_interval: float -> Secs before the second poll, grows by 1.5x up to max_interval
+            max_interval: float -> Upper bound of the poll interval
+        Returns:
+            is_ready: bool -> False when the wait ended first
+        """
+        print('BEGIN: Waiting for change request state')
+        wanted = set(str(state).lower() for state in states)
+        stop_at = time.monotonic() + min(max_wait, get_deadline().remaining() - READY_UPDATE_RESERVE)
+        interval = initial_interval
+        # Polls are retried by the loop itself
+        poll_policy = RetryPolicy(max_attempts=1)
+        is_ready = False
+        while True:
+            try:
+                started = time.time()
+                cr_response = send_request('GET', self.cr_get_url + "/" + cr_number, headers=self.headers,
+                                           client=self.client, policy=poll_policy, auth=self.auth)
+                record = first_record(cr_response)
+                if record:
+                    # Every poll refreshes the CR for the steps reading it from the cache
+                    try:
+                        get_cr_cache().store(self.cr_query_url, cr_number, record, full=True, fetched_at=started)
+                    except CrCacheError as ex:
+                        print('Caching CR # %s failed: %s' % (cr_number, ex))
+                state = get_cr_state(cr_response)
+                if state in wanted:
+                    is_ready = True
+                    break
+                print('CR # %s state: %s, waiting..' % (cr_number, state))
+            except HttpRequestError as ex:
+                print('Polling CR # %s failed: %s' % (cr_number, ex))
+            remaining = stop_at - time.monotonic()
+            if remaining <= 0:
+                break
+            time.sleep(min(interval, remaining))
+            interval = min(interval * 1.5, max_interval)
+        print('END: Waiting for change request state')
+        return is_ready
+
+    @timed('update_change_request')
     def update_change_request(self, data):
         """Method for running patch requests on Change Request
         Args:
@@ -130,66 +299,84 @@ class ServiceNowApi:
         if 'cr_state' in data:
             change_data['state'] = data['cr_state']
 
-        change_data = json.dumps(change_data)
-        cr_response = request_with_retry('PATCH', self.cr_patch_url + "/" + data['cr_number'], headers=self.headers, data=change_data)
-        #cr_response = request_with_retry('PATCH', self.cr_patch_url, headers=self.headers, data=change_data)
+        cr_response = request_with_retry('PATCH', self.cr_get_url + "/" + data['cr_number'], headers=self.headers,
+                                         data=json.dumps(change_data), client=self.client, auth=self.auth)
+        #cr_response = request_with_retry('PATCH', self.cr_get_url, headers=self.headers, data=change_data)
         if cr_response and 'result' in cr_response:
             result = cr_response['result']
             if 'status' in result and result['status'] == 'success':
                 is_implemented = True
+        if is_implemented:
+            # The state is server controlled, the instance may hold another representation than
+            # the one sent, e.g. a numeric code for a label; let the next read fetch it
+            get_cr_cache().invalidate(self.cr_query_url, data['cr_number'], fields=change_data)
+        else:
+            # Whether the PATCH applied is unknown, let the next read ask the instance
+            get_cr_cache().invalidate(self.cr_query_url, data['cr_number'])
         print('END: Updating change request')
         return is_implemented
 
 
-def load_template(web_site_name, environment_name):
-    with open('C:\Script\ServiceNow\Corp-CR-WebSite.json') as template_file:
-        tdata = json.load(template_file)
+def get_record_id(cr_response):
+    """Return the CR number of a successful create response, or None
+    """
+    if cr_response and 'result' in cr_response:
+        result = cr_response['result']
+        if 'status' in result and result['status'] == 'success':
+            return result['record_id']
+    return None
 
-    if web_site_name in tdata:
-        if environment_name in tdata[web_site_name]:
-            return tdata[web_site_name][environment_name]
-        else:
-            return tdata[web_site_name]
-    else:
-        failstep('WebSite: %s is not defined.' % web_site_name)
 
+def get_created_record(cr_response):
+    """Return the CR fields a successful create response confirms, for the CR cache
+
+    The fields posted are not cached as such: the instance may hold other
+    values, e.g. sys_ids for reference fields, and sets the state itself.
+    """
+    result = cr_response['result']
+    record = {field: value for field, value in result.items()
+              if field not in ('status', 'record_id') and field not in SERVER_CONTROLLED_FIELDS}
+    record['number'] = result['record_id']
+    return record
 
-def request_with_retry(method=None, url=None, headers={}, data=None):
-    """Run HTTP requests with upto 3 attempts and waits for 5 secs between each attempt
+
+def get_cr_state(cr_response):
+    """Return the lower cased state of a CR lookup response, or None
 
     Args:
-        method: HTTP methods - POST, PATCH etc.
-        url: Request URL
-        headers: Request headers
-        data: Request payload
+        cr_response: dict() -> Response of a /number/{cr} GET
+    """
+    result = first_record(cr_response)
+    state = result.get('state') if result else None
+    if isinstance(state, dict):
+        state = state.get('display_value') or state.get('value')
+    return str(state).lower() if state is not None else None
+
+
+def load_template(web_site_name, environment_name):
+    tdata = TEMPLATES.get(web_site_name, environment_name)
+    if tdata is None:
+        failstep('WebSite: %s is not defined.' % web_site_name)
+    return tdata
+
+
+def request_with_retry(method=None, url=None, headers={}, data=None, client=None, policy=None, params=None,
+                       conditional=False, stream=False, compress=False, auth=None):
+    """Run HTTP requests via send_request and fail the step once retries are exhausted
 
     Returns:
         response: for successful request
         (or) exit with error
     """
-    retry_count = 0
-    response = None
-    while True:
-        try:
-            retry_count = retry_count + 1
-            response = requests.request(method, url, headers=headers, data=data)
-            # Check for HTTP codes other than 200
-            if response.status_code >= 400: 
-                raise CRCreationError
-        except (CRCreationError, requests.exceptions.RequestException):
-            if retry_count < 3:
-                print('Retrying API - %s operation for URL - %s' % (method, url))
-                time.sleep(5)
-                continue
-            else:
-                printwarning('Maximum retries exceeded, exiting..')
-                failstep('Status: {}, Headers: {}, Error Response: {}'.format(response.status_code, 
-                                                                            response.headers, 
-                                                                            response.content))
-        break
-    return json.loads(response.content, encoding='utf-8')
+    try:
+        return send_request(method, url, headers=headers, data=data, client=client, policy=policy, params=params,
+                            conditional=conditional, stream=stream, compress=compress, auth=auth)
+    except HttpRequestError as ex:
+        printwarning('Retries exhausted, exiting..')
+        failstep(str(ex))
 
 
+@timed('read_octopus_vars')
 def read_octopus_vars():
     """Read Octopus variables
     Format:
@@ -228,10 +415,13 @@ def read_octopus_vars():
     return octopus_vars
 
 
+@timed('get_cr_defaults')
 def get_cr_defaults():
     """Return CR defaults for CR creation.
     These are release independent parameters required to move CR into scheduled/implement state
     """
+    import datetime
+
     print('BEGIN: Reading CR defaults')
     cr_defaults = dict()
     cr_defaults['cr_type'] = 'standard'
@@ -242,24 +432,7 @@ def get_cr_defaults():
     return cr_defaults
 
 
-def to_snake_case(camel_str):
-    """Convert a given string to snake case
-
-    Args:
-        camel_str: str -> Eg: ServiceNow.Cr.Template
-    Returns:
-        snake_str: str -> Eg: cr_template
-    """
-    slist = []
-    if len(camel_str.split('.')[1:]) > 0:
-        slist = camel_str.split('.')[1:]
-    else:
-        slist = camel_str.split('.')[:]
-    slist_snake_case = [reduce(lambda x, y: x + ('_' if y.isupper() else '') + y, var_part).lower() 
-                        for var_part in slist]
-    return '_'.join(slist_snake_case)
-
-
+@timed('set_context')
 def set_context(octopus_vars=dict(), cr_defaults=dict()):
     """Set deployment context
     """
@@ -269,36 +442,87 @@ def set_context(octopus_vars=dict(), cr_defaults=dict()):
             octopus_vars[param] = val
     tdata = load_template(octopus_vars['web_site_name'], octopus_vars['environment_name'])
     octopus_vars['cr_cmdb_ci'] = tdata['Cmdb_Ci']
-    octopus_vars['cr_implementation_plan'] = cleandoc(tdata['Install Plan'])
-    octopus_vars['cr_test_plan'] = cleandoc(tdata['Testing Plan'])
-    octopus_vars['cr_backout_plan'] = cleandoc(tdata['Rollback'])
+    # Plans come back from the template store already cleandoc-ed
+    octopus_vars['cr_implementation_plan'] = tdata['Install Plan']
+    octopus_vars['cr_test_plan'] = tdata['Testing Plan']
+    octopus_vars['cr_backout_plan'] = tdata['Rollback']
     print('END: Setting deployment context')
     return octopus_vars
 
 
+def move_to_implement(api, context, cr_number):
+    """Move a freshly created CR to implement state as soon as ServiceNow reports it scheduled
+    """
+    if not api.wait_for_state(cr_number, READY_STATES):
+        printwarning('CR # %s not scheduled in time, moving to implement anyway' % cr_number)
+    context['cr_state'] = 'implement'
+    context['cr_number'] = cr_number
+    is_implemented = api.update_change_request(context)
+    if is_implemented:
+        printhighlight('CR # %s is successfully moved to implement status' % cr_number)
+    else:
+        printwarning('Failed to move move CR # %s to implement status' % cr_number)
+    return is_implemented
+
+
+def build_contexts(octopus_vars, cr_defaults):
+    """Return the deployment context of every site in WebSiteName
+    """
+    # A comma separated WebSiteName creates one CR per site
+    web_site_names = [name.strip() for name in octopus_vars['web_site_name'].split(',') if name.strip()]
+    if not web_site_names:
+        failstep('WebSiteName lists no web sites: "%s"' % octopus_vars['web_site_name'])
+    return [set_context(dict(octopus_vars, web_site_name=name), cr_defaults) for name in web_site_names]
+
+
+def run_multi_site(api, contexts):
+    """Create and implement one CR per site for a multi-site release
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    results = api.create_change_requests(contexts)
+    for result in results:
+        if result['error']:
+            printwarning('CR creation failed for WebSite %s: %s' % (result['web_site_name'], result['error']))
+        else:
+            printhighlight('WebSite %s CR number: %s' % (result['web_site_name'], result['cr_number']))
+    created = [(context, result['cr_number']) for context, result in zip(contexts, results) if result['cr_number']]
+
+    # Set cr_numbers for next steps, in WebSiteName order
+    set_octopusvariable('ServiceNow.Cr.Number', ','.join(cr_number for _, cr_number in created))
+
+    with ThreadPoolExecutor(max_workers=BULK_CREATE_WORKERS) as executor:
+        list(executor.map(lambda item: move_to_implement(api, *item), created))
+    if len(created) < len(contexts):
+        failstep('CR creation failed for %d of %d WebSites' % (len(contexts) - len(created), len(contexts)))
+
+
 def run():
     """Script entry point runner method
     """
-    octopus_vars = read_octopus_vars()
-    cr_defaults = get_cr_defaults()
-    context = set_context(octopus_vars, cr_defaults)
-    api = ServiceNowApi(context)
+    # Token, create, readiness wait and update all draw from one budget
+    start_deadline(octopusvariables.get('ServiceNow.StepTimeout'))
+    # The token and the connection to the instance only need the variables,
+    # they are fetched while the CR defaults and the template load
+    phases = run_phases({
+        'octopus_vars': (read_octopus_vars, []),
+        'cr_defaults': (get_cr_defaults, []),
+        'warm_up': (lambda octopus_vars: get_client().warm_up(octopus_vars['url']), ['octopus_vars']),
+        'api': (lambda octopus_vars: ServiceNowApi(octopus_vars), ['octopus_vars']),
+        'contexts': (build_contexts, ['octopus_vars', 'cr_defaults']),
+    })
+    api, contexts = phases['api'], phases['contexts']
+    if len(contexts) > 1:
+        run_multi_site(api, contexts)
+        return
+    context = contexts[0]
     cr_number = api.create_change_request(context)
     printhighlight('CR number: %s' % cr_number)
 
     # Set cr_number for next steps
     set_octopusvariable('ServiceNow.Cr.Number', cr_number)
 
-    # Move CR to implement state
-    print('Graceful wait for 30 secs before moving CR to implement state')
-    time.sleep(30)
-    context['cr_state'] = 'implement'
-    context['cr_number'] = cr_number
-    is_implemented = api.update_change_request(context)
-    if is_implemented:
-        printhighlight('CR # %s is successfully moved to implement status' % cr_number)
-    else:
-        printwarning('Failed to move move CR # %s to implement status' % cr_number)
+    move_to_implement(api, context, cr_number)
     
 
 if __name__ == "<run_path>":
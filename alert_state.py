@@ -0,0 +1,97 @@
+import json
+import os
+import tempfile
+import time
+
+from token_cache import file_lock
+
+
+"""Alert coalescing for the monitoring mails
+
+Keeps the last known status of every monitored target in a JSON file
+shared by all monitoring processes on the host, so a mail goes out only
+when a target changes state (OK -> FAIL, FAIL -> OK) instead of on every
+failing probe. In digest mode the state changes are collected over a
+window and sent as one message.
+"""
+
+# State file, override with $MONITORING_ALERT_STATE
+DEFAULT_STATE_FILE = os.path.join(tempfile.gettempdir(), 'servicenow-monitoring-alerts.json')
+
+
+class AlertState:
+    """Last known status per target and the state changes waiting to be mailed
+    """
+
+    def __init__(self, path=None, digest_window=0):
+        """Initialise instance variables
+        Args:
+            path: str -> State file, defaults to $MONITORING_ALERT_STATE or DEFAULT_STATE_FILE
+            digest_window: float -> Secs state changes are collected before they are due, 0 to mail each at once
+        """
+        self.path = path or os.environ.get('MONITORING_ALERT_STATE') or DEFAULT_STATE_FILE
+        self.digest_window = digest_window
+
+    def _load(self):
+        try:
+            with open(self.path) as state_file:
+                return json.load(state_file)
+        except (OSError, ValueError):
+            return {'targets': dict(), 'pending': []}
+
+    def _save(self, state):
+        tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmp_path, 'w') as tmp_file:
+            json.dump(state, tmp_file)
+        os.replace(tmp_path, self.path)
+
+    def _due(self, state, now):
+        pending = state['pending']
+        if pending and (not self.digest_window or now - pending[0]['ts'] >= self.digest_window):
+            state['pending'] = []
+            return pending
+        return []
+
+    def record(self, results):
+        """Record probe results and return the state changes due for mailing
+
+        A target seen for the first time counts as previously OK, so a
+        failure is reported but a healthy first probe is not.
+
+        Args:
+            results: list() -> (target name, ok, phases) tuples
+        Returns:
+            events: list() -> dicts with target, ok, ts, phases and since, the
+                              time the target entered its previous state
+        """
+        now = time.time()
+        with file_lock(self.path + '.lock'):
+            state = self._load()
+            for name, ok, phases in results:
+                previous = state['targets'].get(name)
+                if previous is None and ok:
+                    state['targets'][name] = {'ok': ok, 'since': now}
+                    continue
+                if previous is not None and previous['ok'] == ok:
+                    continue
+                state['targets'][name] = {'ok': ok, 'since': now}
+                state['pending'].append({'target': name, 'ok': ok, 'ts': now, 'phases': phases,
+                                         'since': previous['since'] if previous else None})
+            due = self._due(state, now)
+            self._save(state)
+        return due
+
+    def requeue(self, events):
+        """Put back events that could not be mailed, ahead of newer ones
+        """
+        if not events:
+            return
+        with file_lock(self.path + '.lock'):
+            state = self._load()
+            state['pending'] = list(events) + state['pending']
+            self._save(state)
+
+    def status(self):
+        """Return the last known status per target
+        """
+        return self._load()['targets']
@@ -0,0 +1,176 @@
+import argparse
+import json
+import math
+import tempfile
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from circuit_breaker import CircuitBreaker, set_circuit_breaker
+from http_client import HttpClient, HttpRequestError, send_with_retry
+from metrics import get_metrics
+from retry_policy import RetryBudget, RetryPolicy
+from servicenow_standin import StandinConfig, StandinServer
+
+
+"""Throughput benchmark for the ServiceNow request path
+
+Runs the create, fetch and update flows through send_with_retry with many
+concurrent workers, against an in-process stand-in server (default) or
+any --url, and reports requests/sec, retry overhead and tail latency.
+
+Usage:
+    python benchmark.py --concurrency 16 --requests 2000 --latency 20 --throttle-rate 0.02
+"""
+
+FLOWS = ('create', 'fetch', 'update')
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list
+    """
+    if not sorted_values:
+        return None
+    rank = max(1, int(math.ceil(pct / 100.0 * len(sorted_values))))
+    return sorted_values[rank - 1]
+
+
+def retry_count():
+    return sum(value for (name, _), value in get_metrics().counters.items()
+               if name == 'servicenow_http_retries_total')
+
+
+class Benchmark:
+    """Runs the benchmark flows against one ServiceNow (stand-in) URL
+    """
+
+    def __init__(self, api_url, concurrency, policy):
+        """Initialise instance variables
+        Args:
+            api_url: str -> ServiceNow.Url of the target
+            concurrency: int -> Concurrent workers
+            policy: RetryPolicy -> Retry policy under test
+        """
+        self.api_url = api_url
+        self.concurrency = concurrency
+        self.policy = policy
+        self.client = HttpClient(pool_maxsize=concurrency)
+        token_url = api_url.split('/api/')[0] + '/oauth_token.do'
+        token = send_with_retry('POST', token_url, data='grant_type=password&client_id=benchmark',
+                                headers={'Content-Type': 'application/x-www-form-urlencoded'},
+                                client=self.client, policy=self.policy)
+        self.headers = {'Authorization': ' '.join([token['token_type'], token['access_token']]),
+                        'content-type': 'application/json'}
+        self.cr_numbers = []
+
+    def _create(self, i):
+        data = json.dumps({'short_description': 'benchmark %d' % i, 'state': 'scheduled',
+                           'implementation_plan': 'x' * 2048})
+        response = send_with_retry('POST', self.api_url, headers=self.headers, data=data,
+                                   client=self.client, policy=self.policy)
+        return response['result']['record_id']
+
+    def _fetch(self, i):
+        cr_number = self.cr_numbers[i % len(self.cr_numbers)]
+        return send_with_retry('GET', self.api_url + '/number/' + cr_number, headers=self.headers,
+                               client=self.client, policy=self.policy)
+
+    def _update(self, i):
+        cr_number = self.cr_numbers[i % len(self.cr_numbers)]
+        return send_with_retry('PATCH', self.api_url + '/number/' + cr_number, headers=self.headers,
+                               data=json.dumps({'state': 'implement'}), client=self.client, policy=self.policy)
+
+    def run_flow(self, flow, requests):
+        """Run one flow and return its statistics
+        """
+        operation = getattr(self, '_' + flow)
+        latencies = []
+        errors = 0
+
+        def timed_call(i):
+            start = time.perf_counter()
+            try:
+                result = operation(i)
+                return time.perf_counter() - start, result, None
+            except HttpRequestError as ex:
+                return time.perf_counter() - start, None, ex
+
+        retries_before = retry_count()
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            outcomes = list(executor.map(timed_call, range(requests)))
+        elapsed = time.perf_counter() - start
+        for latency, result, error in outcomes:
+            latencies.append(latency)
+            if error is not None:
+                errors += 1
+            elif flow == 'create':
+                self.cr_numbers.append(result)
+        latencies.sort()
+        retries = retry_count() - retries_before
+        return {
+            'flow': flow,
+            'requests': requests,
+            'concurrency': self.concurrency,
+            'errors': errors,
+            'retries': retries,
+            'retries_per_request': retries / float(requests),
+            'elapsed_secs': elapsed,
+            'requests_per_sec': requests / elapsed if elapsed else None,
+            'mean_ms': 1000 * sum(latencies) / len(latencies),
+            'p50_ms': 1000 * percentile(latencies, 50),
+            'p90_ms': 1000 * percentile(latencies, 90),
+            'p99_ms': 1000 * percentile(latencies, 99),
+            'max_ms': 1000 * latencies[-1],
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='ServiceNow request path throughput benchmark')
+    parser.add_argument('--url', help='ServiceNow.Url to benchmark, defaults to an in-process stand-in')
+    parser.add_argument('--flows', default=','.join(FLOWS), help='Comma separated subset of %s' % ', '.join(FLOWS))
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=500, help='Requests per flow')
+    parser.add_argument('--latency', type=float, default=10, help='Stand-in base latency in ms')
+    parser.add_argument('--jitter', type=float, default=5, help='Stand-in random extra latency in ms')
+    parser.add_argument('--error-rate', type=float, default=0, help='Stand-in share of 503 responses')
+    parser.add_argument('--throttle-rate', type=float, default=0, help='Stand-in share of 429 responses')
+    parser.add_argument('--retry-after', type=int, default=0, help='Stand-in Retry-After secs')
+    parser.add_argument('--max-attempts', type=int, default=3)
+    parser.add_argument('--base-delay', type=float, default=0.05, help='Retry backoff base in secs')
+    parser.add_argument('--json', action='store_true', help='Print results as JSON lines')
+    args = parser.parse_args(argv)
+
+    server = None
+    api_url = args.url
+    if not api_url:
+        config = StandinConfig(latency=args.latency / 1000.0, jitter=args.jitter / 1000.0,
+                               error_rate=args.error_rate, throttle_rate=args.throttle_rate,
+                               retry_after=args.retry_after)
+        server = StandinServer(config=config).start()
+        api_url = server.api_url
+
+    policy = RetryPolicy(max_attempts=args.max_attempts, base_delay=args.base_delay, budget=RetryBudget())
+    # Keep injected faults from tripping the circuit real steps on this host share
+    set_circuit_breaker(CircuitBreaker(state_dir=tempfile.mkdtemp(prefix='benchmark-circuit-')))
+    try:
+        benchmark = Benchmark(api_url, args.concurrency, policy)
+        flows = args.flows.split(',')
+        if 'create' not in flows:
+            # fetch and update need CRs to work on
+            benchmark.run_flow('create', args.concurrency)
+        for flow in flows:
+            result = benchmark.run_flow(flow, args.requests)
+            if args.json:
+                print(json.dumps(result))
+            else:
+                print('%(flow)-7s %(requests_per_sec)8.1f req/s  p50 %(p50_ms)7.1f ms  p90 %(p90_ms)7.1f ms  '
+                      'p99 %(p99_ms)7.1f ms  max %(max_ms)7.1f ms  retries %(retries)4d  errors %(errors)4d'
+                      % result)
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == "__main__":
+    main()
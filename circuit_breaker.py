@@ -0,0 +1,159 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+from token_cache import file_lock
+
+
+"""Cross-process circuit breaker for ServiceNow hosts
+
+The state of each host lives in a small JSON file under a shared
+directory, so every step on a Tentacle sees an outage as soon as one of
+them has. The circuit opens after a run of consecutive failed attempts;
+while it is open calls are rejected at once. Once reset_timeout has
+passed a single caller gets a half-open probe lease, and its outcome
+closes the circuit or opens it for another reset_timeout.
+"""
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+# Statuses counted as failures, next to connection errors; other errors still mean the host answered
+FAILURE_STATUS = {500, 502, 503, 504}
+# Consecutive failed attempts, across processes, that open the circuit
+DEFAULT_FAILURE_THRESHOLD = 5
+# Secs the circuit stays open before a probe may test the host
+DEFAULT_RESET_TIMEOUT = 30
+# Secs a probe lease is held before another caller may probe
+DEFAULT_PROBE_TIMEOUT = 60
+
+
+class CircuitBreaker:
+    """File backed circuit breaker keyed by host
+    """
+
+    def __init__(self, state_dir=None, failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+                 reset_timeout=DEFAULT_RESET_TIMEOUT, probe_timeout=DEFAULT_PROBE_TIMEOUT):
+        """Initialise instance variables
+        Args:
+            state_dir: str -> Directory holding state files, defaults to
+                              $SERVICENOW_CIRCUIT_DIR or the temp directory
+            failure_threshold: int -> Consecutive failed attempts that open the circuit
+            reset_timeout: float -> Secs the circuit stays open before a probe
+            probe_timeout: float -> Secs before an unfinished probe lease expires
+        """
+        self.state_dir = state_dir or os.environ.get('SERVICENOW_CIRCUIT_DIR') or \
+            os.path.join(tempfile.gettempdir(), 'servicenow-circuit')
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.probe_timeout = probe_timeout
+        os.makedirs(self.state_dir, exist_ok=True)
+
+    def _paths(self, host):
+        base = os.path.join(self.state_dir, hashlib.sha256(host.encode('utf-8')).hexdigest())
+        return base + '.json', base + '.lock'
+
+    def _read(self, path):
+        try:
+            with open(path) as state_file:
+                return json.load(state_file)
+        except (OSError, ValueError):
+            return {'state': CLOSED, 'failures': 0}
+
+    def _write(self, path, state):
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'w') as tmp_file:
+            json.dump(state, tmp_file)
+        os.replace(tmp_path, path)
+
+    def _rejects(self, state, now):
+        if state['state'] == OPEN:
+            return now - state['opened_at'] < self.reset_timeout
+        if state['state'] == HALF_OPEN:
+            return now < state['probe_until']
+        return False
+
+    def state(self, host):
+        """Return the current state of host's circuit
+        """
+        return self._read(self._paths(host)[0])['state']
+
+    def allow(self, host):
+        """Whether a call to host may go ahead
+
+        Returns:
+            allowed: bool -> False while the circuit is open or another caller holds the probe lease
+            probe: bool -> True when this call is the half-open probe
+        """
+        path, lock_path = self._paths(host)
+        now = time.time()
+        state = self._read(path)
+        if state['state'] == CLOSED:
+            return True, False
+        if self._rejects(state, now):
+            return False, False
+        with file_lock(lock_path):
+            state = self._read(path)
+            if state['state'] == CLOSED:
+                return True, False
+            if self._rejects(state, now):
+                return False, False
+            self._write(path, {'state': HALF_OPEN, 'failures': state['failures'],
+                               'opened_at': state.get('opened_at'), 'probe_until': now + self.probe_timeout})
+            return True, True
+
+    def record_success(self, host):
+        """Close host's circuit after a successful attempt
+        """
+        path, lock_path = self._paths(host)
+        state = self._read(path)
+        if state['state'] == CLOSED and not state['failures']:
+            return
+        with file_lock(lock_path):
+            self._write(path, {'state': CLOSED, 'failures': 0})
+
+    def record_failure(self, host):
+        """Count a failed attempt against host
+
+        Returns:
+            state: str -> Circuit state after the failure
+        """
+        path, lock_path = self._paths(host)
+        with file_lock(lock_path):
+            state = self._read(path)
+            failures = state['failures'] + 1
+            if state['state'] == OPEN:
+                # A call that started before the circuit opened, keep the reset timer
+                state = dict(state, failures=failures)
+            elif state['state'] == HALF_OPEN or failures >= self.failure_threshold:
+                state = {'state': OPEN, 'failures': failures, 'opened_at': time.time()}
+            else:
+                state = {'state': CLOSED, 'failures': failures}
+            self._write(path, state)
+        return state['state']
+
+
+_breaker = None
+_breaker_lock = threading.Lock()
+
+
+def get_circuit_breaker():
+    """Return the process wide circuit breaker, creating it on first use
+    """
+    global _breaker
+    with _breaker_lock:
+        if _breaker is None:
+            _breaker = CircuitBreaker()
+        return _breaker
+
+
+def set_circuit_breaker(breaker):
+    """Replace the process wide circuit breaker, None to create a default one on next use
+    """
+    global _breaker
+    with _breaker_lock:
+        _breaker = breaker
@@ -0,0 +1,309 @@
+import json
+import os
+import tempfile
+import threading
+import time
+
+from contextlib import contextmanager
+from http_client import VERSION_FIELDS
+from metrics import increment
+
+
+"""Local SQLite cache of ServiceNow change requests
+
+Steps of one deployment often read the same CR within seconds of each
+other, each in its own process. The fields of every CR read or written
+are kept in a SQLite file shared by those processes, each with the time
+it was fetched, and a field is served from the cache while it is younger
+than its TTL. Fields that move during a deployment, like the state, get
+a short TTL; descriptive fields a long one.
+
+Strict reads go to ServiceNow once a requested field is past its TTL.
+Stale-while-revalidate reads return the stale fields at once, up to
+max_stale secs past their TTL, and refresh them on a background thread;
+a lease in the cache file makes sure only one process refreshes a CR.
+"""
+
+READ_STRICT = 'strict'
+READ_STALE = 'stale-while-revalidate'
+# Always fetch, the response still refreshes the cache
+READ_BYPASS = 'bypass'
+
+# Cache file, override with $SERVICENOW_CR_CACHE
+DEFAULT_CACHE_FILE = os.path.join(tempfile.gettempdir(), 'servicenow-cr-cache.sqlite3')
+# Secs a field stays fresh unless FIELD_TTLS has its own
+DEFAULT_TTL = 300
+FIELD_TTLS = {
+    'state': 10,
+    'approval': 10,
+    'work_notes': 10,
+    'sys_updated_on': 10,
+    'sys_mod_count': 10,
+}
+# Secs past its TTL a stale-while-revalidate read may still serve a field
+MAX_STALE = 600
+# Secs one process holds the right to refresh a CR in the background
+REFRESH_LEASE = 30
+# Secs to wait for another process holding the write lock
+SQLITE_TIMEOUT = 10
+# Pseudo field listing the fields of the last full record fetched
+FULL_RECORD = '*'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS cr_field (
+    instance TEXT NOT NULL,
+    number TEXT NOT NULL,
+    field TEXT NOT NULL,
+    value TEXT NOT NULL,
+    fetched_at REAL NOT NULL,
+    PRIMARY KEY (instance, number, field)
+);
+CREATE TABLE IF NOT EXISTS cr_refresh (
+    instance TEXT NOT NULL,
+    number TEXT NOT NULL,
+    leased_until REAL NOT NULL,
+    PRIMARY KEY (instance, number)
+);
+'''
+
+# Never let an older fetch overwrite a field written or fetched after it started
+UPSERT = '''
+INSERT INTO cr_field (instance, number, field, value, fetched_at) VALUES (?, ?, ?, ?, ?)
+ON CONFLICT (instance, number, field) DO UPDATE SET value = excluded.value, fetched_at = excluded.fetched_at
+WHERE excluded.fetched_at >= cr_field.fetched_at
+'''
+
+
+class CrCacheError(Exception):
+    """The cache file could not be read or written
+    """
+
+
+class CrCache:
+    """Per-field TTL cache of CR records shared by the processes on a host
+    """
+
+    def __init__(self, path=None, ttls=None, default_ttl=DEFAULT_TTL, max_stale=MAX_STALE,
+                 refresh_lease=REFRESH_LEASE):
+        """Initialise instance variables
+        Args:
+            path: str -> SQLite file, defaults to $SERVICENOW_CR_CACHE or DEFAULT_CACHE_FILE
+            ttls: dict() -> Field name to secs it stays fresh, merged over FIELD_TTLS
+            default_ttl: float -> Secs a field without its own TTL stays fresh
+            max_stale: float -> Secs past its TTL a stale-while-revalidate read may serve a field
+            refresh_lease: float -> Secs a background refresh holds its lease
+        """
+        self.path = path or os.environ.get('SERVICENOW_CR_CACHE') or DEFAULT_CACHE_FILE
+        self.ttls = dict(FIELD_TTLS, **(ttls or dict()))
+        self.default_ttl = default_ttl
+        self.max_stale = max_stale
+        self.refresh_lease = refresh_lease
+        self._schema_ready = False
+        self._schema_lock = threading.Lock()
+
+    @contextmanager
+    def _transaction(self):
+        # sqlite3 takes ~15 ms to import, only pay it once the cache is used
+        import sqlite3
+
+        # A connection per transaction, background refreshes run on their own thread
+        try:
+            connection = sqlite3.connect(self.path, timeout=SQLITE_TIMEOUT)
+        except sqlite3.Error as ex:
+            raise CrCacheError('Opening %s failed: %s' % (self.path, ex))
+        try:
+            with self._schema_lock:
+                if not self._schema_ready:
+                    connection.execute('PRAGMA journal_mode=WAL')
+                    connection.executescript(SCHEMA)
+                    self._schema_ready = True
+            with connection:
+                yield connection
+        except sqlite3.Error as ex:
+            raise CrCacheError('%s: %s' % (self.path, ex))
+        finally:
+            connection.close()
+
+    def ttl(self, field):
+        """Return the secs field stays fresh
+        """
+        return self.ttls.get(field, self.default_ttl)
+
+    def lookup(self, instance, number, fields=None):
+        """Return the cached fields of a CR
+        Args:
+            instance: str -> API URL of the ServiceNow instance
+            number: str -> CR number
+            fields: list() -> Fields the caller needs, None for the last full record
+        Returns:
+            record: dict() -> Cached fields, None when one is missing or more than max_stale past its TTL
+            fresh: bool -> Whether every field is within its TTL
+        """
+        now = time.time()
+        with self._transaction() as connection:
+            rows = {field: (value, fetched_at) for field, value, fetched_at in connection.execute(
+                'SELECT field, value, fetched_at FROM cr_field WHERE instance = ? AND number = ?',
+                (instance, number))}
+        if fields is None:
+            if FULL_RECORD not in rows:
+                return None, False
+            fields = json.loads(rows[FULL_RECORD][0])
+        record = dict()
+        fresh = True
+        for field in fields:
+            if field not in rows:
+                return None, False
+            value, fetched_at = rows[field]
+            overdue = now - fetched_at - self.ttl(field)
+            if overdue > self.max_stale:
+                return None, False
+            fresh = fresh and overdue <= 0
+            record[field] = json.loads(value)
+        return record, fresh
+
+    def store(self, instance, number, record, full=False, fetched_at=None):
+        """Cache the fields of a CR
+        Args:
+            instance: str -> API URL of the ServiceNow instance
+            number: str -> CR number
+            record: dict() -> Field values
+            full: bool -> Whether record is the full record, served to reads without a field list
+            fetched_at: float -> Epoch secs the values were current, defaults to now
+        """
+        fetched_at = time.time() if fetched_at is None else fetched_at
+        rows = [(instance, number, field, json.dumps(value), fetched_at) for field, value in record.items()]
+        if full:
+            rows.append((instance, number, FULL_RECORD, json.dumps(sorted(record)), fetched_at))
+        with self._transaction() as connection:
+            connection.executemany(UPSERT, rows)
+
+    def write_through(self, instance, number, record):
+        """Cache the fields a create or update just wrote to a CR
+
+        The version fields ServiceNow bumps on every write are dropped, only
+        the next fetch knows them, so reads needing them go to the instance.
+        The write already happened, a cache failure is only reported.
+        """
+        try:
+            self.store(instance, number, record)
+            with self._transaction() as connection:
+                connection.executemany('DELETE FROM cr_field WHERE instance = ? AND number = ? AND field = ?',
+                                       [(instance, number, field) for field in VERSION_FIELDS])
+        except CrCacheError as ex:
+            print('Caching CR # %s failed: %s' % (number, ex))
+
+    def invalidate(self, instance, number, fields=None):
+        """Drop cached fields of a CR, e.g. after a write with an unknown outcome
+
+        Args:
+            fields: list() -> Fields a write changed, with the version fields it bumped;
+                              None drops every field
+        """
+        try:
+            with self._transaction() as connection:
+                if fields is None:
+                    connection.execute('DELETE FROM cr_field WHERE instance = ? AND number = ?', (instance, number))
+                else:
+                    connection.executemany('DELETE FROM cr_field WHERE instance = ? AND number = ? AND field = ?',
+                                           [(instance, number, field)
+                                            for field in set(fields).union(VERSION_FIELDS)])
+        except CrCacheError as ex:
+            print('Invalidating CR # %s failed: %s' % (number, ex))
+
+    def _leased(self, instance, number):
+        """Take the background refresh lease of a CR, False while another caller holds it
+        """
+        now = time.time()
+        try:
+            with self._transaction() as connection:
+                # Take the write lock before reading, two processes must not both see the lease free
+                connection.execute('BEGIN IMMEDIATE')
+                row = connection.execute('SELECT leased_until FROM cr_refresh WHERE instance = ? AND number = ?',
+                                         (instance, number)).fetchone()
+                if row and row[0] > now:
+                    return False
+                connection.execute('INSERT OR REPLACE INTO cr_refresh VALUES (?, ?, ?)',
+                                   (instance, number, now + self.refresh_lease))
+                return True
+        except CrCacheError as ex:
+            print('Leasing the refresh of CR # %s failed: %s' % (number, ex))
+            return False
+
+    def _release(self, instance, number):
+        with self._transaction() as connection:
+            connection.execute('DELETE FROM cr_refresh WHERE instance = ? AND number = ?', (instance, number))
+
+    def _fetch(self, instance, number, fetch, fields):
+        started = time.time()
+        record = fetch()
+        if record is not None:
+            try:
+                self.store(instance, number, record, full=fields is None, fetched_at=started)
+            except CrCacheError as ex:
+                print('Caching CR # %s failed: %s' % (number, ex))
+        return record
+
+    def _refresh(self, instance, number, fetch, fields):
+        try:
+            self._fetch(instance, number, fetch, fields)
+        except Exception as ex:
+            print('Background refresh of CR # %s failed: %s' % (number, ex))
+        finally:
+            try:
+                self._release(instance, number)
+            except CrCacheError:
+                # The lease expires on its own
+                pass
+
+    def read(self, instance, number, fetch, fields=None, mode=READ_STRICT, refresh=None):
+        """Return a CR from the cache, fetching it when the cached fields do not satisfy mode
+        Args:
+            instance: str -> API URL of the ServiceNow instance
+            number: str -> CR number
+            fetch: callable -> fetch() returning the CR record from ServiceNow, or None
+            fields: list() -> Fields the caller needs, None for the full record
+            mode: str -> READ_STRICT, READ_STALE or READ_BYPASS
+            refresh: callable -> Like fetch, run by background refreshes, defaults to fetch. Must not fail the step
+        Returns:
+            record: dict() -> CR fields, None when fetch found no record
+        """
+        if mode != READ_BYPASS:
+            try:
+                record, fresh = self.lookup(instance, number, fields)
+            except CrCacheError as ex:
+                print('Reading CR # %s from the cache failed: %s' % (number, ex))
+                record, fresh = None, False
+            if record is not None and fresh:
+                increment('servicenow_cr_cache_reads_total', result='fresh')
+                return record
+            if record is not None and mode == READ_STALE:
+                increment('servicenow_cr_cache_reads_total', result='stale')
+                if self._leased(instance, number):
+                    # Not a daemon, the refresh completes before the interpreter exits
+                    threading.Thread(target=self._refresh, args=(instance, number, refresh or fetch, fields),
+                                     name='cr-cache-refresh').start()
+                return record
+        increment('servicenow_cr_cache_reads_total', result='bypass' if mode == READ_BYPASS else 'miss')
+        return self._fetch(instance, number, fetch, fields)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cr_cache():
+    """Return the process wide CR cache, creating it on first use
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = CrCache()
+        return _cache
+
+
+def set_cr_cache(cache):
+    """Replace the process wide CR cache, None to create a default one on next use
+    """
+    global _cache
+    with _cache_lock:
+        _cache = cache
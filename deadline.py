@@ -0,0 +1,104 @@
+import threading
+import time
+
+
+"""Run deadline shared by every phase of a step
+
+A step starts one deadline when it begins and every blocking call draws
+its timeout from what is left of it: HTTP connect and read timeouts,
+retry backoff, readiness polling and SMTP socket timeouts. A half-open
+connection can then no longer hold a step past its budget. Without a
+started deadline, e.g. in the monitoring daemon, only the per-call caps
+apply.
+"""
+
+# Secs a step may run unless ServiceNow.StepTimeout says otherwise
+DEFAULT_STEP_BUDGET = 300
+# Upper bounds of the per-request HTTP socket timeouts
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 60
+
+
+class DeadlineExceeded(TimeoutError):
+    """Raised when the run deadline passed before a blocking call could start"""
+
+
+class Deadline:
+    """Point in time by which a run has to finish
+    """
+
+    def __init__(self, budget=None):
+        """Initialise instance variables
+        Args:
+            budget: float -> Secs from now, None for no deadline
+        """
+        self.budget = budget
+        self.expires_at = None if budget is None else time.monotonic() + budget
+
+    def remaining(self):
+        """Return the secs left, infinite without a deadline
+        """
+        if self.expires_at is None:
+            return float('inf')
+        return self.expires_at - time.monotonic()
+
+    def expired(self):
+        """Whether the deadline has passed
+        """
+        return self.remaining() <= 0
+
+    def check(self, what='the call'):
+        """Return the secs left
+
+        Raises:
+            DeadlineExceeded: when no time is left
+        """
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded('Run deadline of %ss passed before %s' % (self.budget, what))
+        return remaining
+
+    def timeout(self, cap, what='the call'):
+        """Return the timeout for one blocking call, at most cap secs
+
+        Raises:
+            DeadlineExceeded: when no time is left
+        """
+        return min(cap, self.check(what))
+
+    def http_timeout(self, connect=CONNECT_TIMEOUT, read=READ_TIMEOUT):
+        """Return the (connect, read) timeout pair for one HTTP request
+
+        These bound the connect and each socket read; HttpClient reads every
+        body in chunks and checks the deadline between them, so a server
+        trickling bytes cannot outlast it either.
+        """
+        return self.timeout(connect, 'the HTTP request'), self.timeout(read, 'the HTTP request')
+
+
+_deadline = Deadline()
+_deadline_lock = threading.Lock()
+
+
+def get_deadline():
+    """Return the process wide run deadline, one without a time limit until a step starts it
+    """
+    with _deadline_lock:
+        return _deadline
+
+
+def start_deadline(budget=None):
+    """Start the process wide run deadline
+
+    Args:
+        budget: float|str -> Secs the run may take, e.g. the ServiceNow.StepTimeout
+                             variable; None or empty for DEFAULT_STEP_BUDGET
+    Returns:
+        deadline: Deadline
+    """
+    global _deadline
+    budget = float(budget) if budget not in (None, '') else DEFAULT_STEP_BUDGET
+    with _deadline_lock:
+        _deadline = Deadline(budget)
+        return _deadline
+
@@ -1,57 +1,125 @@
-import smtplib
-import requests
+import base64
+import gzip
+import os
+import re
+import shutil
+import sys
+import tempfile
 
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.base import MIMEBase
-from email import encoders
-from inspect import cleandoc
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from deadline import start_deadline
+from metrics import timed
 
+# requests, the email package and the SMTP transport are imported by the
+# functions that use them, so importing this module for its helpers stays cheap
+
+# Compressed log kept in memory up to this size before spilling to disk
+LOG_SPOOL_MAX_SIZE = 8 * 1024 * 1024
+# Raw bytes per base64 chunk, a multiple of 57 so every line is 76 chars
+BASE64_CHUNK_SIZE = 57 * 1024
+
+
+@timed('get_task_log')
 def get_task_log():
+    """Bring the local copy of the raw task log up to date and gzip it into a spooled temp file
+
+    Only the part of the log written since an earlier step of this task
+    read it is downloaded.
+
+    Returns:
+        log_file: file object positioned at the start of the gzip data
+    """
+    import requests
+    from http_client import HttpRequestError
+    from task_log import TaskLog
+
     print('BEGIN: Fetching task log')
     octopus_url = get_octopusvariable('Octopus.Url')
     octopus_api_key = get_octopusvariable('Octopus.ApiKey')
     octopus_task_id = get_octopusvariable('Octopus.Task.Id')
-    headers = {'X-Octopus-ApiKey': octopus_api_key}
-    request_url = '/'.join([octopus_url, 'api/tasks', octopus_task_id, 'raw'])
+    log_file = tempfile.SpooledTemporaryFile(max_size=LOG_SPOOL_MAX_SIZE)
     try:
-        response = requests.get(request_url, headers=headers, verify=False)
-        response = response.text
-    except (requests.exceptions.ConnectTimeout, 
-            requests.exceptions.RequestException) as e:
+        with TaskLog(octopus_url, octopus_api_key).open_log(octopus_task_id) as raw_log:
+            with gzip.GzipFile(filename='tasklog.txt', mode='wb', fileobj=log_file) as gzip_file:
+                shutil.copyfileobj(raw_log, gzip_file)
+    except (requests.exceptions.RequestException, HttpRequestError, OSError) as e:
+        log_file.close()
         failstep(e)
+    log_file.seek(0)
     print('END: Fetching task log')
-    return response
+    return log_file
+
+
+def to_smtp_lines(text):
+    """Convert text to CRLF line endings with SMTP dot-stuffing
+    """
+    text = re.sub(r'\r?\n', '\r\n', text)
+    return re.sub(r'(?m)^\.', '..', text)
+
 
+def iter_message(from_addr, to_addr, subject, body, attachment, filename):
+    """Yield a multipart message as CRLF terminated byte chunks
+
+    The attachment is read and base64 encoded chunk by chunk, so only one
+    chunk of it is held in memory at a time.
+
+    Args:
+        from_addr: str -> Sender
+        to_addr: str -> Recipient
+        subject: str -> Mail subject
+        body: str -> Plain text body
+        attachment: file object -> Binary attachment content
+        filename: str -> Attachment file name
+    """
+    import uuid
+    from email import policy
+    from email.mime.text import MIMEText
+
+    boundary = '===============%s==' % uuid.uuid4().hex
+    headers = [('From', from_addr),
+               ('To', to_addr),
+               ('Subject', subject),
+               ('MIME-Version', '1.0'),
+               ('Content-Type', 'multipart/mixed; boundary="%s"' % boundary)]
+    header_block = ''.join(policy.SMTP.fold(name, value) for name, value in headers) + '\r\n'
+    yield to_smtp_lines(header_block).encode('utf-8')
+
+    text_part = MIMEText(body, 'plain')
+    yield to_smtp_lines('--%s\n%s\n' % (boundary, text_part.as_string())).encode('utf-8')
+
+    yield to_smtp_lines('--%s\n'
+                        'Content-Type: application/gzip\n'
+                        'Content-Transfer-Encoding: base64\n'
+                        'Content-Disposition: attachment; filename="%s"\n\n' % (boundary, filename)).encode('utf-8')
+    while True:
+        chunk = attachment.read(BASE64_CHUNK_SIZE)
+        if not chunk:
+            break
+        yield base64.encodebytes(chunk).replace(b'\n', b'\r\n')
+    yield ('--%s--\r\n' % boundary).encode('utf-8')
+
+
+@timed('mailer')
 def mailer():
+    from inspect import cleandoc
+    from mail_transport import get_transport
+
     print('BEGIN: Sending email')
     from_addr = get_octopusvariable('Mail.From')
     to_addr = get_octopusvariable('Mail.To')
 
-    msg = MIMEMultipart()
-    msg['From'] = from_addr
-    msg['To'] = to_addr
-    msg['Subject'] = "Deployment sample mail"
+    subject = "Deployment sample mail"
     body = cleandoc(f'''Test''')
 
-    msg.attach(MIMEText(body, 'plain'))
-
     print('Preparing attachment..')
-    filename = "tasklog.txt"
-    raw_log = get_task_log()
-    payload = MIMEBase('application', 'octet-stream')
-    payload.set_payload(raw_log)
-    encoders.encode_base64(payload)
-    payload.add_header('Content-Disposition', "attachment; filename= %s" % filename)
-
-    msg.attach(payload)
-
-    print('Sending mail..')
-    server = smtplib.SMTP('atom.paypalcorp.com', 25)
-    text = msg.as_string()
-    server.sendmail(from_addr, to_addr, text)
-    server.quit()
+    filename = "tasklog.txt.gz"
+    with get_task_log() as log_file:
+        print('Sending mail..')
+        get_transport().send_streamed(from_addr, to_addr,
+                                      iter_message(from_addr, to_addr, subject, body, log_file, filename))
     printhighlight('Mail sent successfully!!')
 
 if __name__ == "<run_path>":
+    # Log fetch and SMTP draw from one budget
+    start_deadline(octopusvariables.get('ServiceNow.StepTimeout'))
     mailer()
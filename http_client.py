@@ -0,0 +1,593 @@
+import collections
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import urllib.parse
+
+from circuit_breaker import FAILURE_STATUS, OPEN, get_circuit_breaker
+from deadline import CONNECT_TIMEOUT, READ_TIMEOUT, DeadlineExceeded, get_deadline
+from json_stream import iter_items
+from metrics import increment
+from retry_policy import get_retry_policy
+from token_cache import file_lock
+
+
+"""Shared HTTP client for ServiceNow API calls
+
+requests is imported when the first client is created, so steps that
+fail before sending anything don't pay for loading it.
+"""
+
+# Number of distinct hosts whose connection pools are cached
+DEFAULT_POOL_CONNECTIONS = 4
+# Connections kept alive per host
+DEFAULT_POOL_MAXSIZE = 10
+# Bytes read per chunk when streaming a response body
+STREAM_CHUNK_SIZE = 64 * 1024
+# Responses kept for conditional GETs
+REVALIDATION_CACHE_SIZE = 1024
+# Record fields that change on every update; sys_updated_on alone has one second resolution
+VERSION_FIELDS = ('sys_updated_on', 'sys_mod_count')
+# Response encodings requests decodes without optional packages
+ACCEPT_ENCODING = 'gzip, deflate'
+# Request bodies from this many bytes on are gzipped when the caller opts in
+COMPRESS_MIN_SIZE = 1024
+# Statuses a host may answer a gzipped body it cannot read with, the body is resent plain once
+COMPRESS_REJECTED_STATUS = (400, 415)
+# Secs a host that rejected a gzipped body gets plain bodies before gzip is tried again
+PLAIN_BODY_TTL = 24 * 60 * 60
+
+
+class HttpRequestError(Exception):
+    """Raised when a request fails for good"""
+
+    def __init__(self, message, response=None):
+        super().__init__(message)
+        self.response = response
+        self.status_code = response.status_code if response is not None else None
+
+
+class CircuitOpenError(HttpRequestError):
+    """Raised without sending when the host's circuit breaker is open"""
+
+
+class DeadlineExceededError(HttpRequestError):
+    """Raised when the run deadline leaves no time for another attempt"""
+
+
+class HttpClient:
+    """Pooled keep-alive HTTP client
+
+    Wraps a requests.Session so repeated calls to the same host reuse
+    the underlying TCP connection and TLS session instead of paying a
+    fresh handshake per request.
+    """
+
+    def __init__(self, pool_connections=DEFAULT_POOL_CONNECTIONS, pool_maxsize=DEFAULT_POOL_MAXSIZE,
+                 pool_block=False, verify=True, cert=None, connect_timeout=CONNECT_TIMEOUT,
+                 read_timeout=READ_TIMEOUT):
+        """Initialise instance variables
+        Args:
+            pool_connections: int -> Number of host pools to cache
+            pool_maxsize: int -> Maximum connections kept per host
+            pool_block: bool -> Block instead of opening extra connections once a host pool is full
+            verify: bool|str -> TLS verification flag or CA bundle path
+            cert: str|tuple -> Client certificate passed to every request
+            connect_timeout: float -> Upper bound of the connect timeout, lowered to what the run deadline leaves
+            read_timeout: float -> Upper bound of the wait for each read from the socket, likewise
+        """
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.pool_block = pool_block
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.session = requests.Session()
+        self.session.verify = verify
+        self.session.cert = cert
+        self.session.headers['Connection'] = 'keep-alive'
+        # Pin what requests would advertise, brotli or zstd would depend on optional packages
+        self.session.headers['Accept-Encoding'] = ACCEPT_ENCODING
+        # Retries are handled by request_with_retry, keep urllib3 out of it
+        adapter = HTTPAdapter(pool_connections=pool_connections,
+                              pool_maxsize=pool_maxsize,
+                              pool_block=pool_block,
+                              max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def request(self, method, url, **kwargs):
+        """Send a request over the pooled session
+        Args:
+            method: HTTP methods - POST, PATCH etc.
+            url: Request URL
+            kwargs: Passed through to requests.Session.request
+        Returns:
+            response: requests.Response, with the body read unless stream=True was passed
+        Raises:
+            DeadlineExceeded: when the run deadline passes before the response, or its body, is read
+        """
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = get_deadline().http_timeout(self.connect_timeout, self.read_timeout)
+        stream = kwargs.pop('stream', False)
+        # Always streamed, so the body is read through iter_body and its deadline checks
+        response = self.session.request(method, url, stream=True, **kwargs)
+        if not stream:
+            read_body(response, 'the body of {} {}'.format(method, url))
+        return response
+
+    def warm_up(self, url):
+        """Open a pooled connection to url's host ahead of the first real request
+
+        Sends a HEAD to the site root and ignores the outcome, a failure
+        only means the first real request opens the connection itself.
+        """
+        import requests
+
+        parts = urllib.parse.urlsplit(url)
+        try:
+            self.request('HEAD', '%s://%s/' % (parts.scheme, parts.netloc), allow_redirects=False).close()
+        except (requests.exceptions.RequestException, DeadlineExceeded) as ex:
+            print('Warming up the connection to %s failed: %s' % (parts.netloc, ex))
+
+    def close(self):
+        """Close all pooled connections
+        """
+        self.session.close()
+
+
+class PlainBodyHosts:
+    """Hosts that took a plain request body after rejecting the gzipped one
+
+    Kept one small JSON file per host under a shared directory, like the
+    token cache and the circuit breaker state, so the steps that follow
+    send plain bodies right away instead of each paying for a rejected
+    gzipped one first.
+    """
+
+    def __init__(self, state_dir=None, ttl=PLAIN_BODY_TTL):
+        """Initialise instance variables
+        Args:
+            state_dir: str -> Directory holding state files, defaults to
+                              $SERVICENOW_PLAIN_BODY_DIR or the temp directory
+            ttl: float -> Secs after which gzip is tried again, the host may have been reconfigured
+        """
+        self.state_dir = state_dir or os.environ.get('SERVICENOW_PLAIN_BODY_DIR') or \
+            os.path.join(tempfile.gettempdir(), 'servicenow-plain-body')
+        self.ttl = ttl
+
+    def _paths(self, host):
+        base = os.path.join(self.state_dir, hashlib.sha256(host.encode('utf-8')).hexdigest())
+        return base + '.json', base + '.lock'
+
+    def __contains__(self, host):
+        try:
+            with open(self._paths(host)[0]) as state_file:
+                return time.time() - json.load(state_file)['since'] < self.ttl
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+
+    def add(self, host):
+        """Send only plain bodies to host from now on, for ttl secs
+        """
+        path, lock_path = self._paths(host)
+        try:
+            os.makedirs(self.state_dir, exist_ok=True)
+            with file_lock(lock_path):
+                tmp_path = '%s.%d.tmp' % (path, os.getpid())
+                with open(tmp_path, 'w') as tmp_file:
+                    json.dump({'host': host, 'since': time.time()}, tmp_file)
+                os.replace(tmp_path, path)
+        except OSError as ex:
+            # Only costs the next step a rejected gzipped body
+            print('Recording plain bodies for %s failed: %s' % (host, ex))
+
+
+_plain_body_hosts = None
+_plain_body_hosts_lock = threading.Lock()
+
+
+def get_plain_body_hosts():
+    """Return the process wide plain body host record, creating it on first use
+    """
+    global _plain_body_hosts
+    with _plain_body_hosts_lock:
+        if _plain_body_hosts is None:
+            _plain_body_hosts = PlainBodyHosts()
+        return _plain_body_hosts
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """Return the process wide HTTP client, creating it on first use
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = HttpClient()
+        return _client
+
+
+def configure_client(**kwargs):
+    """Replace the process wide HTTP client with a newly configured one
+
+    Args:
+        kwargs: HttpClient arguments - pool_connections, pool_maxsize etc.
+    Returns:
+        client: HttpClient
+    """
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+        _client = HttpClient(**kwargs)
+        return _client
+
+
+def count_saved_bytes(response, decoded_size):
+    """Count the bytes a compressed response body saved on the wire
+
+    Args:
+        response: requests.Response -> Response whose body has been read
+        decoded_size: int -> Bytes of the body after decoding
+    """
+    if response.headers.get('Content-Encoding', '').lower() in ('gzip', 'deflate'):
+        saved = decoded_size - response.raw.tell()
+        if saved > 0:
+            increment('servicenow_http_bytes_saved_total', saved, direction='response')
+
+
+def iter_body(response, chunk_size=STREAM_CHUNK_SIZE, what='the response body'):
+    """Yield the decoded body of a streamed response as it arrives
+
+    Socket timeouts only bound each read, so the run deadline is checked
+    between reads as well; a server trickling bytes cannot hold the step
+    past it.
+
+    Args:
+        response: requests.Response -> Response sent with stream=True
+        chunk_size: int -> Most bytes yielded at a time
+        what: str -> Named by DeadlineExceeded
+    Raises:
+        DeadlineExceeded: when the run deadline passes before the body is read
+        requests.exceptions.RequestException: when reading the body fails, as from iter_content
+    """
+    deadline = get_deadline()
+    if hasattr(response.raw, 'read1'):
+        # urllib3 2 returns whatever one socket read brought instead of filling the chunk
+        chunks = _read1_chunks(response.raw, chunk_size)
+    else:
+        chunks = response.iter_content(chunk_size)
+    for chunk in chunks:
+        deadline.check(what)
+        yield chunk
+
+
+def _read1_chunks(raw, chunk_size):
+    """Yield raw.read1() chunks, translating urllib3 errors to requests' the way iter_content does
+    """
+    from requests import exceptions
+    from urllib3.exceptions import DecodeError, ProtocolError, ReadTimeoutError, SSLError
+
+    try:
+        yield from iter(lambda: raw.read1(chunk_size, decode_content=True), b'')
+    except ProtocolError as ex:
+        raise exceptions.ChunkedEncodingError(ex)
+    except DecodeError as ex:
+        raise exceptions.ContentDecodingError(ex)
+    except ReadTimeoutError as ex:
+        raise exceptions.ConnectionError(ex)
+    except SSLError as ex:
+        raise exceptions.SSLError(ex)
+
+
+def read_body(response, what='the response body'):
+    """Read the whole body of a streamed response, bounded by the run deadline
+
+    Sets response.content as requests would without stream=True and returns
+    the connection to the pool; on an error the connection is dropped.
+
+    Args:
+        response: requests.Response -> Response sent with stream=True
+        what: str -> Named by DeadlineExceeded
+    Returns:
+        content: bytes -> Decoded body
+    Raises:
+        DeadlineExceeded: when the run deadline passes before the body is read
+    """
+    if response._content is False:
+        try:
+            response._content = b''.join(iter_body(response, what=what))
+            response._content_consumed = True
+        finally:
+            response.close()
+    return response.content
+
+
+def compress_body(url, data, min_size=COMPRESS_MIN_SIZE):
+    """Gzip a request body when it is large enough and the host has not rejected gzip before
+
+    Returns:
+        body: bytes -> Gzipped body, None to send data as it is
+        size: int -> Bytes that were gzipped, data encoded as UTF-8 when it is a str
+    """
+    if not isinstance(data, (str, bytes)):
+        return None, None
+    payload = data.encode('utf-8') if isinstance(data, str) else data
+    if len(payload) < min_size or urllib.parse.urlsplit(url).netloc in get_plain_body_hosts():
+        return None, None
+    import gzip
+
+    return gzip.compress(payload), len(payload)
+
+
+def send_with_retry_raw(method=None, url=None, headers={}, data=None, client=None, policy=None, params=None,
+                        stream=False, compress=False):
+    """Run HTTP requests, retrying as the retry policy allows
+
+    Args:
+        method: HTTP methods - POST, PATCH etc.
+        url: Request URL
+        headers: Request headers
+        data: Request payload
+        client: HttpClient -> Pooled HTTP client, defaults to the shared one
+        policy: RetryPolicy -> Retry policy, defaults to the shared one
+        params: dict() -> Query string parameters
+        stream: bool -> Leave the body of the successful response unread, the caller must close it
+        compress: bool -> Gzip a data payload of COMPRESS_MIN_SIZE bytes or more; a host rejecting
+                          it gets the plain body, and only plain bodies for PLAIN_BODY_TTL secs
+                          from every step
+
+    Returns:
+        response: requests.Response for successful request
+        (or) raises HttpRequestError, CircuitOpenError while the host's circuit is open,
+        DeadlineExceededError once the run deadline leaves no time for an attempt
+    """
+    import requests
+
+    client = client or get_client()
+    policy = policy or get_retry_policy()
+    breaker = get_circuit_breaker()
+    deadline = get_deadline()
+    host = urllib.parse.urlsplit(url).netloc
+    compressed, plain_size = compress_body(url, data) if compress else (None, None)
+    if policy.budget is not None:
+        policy.budget.record_request()
+    attempt = 0
+    message = None
+    fallback = False
+    while True:
+        # Checked before every attempt, another step may have opened the circuit meanwhile
+        allowed, probe = breaker.allow(host)
+        if not allowed:
+            increment('servicenow_circuit_rejected_total', host=host)
+            raise CircuitOpenError('Circuit open for {} after repeated failures, not sending {} {}{}'.format(
+                host, method, url, ', last error: ' + message if message else ''))
+        if probe:
+            print('Circuit half-open for %s, probing with %s %s' % (host, method, url))
+        attempt = attempt + 1
+        response = None
+        exception = None
+        try:
+            while True:
+                if compressed is not None:
+                    response = client.request(method, url, headers=dict(headers, **{'Content-Encoding': 'gzip'}),
+                                              data=compressed, params=params, stream=stream)
+                else:
+                    response = client.request(method, url, headers=headers, data=data, params=params, stream=stream)
+                increment('servicenow_http_requests_total', method=method, status=response.status_code)
+                if compressed is None or response.status_code not in COMPRESS_REJECTED_STATUS:
+                    break
+                # Maybe the host can't read gzip, resend plain within this attempt, and its probe lease
+                read_body(response, 'the error body of {} {}'.format(method, url))
+                print('%s %s rejected the gzipped body (status %s), resending it plain' % (
+                    method, url, response.status_code))
+                compressed = None
+                fallback = True
+            # Check for HTTP codes other than 200
+            if response.status_code < 400:
+                break
+            # Read the error body so a streamed connection goes back to the pool
+            read_body(response, 'the error body of {} {}'.format(method, url))
+        except requests.exceptions.RequestException as ex:
+            increment('servicenow_http_requests_total', method=method, status=type(ex).__name__)
+            exception = ex
+        except DeadlineExceeded as ex:
+            raise DeadlineExceededError('{} {} {}{}'.format(ex, method, url,
+                                                            ', last error: ' + message if message else ''))
+        if response is not None:
+            message = 'Status: {}, Headers: {}, Error Response: {}'.format(response.status_code,
+                                                                           response.headers,
+                                                                           response.content)
+        else:
+            template = "An exception of type {0} occurred. Arguments:\n{1!r}"
+            message = template.format(type(exception).__name__, exception.args)
+        # Only an unreachable or failing host counts against the circuit, a 4xx is an answer
+        if exception is not None or response.status_code in FAILURE_STATUS:
+            if breaker.record_failure(host) == OPEN:
+                raise CircuitOpenError('Circuit opened for {} after {} attempt(s): {}'.format(host, attempt, message),
+                                       response)
+        else:
+            breaker.record_success(host)
+        retry, reason = policy.should_retry(attempt, response=response, exception=exception)
+        if not retry:
+            raise HttpRequestError('{} after {} attempt(s): {}'.format(reason.capitalize(), attempt, message),
+                                   response)
+        delay = policy.next_delay(attempt, response)
+        if delay >= deadline.remaining():
+            raise DeadlineExceededError('Run deadline leaves no time to retry after {} attempt(s): {}'.format(
+                attempt, message), response)
+        increment('servicenow_http_retries_total', method=method)
+        print('Retrying API - %s operation for URL - %s in %.1f secs' % (method, url, delay))
+        time.sleep(delay)
+    breaker.record_success(host)
+    if fallback:
+        # The plain body went through, the gzipped one was the problem
+        get_plain_body_hosts().add(host)
+    if compressed is not None:
+        increment('servicenow_http_bytes_saved_total', plain_size - len(compressed), direction='request')
+    if not stream:
+        count_saved_bytes(response, len(response.content))
+    return response
+
+
+def send_with_retry(method=None, url=None, headers={}, data=None, client=None, policy=None, params=None,
+                    compress=False):
+    """Run HTTP requests via send_with_retry_raw and decode the JSON response
+
+    Returns:
+        response: dict() for successful request
+        (or) raises HttpRequestError
+    """
+    response = send_with_retry_raw(method, url, headers=headers, data=data, client=client, policy=policy,
+                                   params=params, compress=compress)
+    return json.loads(response.content.decode('utf-8'))
+
+
+def send_streaming(method=None, url=None, headers={}, data=None, client=None, policy=None, params=None,
+                   key='result', chunk_size=STREAM_CHUNK_SIZE):
+    """Run HTTP requests via send_with_retry_raw and decode the records of the JSON response as they arrive
+
+    The request is sent, and retried, before this returns; only the body is
+    read lazily. Exhaust the generator, or close it once iteration started,
+    to release the connection.
+
+    Args:
+        key: str -> Top-level member holding the records
+        chunk_size: int -> Bytes read from the socket at a time
+    Returns:
+        items: generator -> Records of the key array, in response order
+        (or) raises HttpRequestError, DeadlineExceededError also while iterating
+    """
+    response = send_with_retry_raw(method, url, headers=headers, data=data, client=client, policy=policy,
+                                   params=params, stream=True)
+
+    def chunks():
+        decoded_size = 0
+        try:
+            for chunk in iter_body(response, chunk_size, 'the rest of {} {}'.format(method, url)):
+                decoded_size += len(chunk)
+                yield chunk
+        except DeadlineExceeded as ex:
+            raise DeadlineExceededError(str(ex), response)
+        count_saved_bytes(response, decoded_size)
+
+    def items():
+        with response:
+            yield from iter_items(chunks(), key=key)
+
+    return items()
+
+
+class RevalidationCache:
+    """Last decoded body and validators per URL for conditional GETs
+    """
+
+    def __init__(self, max_entries=REVALIDATION_CACHE_SIZE):
+        """Initialise instance variables
+        Args:
+            max_entries: int -> Entries kept, least recently used are dropped first
+        """
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+def get_record_version(body, fields=VERSION_FIELDS):
+    """Return the version fields of the first record in a Table API style response
+
+    Returns:
+        version: tuple() -> Field values, None when the record carries none of them
+    """
+    result = body.get('result') if isinstance(body, dict) else None
+    if isinstance(result, list):
+        result = result[0] if result else None
+    if not isinstance(result, dict):
+        return None
+    values = [result.get(field) for field in fields]
+    values = tuple(value.get('value') if isinstance(value, dict) else value for value in values)
+    return values if any(value is not None for value in values) else None
+
+
+def send_conditional(url=None, headers={}, params=None, client=None, policy=None, cache=None,
+                     version_fields=VERSION_FIELDS):
+    """GET url, revalidating the previous response instead of downloading it again
+
+    Sends If-None-Match / If-Modified-Since when the last response carried an
+    ETag / Last-Modified and reuses the cached body on 304. Without those
+    validators, when the cached body is a full record with version_fields, a
+    GET projected to just those fields decides whether it has to be fetched
+    again. A read already projected by sysparm_fields is about as small as
+    that probe, it is simply sent again.
+
+    Args:
+        url: Request URL
+        headers: Request headers
+        params: dict() -> Query string parameters
+        client: HttpClient -> Pooled HTTP client, defaults to the shared one
+        policy: RetryPolicy -> Retry policy, defaults to the shared one
+        cache: RevalidationCache -> Defaults to the shared one
+        version_fields: tuple() -> Record fields that change on every update
+
+    Returns:
+        response: dict() for successful request
+        (or) raises HttpRequestError
+    """
+    cache = cache or get_revalidation_cache()
+    key = url + '?' + urllib.parse.urlencode(sorted((params or dict()).items()))
+    entry = cache.get(key)
+    request_headers = dict(headers)
+    if entry is not None:
+        if entry['etag'] or entry['last_modified']:
+            if entry['etag']:
+                request_headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                request_headers['If-Modified-Since'] = entry['last_modified']
+        elif entry['version'] is not None and 'sysparm_fields' not in (params or dict()):
+            probe_params = dict(params or dict())
+            probe_params['sysparm_fields'] = ','.join(version_fields)
+            probe = send_with_retry('GET', url, headers=headers, client=client, policy=policy, params=probe_params)
+            if get_record_version(probe, version_fields) == entry['version']:
+                increment('servicenow_http_revalidated_total', mode='version')
+                return entry['body']
+    response = send_with_retry_raw('GET', url, headers=request_headers, client=client, policy=policy, params=params)
+    if response.status_code == 304 and entry is not None:
+        increment('servicenow_http_revalidated_total', mode='etag')
+        return entry['body']
+    body = json.loads(response.content.decode('utf-8'))
+    cache.put(key, {'etag': response.headers.get('ETag'),
+                    'last_modified': response.headers.get('Last-Modified'),
+                    'version': get_record_version(body, version_fields),
+                    'body': body})
+    return body
+
+
+_revalidation_cache = RevalidationCache()
+
+
+def get_revalidation_cache():
+    """Return the process wide revalidation cache
+    """
+    return _revalidation_cache
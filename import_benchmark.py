@@ -0,0 +1,159 @@
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+
+
+"""Cold-start import benchmark for the Octopus step scripts
+
+Every step runs in a fresh interpreter, so import time is paid on every
+run. Imports each script in a new interpreter under -X importtime, checks
+the median against a per-script budget and checks that modules the
+scripts defer to the paths that use them were not loaded. With --tick it
+also runs a healthy monitoring tick against the stand-in server and
+checks that the mail stack stays unloaded.
+
+Usage:
+    python import_benchmark.py --runs 5
+    python import_benchmark.py --tick --json
+"""
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Median cumulative import time budget per script in ms
+IMPORT_BUDGETS_MS = {
+    'Monitor': 40,
+    'monitoring': 30,
+    'monitoring_withmail': 40,
+    'email_task': 30,
+    'install_version': 30,
+}
+# Loaded only on the paths that use them, never by importing a script
+DEFERRED_MODULES = ('requests', 'smtplib', 'email.mime', 'mail_transport', 'mail_queue', 'argparse', 'inspect',
+                    'concurrent.futures.thread', 'datetime', 'sqlite3')
+# Never loaded by a healthy monitoring tick
+TICK_DEFERRED_MODULES = ('smtplib', 'email.mime', 'mail_transport', 'mail_queue', 'argparse', 'inspect')
+
+IMPORT_TIME_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+TICK_CODE = '''
+import json, runpy, sys
+sys.path.insert(0, %(here)r)
+from servicenow_standin import StandinServer
+server = StandinServer().start()
+cr_number = server.state.create({'state': 'scheduled'}, 0)
+variables = {'ServiceNow.Url': server.api_url, 'ServiceNow.Auth.GrantType': 'password',
+             'ServiceNow.Auth.ClientId': 'import-benchmark', 'ServiceNow.Auth.ClientSecret': 'secret',
+             'ServiceNow.Auth.Username': 'user', 'ServiceNow.Auth.Password': 'password',
+             'ServiceNow.Cr.Number': cr_number}
+def failstep(message):
+    raise SystemExit('failstep: %%s' %% message)
+harness = {'octopusvariables': variables, 'get_octopusvariable': variables.__getitem__,
+           'set_octopusvariable': variables.__setitem__, 'failstep': failstep,
+           'printhighlight': lambda message: None, 'printwarning': lambda message: None}
+before = set(sys.modules)
+runpy.run_path(%(script)r, init_globals=harness, run_name='<run_path>')
+loaded = set(sys.modules) - before
+print(json.dumps(sorted(loaded)))
+'''
+
+
+def parse_importtime(stderr):
+    """Parse -X importtime output
+
+    Returns:
+        cumulative: dict() -> Module name to cumulative import time in us
+    """
+    cumulative = dict()
+    for line in stderr.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if match:
+            cumulative[match.group(4)] = int(match.group(2))
+    return cumulative
+
+
+def loaded_matches(modules, prefixes):
+    """Return the entries of prefixes loaded as a module or package in modules
+    """
+    return sorted(prefix for prefix in prefixes
+                  if any(name == prefix or name.startswith(prefix + '.') for name in modules))
+
+
+def measure_import(module, runs):
+    """Import module in runs fresh interpreters
+
+    Returns:
+        result: dict() -> Median and per-run times in ms, deferred modules that got loaded
+    """
+    times = []
+    modules = set()
+    for _ in range(runs):
+        completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                                   cwd=HERE, capture_output=True, text=True)
+        if completed.returncode != 0:
+            raise RuntimeError('Importing %s failed:\n%s' % (module, completed.stderr[-2000:]))
+        cumulative = parse_importtime(completed.stderr)
+        times.append(cumulative[module] / 1000.0)
+        modules.update(cumulative)
+    median = statistics.median(times)
+    budget = IMPORT_BUDGETS_MS.get(module)
+    loaded = loaded_matches(modules, DEFERRED_MODULES)
+    return {
+        'module': module,
+        'median_ms': median,
+        'runs_ms': times,
+        'budget_ms': budget,
+        'deferred_loaded': loaded,
+        'ok': (budget is None or median <= budget) and not loaded,
+    }
+
+
+def measure_tick(script):
+    """Run a healthy monitoring tick of script against the stand-in in a fresh interpreter
+
+    Returns:
+        result: dict() -> Mail stack modules the tick loaded
+    """
+    scratch = tempfile.mkdtemp(prefix='import-benchmark-')
+    env = dict(os.environ, SERVICENOW_TOKEN_CACHE_DIR=scratch,
+               MONITORING_ALERT_STATE=os.path.join(scratch, 'alerts.json'),
+               SERVICENOW_CR_CACHE=os.path.join(scratch, 'cr-cache.sqlite3'))
+    code = TICK_CODE % {'here': HERE, 'script': os.path.join(HERE, script + '.py')}
+    completed = subprocess.run([sys.executable, '-c', code], cwd=HERE, capture_output=True, text=True, env=env)
+    if completed.returncode != 0:
+        raise RuntimeError('Tick of %s failed:\n%s' % (script, (completed.stdout + completed.stderr)[-2000:]))
+    loaded = loaded_matches(json.loads(completed.stdout.strip().splitlines()[-1]), TICK_DEFERRED_MODULES)
+    return {'module': script, 'tick_loaded': loaded, 'ok': not loaded}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Step script import time benchmark')
+    parser.add_argument('--modules', default=','.join(IMPORT_BUDGETS_MS), help='Comma separated scripts to import')
+    parser.add_argument('--runs', type=int, default=5, help='Fresh interpreters per script')
+    parser.add_argument('--tick', action='store_true', help='Also run a healthy monitoring tick per monitoring script')
+    parser.add_argument('--json', action='store_true', help='Print results as JSON lines')
+    args = parser.parse_args(argv)
+
+    results = [measure_import(module, args.runs) for module in args.modules.split(',')]
+    if args.tick:
+        results += [measure_tick(script) for script in ('monitoring', 'monitoring_withmail')]
+    for result in results:
+        if args.json:
+            print(json.dumps(result))
+        elif 'tick_loaded' in result:
+            print('%-20s tick        %s' % (result['module'],
+                                           'loaded ' + ', '.join(result['tick_loaded']) if result['tick_loaded']
+                                           else 'mail stack not loaded'))
+        else:
+            print('%-20s import %6.1f ms  budget %4s ms  %s' % (
+                result['module'], result['median_ms'], result['budget_ms'],
+                'loaded ' + ', '.join(result['deferred_loaded']) if result['deferred_loaded'] else 'ok'))
+    sys.exit(0 if all(result['ok'] for result in results) else 1)
+
+
+if __name__ == "__main__":
+    main()
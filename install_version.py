@@ -0,0 +1,152 @@
+import json
+import os
+import re
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from deadline import start_deadline
+from http_client import HttpRequestError, configure_client, get_client, send_with_retry
+from metrics import timed
+
+
+"""InstallVersion registration module
+
+Registers a release with the web install service and points its version
+of choice (/voc) at it: POST the version, GET /voc, PUT /voc. A release
+rolled out to many regions is registered with every endpoint in
+WebInstallServiceUrl at once, over the pooled client certificate session.
+"""
+
+# Endpoints registered concurrently
+INSTALL_WORKERS = 8
+JSON_HEADERS = {'Content-Type': 'application/json'}
+# WebInstallServiceUrl may list endpoints separated by commas, semicolons or whitespace
+URL_SEPARATORS = re.compile(r'[,;\s]+')
+
+
+def _accepted(response):
+    """Whether an install service response reports success, a positive id or a non empty body
+    """
+    if isinstance(response, bool):
+        return response
+    if isinstance(response, (int, float)):
+        return response > 0
+    return bool(response)
+
+
+class InstallVersionApi:
+    """Web install service helper class
+    """
+
+    def __init__(self, client=None):
+        """Initialize instance variables
+        Args:
+            client: HttpClient -> Pooled HTTP client, defaults to the shared one
+        """
+        self.client = client or get_client()
+
+    @timed('register_install_version')
+    def register_version(self, url, version, environment_name):
+        """Create an InstallVersion and point the endpoint's version of choice at it
+        Args:
+            url: str -> Install service endpoint, e.g. https://host/api/InstallVersion
+            version: str -> Release number
+            environment_name: str -> Octopus environment, part of the manifest path
+        Returns:
+            result: dict() -> 'url', 'version_id', 'previous_version_id' and 'error' (None on success)
+        """
+        result = {'url': url, 'version_id': None, 'previous_version_id': None, 'error': None}
+        payload = {'Version': version, 'RelativePath': '%s%s\\pda.manifest' % (version, environment_name)}
+        try:
+            version_id = send_with_retry('POST', url, headers=JSON_HEADERS, data=json.dumps(payload),
+                                         client=self.client)
+            if not _accepted(version_id):
+                result['error'] = 'InstallVersion was not created, response: %r' % (version_id,)
+                return result
+            result['version_id'] = version_id
+            voc = send_with_retry('GET', url + '/voc', headers=JSON_HEADERS, client=self.client)
+            result['previous_version_id'] = voc.get('InstallVersionID') if isinstance(voc, dict) else None
+            if result['previous_version_id'] == version_id:
+                # Already pointed at this version, e.g. by an earlier attempt of the step
+                return result
+            response = send_with_retry('PUT', url + '/voc', headers=JSON_HEADERS,
+                                       data=json.dumps({'InstallVersionID': version_id}), client=self.client)
+            if not _accepted(response):
+                result['error'] = 'Version of choice was not updated, response: %r' % (response,)
+        except HttpRequestError as ex:
+            result['error'] = str(ex)
+        except ValueError as ex:
+            # An empty or non JSON body, only this endpoint failed
+            result['error'] = 'Invalid response: %s' % ex
+        return result
+
+    @timed('register_install_versions')
+    def register_versions(self, urls, version, environment_name, workers=INSTALL_WORKERS):
+        """Register a release with many install service endpoints concurrently
+        Args:
+            urls: list() -> Install service endpoints
+            version: str -> Release number
+            environment_name: str -> Octopus environment
+            workers: int -> Endpoints registered at a time
+        Returns:
+            results: list() -> One register_version result per endpoint, in input order
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        print('BEGIN: Registering install version')
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(urls)))) as executor:
+            results = list(executor.map(lambda url: self.register_version(url, version, environment_name), urls))
+        print('END: Registering install version')
+        return results
+
+
+def read_octopus_vars():
+    """Read Octopus variables
+    Format:
+        WebInstallServiceUrl:           Install service endpoints, comma separated
+        WebInstallService.Certificate:  Client certificate PEM file, optional
+        WebInstallService.Key:          Its private key PEM file when not part of the certificate file
+        Octopus.Release.Number:         Release registered
+        Octopus.Environment.Name:       Environment, part of the manifest path
+    """
+    print('BEGIN: Reading octopus variables')
+    octopus_vars = dict()
+    for var in ('WebInstallServiceUrl', 'Octopus.Release.Number', 'Octopus.Environment.Name'):
+        try:
+            octopus_vars[var] = get_octopusvariable(var)
+        except Exception as e:
+            failstep('Required variable "%s" is not set: %s' % (var, e))
+    for var in ('WebInstallService.Certificate', 'WebInstallService.Key'):
+        octopus_vars[var] = octopusvariables.get(var) or None
+    print('END: Reading octopus variables')
+    return octopus_vars
+
+
+def run():
+    """Script entry point runner method
+    """
+    start_deadline(octopusvariables.get('ServiceNow.StepTimeout'))
+    octopus_vars = read_octopus_vars()
+    urls = [url.rstrip('/') for url in URL_SEPARATORS.split(octopus_vars['WebInstallServiceUrl']) if url.rstrip('/')]
+    if not urls:
+        failstep('WebInstallServiceUrl lists no install service endpoints')
+    cert = octopus_vars['WebInstallService.Certificate']
+    if cert and octopus_vars['WebInstallService.Key']:
+        cert = (cert, octopus_vars['WebInstallService.Key'])
+    # One pool per endpoint host, every call after the first reuses its TLS session
+    client = configure_client(cert=cert, pool_connections=len(urls), pool_maxsize=INSTALL_WORKERS)
+    results = InstallVersionApi(client).register_versions(urls, octopus_vars['Octopus.Release.Number'],
+                                                         octopus_vars['Octopus.Environment.Name'])
+    for result in results:
+        if result['error']:
+            printwarning('InstallVersion registration failed for %s: %s' % (result['url'], result['error']))
+        else:
+            printhighlight('%s version of choice: %s (was %s)' % (result['url'], result['version_id'],
+                                                                  result['previous_version_id']))
+    failed = [result for result in results if result['error']]
+    if failed:
+        failstep('InstallVersion registration failed for %d of %d endpoints' % (len(failed), len(results)))
+
+
+if __name__ == "<run_path>":
+    run()
@@ -0,0 +1,122 @@
+import codecs
+import json
+
+
+"""Incremental JSON decoding of Table API style responses
+
+Decodes the items of the top-level result array as their bytes arrive,
+so a large query result is processed one record at a time instead of
+being buffered and parsed as a whole.
+"""
+
+WHITESPACE = ' \t\n\r'
+DELIMITERS = WHITESPACE + ',:]}'
+
+
+class _Reader:
+    """Text buffer over a byte chunk iterator, decoding values as they complete
+    """
+
+    def __init__(self, chunks, encoding):
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder(encoding)()
+        self.json_decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        """Read one more chunk, returns False at the end of the stream
+        """
+        if self.eof:
+            return False
+        try:
+            chunk = next(self.chunks)
+        except StopIteration:
+            self.eof = True
+            self.buffer = self.buffer[self.pos:] + self.decoder.decode(b'', final=True)
+            self.pos = 0
+            return False
+        # Drop consumed text so the buffer only holds the value being decoded
+        self.buffer = self.buffer[self.pos:] + self.decoder.decode(chunk)
+        self.pos = 0
+        return True
+
+    def _error(self, message):
+        return json.JSONDecodeError(message, self.buffer, self.pos)
+
+    def peek(self):
+        """Return the next non-whitespace character without consuming it, '' at the end
+        """
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, chars):
+        """Consume the next non-whitespace character, which must be one of chars
+        """
+        char = self.peek()
+        if not char or char not in chars:
+            raise self._error('Expecting one of %r' % chars)
+        self.pos += 1
+        return char
+
+    def value(self):
+        """Decode the next complete JSON value
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = self.json_decoder.raw_decode(self.buffer, self.pos)
+                # Only a following delimiter shows the value is complete, a number cut
+                # at the end of a chunk like '2.' still decodes
+                if self.eof or (end < len(self.buffer) and self.buffer[end] in DELIMITERS):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+
+def iter_items(chunks, key='result', encoding='utf-8'):
+    """Yield the items of the key array of a JSON object as they are decoded
+
+    A single object under key, as returned for one record, is yielded as the
+    only item. Other top-level members are skipped.
+
+    Args:
+        chunks: iterable -> Response body bytes, e.g. response.iter_content()
+        key: str -> Top-level member holding the records
+        encoding: str -> Body encoding
+    Raises:
+        json.JSONDecodeError: for a malformed or truncated body
+    """
+    reader = _Reader(chunks, encoding)
+    reader.expect('{')
+    if reader.peek() == '}':
+        return
+    while True:
+        name = reader.value()
+        reader.expect(':')
+        if name != key:
+            reader.value()
+        elif reader.peek() == '[':
+            reader.expect('[')
+            if reader.peek() == ']':
+                reader.expect(']')
+            else:
+                while True:
+                    yield reader.value()
+                    if reader.expect(',]') == ']':
+                        break
+        else:
+            value = reader.value()
+            if value is not None:
+                yield value
+        if reader.expect(',}') == '}':
+            return
@@ -0,0 +1,267 @@
+import argparse
+import atexit
+import glob
+import itertools
+import json
+import os
+import queue
+import smtplib
+import sys
+import tempfile
+import threading
+import time
+
+from deadline import Deadline
+from mail_transport import MailTransport, get_transport
+
+
+"""Background mail dispatch with a disk spool
+
+Mail is handed to a bounded queue and sent by a worker thread, so a slow
+or unreachable relay never holds up the step that reports a failure.
+Messages the relay refused, that did not fit the queue, or that were
+still unsent when the exit flush ran out of time are written to a spool
+directory, and the drain command resends them later:
+
+    python mail_queue.py
+    python mail_queue.py --spool-dir /var/spool/servicenow-mail --list
+"""
+
+# Spool directory, override with $MAIL_SPOOL_DIR
+DEFAULT_SPOOL_DIR = os.path.join(tempfile.gettempdir(), 'servicenow-mail-spool')
+# Messages waiting for the worker before new ones go straight to the spool
+MAIL_QUEUE_SIZE = 100
+# Secs the exit flush waits for queued mail before spooling the rest; a budget of its own, it
+# starts when the flush does and does not draw on what is left of the run deadline
+MAIL_FLUSH_TIMEOUT = 10
+# Secs after which a message claimed by a drain that never finished may be claimed again
+CLAIM_TIMEOUT = 600
+
+SPOOL_SUFFIX = '.json'
+CLAIM_SUFFIX = '.sending'
+
+_sequence = itertools.count()
+
+
+def spool_message(spool_dir, from_addr, to_addrs, message):
+    """Write a message to the spool for the drain command
+
+    Returns:
+        path: str -> Spool file
+    """
+    os.makedirs(spool_dir, exist_ok=True)
+    path = os.path.join(spool_dir, '%.6f-%d-%d%s' % (time.time(), os.getpid(), next(_sequence), SPOOL_SUFFIX))
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as spool_file:
+        json.dump({'from': from_addr, 'to': to_addrs, 'message': message, 'spooled_at': time.time()}, spool_file)
+    os.replace(tmp_path, path)
+    return path
+
+
+def _claim(path):
+    """Rename a spool file so concurrent drains skip it, None when another drain got it first
+    """
+    claimed = path[:-len(SPOOL_SUFFIX)] + CLAIM_SUFFIX if path.endswith(SPOOL_SUFFIX) else path
+    try:
+        if claimed != path:
+            os.replace(path, claimed)
+        # Restart the claim timeout, also when taking over a stale claim
+        os.utime(claimed)
+    except OSError:
+        return None
+    return claimed
+
+
+def drain(spool_dir=None, transport=None):
+    """Resend spooled messages, oldest first
+
+    Args:
+        spool_dir: str -> Spool directory, defaults to $MAIL_SPOOL_DIR or DEFAULT_SPOOL_DIR
+        transport: MailTransport -> Defaults to the process wide one
+    Returns:
+        sent: int -> Messages sent and removed from the spool
+        failed: int -> Messages left in the spool
+    """
+    spool_dir = spool_dir or os.environ.get('MAIL_SPOOL_DIR') or DEFAULT_SPOOL_DIR
+    transport = transport or get_transport()
+    now = time.time()
+    paths = glob.glob(os.path.join(spool_dir, '*' + SPOOL_SUFFIX))
+    for path in glob.glob(os.path.join(spool_dir, '*' + CLAIM_SUFFIX)):
+        try:
+            if now - os.path.getmtime(path) > CLAIM_TIMEOUT:
+                paths.append(path)
+        except FileNotFoundError:
+            # Sent and removed by a concurrent drain meanwhile
+            continue
+    sent = failed = 0
+    for path in sorted(paths, key=os.path.basename):
+        claimed = _claim(path)
+        if claimed is None:
+            continue
+        try:
+            with open(claimed) as spool_file:
+                item = json.load(spool_file)
+            transport.send(item['from'], item['to'], item['message'])
+        except (smtplib.SMTPException, OSError, ValueError) as ex:
+            print('Resending %s failed: %s' % (os.path.basename(path), ex))
+            os.replace(claimed, claimed[:-len(CLAIM_SUFFIX)] + SPOOL_SUFFIX)
+            failed += 1
+            continue
+        os.remove(claimed)
+        sent += 1
+    return sent, failed
+
+
+class MailQueue:
+    """Bounded queue of outgoing mail sent by a background worker
+    """
+
+    def __init__(self, transport=None, spool_dir=None, maxsize=MAIL_QUEUE_SIZE):
+        """Initialise instance variables
+        Args:
+            transport: MailTransport -> Used by the worker alone, defaults to a new one; the
+                                        process wide one would make its exit close wait for a hung send.
+                                        The default one is not bound by the run deadline, so a step
+                                        that ran out of time still has its failure mailed
+            spool_dir: str -> Spool directory, defaults to $MAIL_SPOOL_DIR or DEFAULT_SPOOL_DIR
+            maxsize: int -> Messages waiting before new ones are spooled instead
+        """
+        # Without a time limit until the exit flush, only the per-call socket timeout applies
+        self.transport = transport or MailTransport(deadline=Deadline())
+        self.spool_dir = spool_dir or os.environ.get('MAIL_SPOOL_DIR') or DEFAULT_SPOOL_DIR
+        self._queue = queue.Queue(maxsize)
+        self._lock = threading.Lock()
+        self._worker = None
+        self._inflight = None
+        self._closed = False
+
+    def _spool(self, item, reason):
+        try:
+            path = spool_message(self.spool_dir, *item)
+            print('Mail spooled to %s (%s), resend it with the drain command' % (path, reason))
+        except OSError as ex:
+            print('Spooling mail failed, message dropped: %s' % ex)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            with self._lock:
+                # Known to the exit flush, which spools it when the send outlasts the deadline
+                self._inflight = item
+            try:
+                self.transport.send(*item)
+            except (smtplib.SMTPException, OSError) as ex:
+                with self._lock:
+                    owned = self._inflight is item
+                    self._inflight = None
+                if owned:
+                    self._spool(item, ex)
+            else:
+                with self._lock:
+                    if self._inflight is item:
+                        self._inflight = None
+            finally:
+                self._queue.task_done()
+
+    def submit(self, from_addr, to_addrs, message):
+        """Queue a message for the background worker, or spool it when the queue is full
+
+        Args:
+            from_addr: str -> Envelope sender
+            to_addrs: str|list() -> Envelope recipients
+            message: str -> Rendered message, e.g. msg.as_string()
+        Returns:
+            queued: bool -> False when the message went to the spool
+        """
+        item = (from_addr, to_addrs, message)
+        with self._lock:
+            if self._closed:
+                self._spool(item, 'queue closed')
+                return False
+            if self._worker is None:
+                # A daemon, the exit flush decides how long unsent mail may hold the process
+                self._worker = threading.Thread(target=self._run, name='mail-queue', daemon=True)
+                self._worker.start()
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self._spool(item, 'queue full')
+            return False
+        return True
+
+    def flush(self, timeout=MAIL_FLUSH_TIMEOUT):
+        """Wait for queued mail to be sent, spooling whatever is left at the deadline
+
+        No mail is accepted afterwards, later messages go to the spool. A
+        message the worker is still sending at the deadline is spooled as
+        well; better twice than lost. The flush has its own budget, the
+        failure of a step that ran out of time is what most needs mailing.
+
+        Args:
+            timeout: float -> Secs to wait, they also bound the SMTP exchanges started meanwhile
+        Returns:
+            spooled: int -> Messages spooled because the deadline passed
+        """
+        deadline = Deadline(timeout)
+        self.transport.deadline = deadline
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = deadline.remaining()
+                if remaining <= 0:
+                    break
+                self._queue.all_tasks_done.wait(remaining)
+        with self._lock:
+            self._closed = True
+            left = [self._inflight] if self._inflight is not None else []
+            self._inflight = None
+        while True:
+            try:
+                left.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        for item in left:
+            self._spool(item, 'not sent within %ss' % timeout)
+        if not left:
+            # The worker is idle, with a send still hanging it holds the transport until its timeout
+            self.transport.close()
+        return len(left)
+
+
+_mail_queue = None
+_mail_queue_lock = threading.Lock()
+
+
+def get_mail_queue():
+    """Return the process wide mail queue, creating it on first use
+
+    The queue is flushed at interpreter exit.
+    """
+    global _mail_queue
+    with _mail_queue_lock:
+        if _mail_queue is None:
+            _mail_queue = MailQueue()
+            atexit.register(_mail_queue.flush)
+        return _mail_queue
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Resend spooled monitoring mail')
+    parser.add_argument('--spool-dir', help='Spool directory, defaults to $MAIL_SPOOL_DIR or the temp directory')
+    parser.add_argument('--list', action='store_true', help='List spooled messages instead of sending them')
+    args = parser.parse_args(argv)
+
+    spool_dir = args.spool_dir or os.environ.get('MAIL_SPOOL_DIR') or DEFAULT_SPOOL_DIR
+    if args.list:
+        for path in sorted(glob.glob(os.path.join(spool_dir, '*' + SPOOL_SUFFIX))):
+            with open(path) as spool_file:
+                item = json.load(spool_file)
+            print('%s  %s -> %s' % (os.path.basename(path), item['from'], item['to']))
+        return
+    sent, failed = drain(spool_dir)
+    print('Sent %d spooled messages, %d left in %s' % (sent, failed, spool_dir))
+    get_transport().close()
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+import atexit
+import os
+import re
+import smtplib
+import threading
+import time
+
+from deadline import get_deadline
+from metrics import span
+
+
+"""Shared SMTP transport for all mailers
+
+Keeps one connection to the relay open for the life of the process,
+probes it with NOOP after it has been idle, and sends queued messages
+back to back over it, pipelining the envelope when the relay advertises
+PIPELINING.
+"""
+
+# Relay settings, override with MAIL_SMTP_HOST / MAIL_SMTP_PORT e.g. to
+# point at a local debugging SMTP server
+DEFAULT_SMTP_HOST = 'atom.paypalcorp.com'
+DEFAULT_SMTP_PORT = 25
+# Idle secs after which the connection is probed before reuse
+DEFAULT_IDLE_TIMEOUT = 30
+DEFAULT_TIMEOUT = 60
+
+
+def to_smtp_data(message):
+    """Return message as CRLF terminated, dot-stuffed bytes ready for DATA
+    """
+    if isinstance(message, str):
+        message = message.encode('utf-8')
+    message = re.sub(br'(?m)^\.', b'..', re.sub(br'\r?\n', b'\r\n', message))
+    if not message.endswith(b'\r\n'):
+        message += b'\r\n'
+    return message
+
+
+class MailTransport:
+    """Persistent SMTP connection with a send queue
+    """
+
+    def __init__(self, host=None, port=None, idle_timeout=DEFAULT_IDLE_TIMEOUT, timeout=DEFAULT_TIMEOUT,
+                 deadline=None):
+        """Initialise instance variables
+        Args:
+            host: str -> SMTP relay, defaults to $MAIL_SMTP_HOST or DEFAULT_SMTP_HOST
+            port: int -> SMTP port, defaults to $MAIL_SMTP_PORT or DEFAULT_SMTP_PORT
+            idle_timeout: float -> Idle secs after which the connection is probed
+            timeout: float -> Socket timeout in secs, lowered to what the deadline leaves
+            deadline: Deadline -> Bounds the SMTP exchanges, defaults to the run deadline
+        """
+        self.host = host or os.environ.get('MAIL_SMTP_HOST') or DEFAULT_SMTP_HOST
+        self.port = int(port or os.environ.get('MAIL_SMTP_PORT') or DEFAULT_SMTP_PORT)
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.deadline = deadline
+        self._server = None
+        self._last_used = 0
+        self._queue = []
+        self._lock = threading.RLock()
+
+    def _close_quietly(self):
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except (smtplib.SMTPException, OSError):
+                self._server.close()
+            self._server = None
+
+    def _abort(self):
+        """Drop the connection without QUIT, which mid-DATA the relay would take as message text
+        """
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+
+    def _get_deadline(self):
+        return self.deadline if self.deadline is not None else get_deadline()
+
+    def _connection(self):
+        timeout = self._get_deadline().timeout(self.timeout, 'the SMTP exchange')
+        if self._server is not None and self._server.sock is not None:
+            # A reused connection keeps the timeout it was opened with, shorten it to what is left
+            self._server.sock.settimeout(timeout)
+        if self._server is not None and time.monotonic() - self._last_used > self.idle_timeout:
+            # The relay may have dropped an idle connection
+            try:
+                code = self._server.noop()[0]
+            except (smtplib.SMTPException, OSError):
+                code = None
+            if code != 250:
+                self._close_quietly()
+        if self._server is None:
+            self._server = smtplib.SMTP(self.host, self.port, timeout=timeout)
+            self._server.ehlo()
+        return self._server
+
+    def _envelope(self, server, from_addr, to_addrs):
+        """Send MAIL, RCPT and DATA, pipelined when supported
+
+        Returns:
+            refused: dict() -> Refused recipients
+        """
+        commands = ['mail FROM:%s' % smtplib.quoteaddr(from_addr)] + \
+                   ['rcpt TO:%s' % smtplib.quoteaddr(addr) for addr in to_addrs] + ['data']
+        if server.has_extn('pipelining'):
+            server.send(''.join(command + '\r\n' for command in commands))
+            replies = [server.getreply() for _ in commands]
+        else:
+            replies = []
+            for command in commands:
+                server.putcmd(command)
+                replies.append(server.getreply())
+                if replies[-1][0] >= 400 and command.startswith('mail'):
+                    break
+        mail_reply, rcpt_replies, data_reply = replies[0], replies[1:len(to_addrs) + 1], replies[-1]
+        refused = {addr: reply for addr, reply in zip(to_addrs, rcpt_replies) if reply[0] not in (250, 251)}
+        failure = None
+        if mail_reply[0] != 250:
+            failure = smtplib.SMTPSenderRefused(mail_reply[0], mail_reply[1], from_addr)
+        elif len(refused) == len(to_addrs):
+            failure = smtplib.SMTPRecipientsRefused(refused)
+        elif data_reply[0] != 354:
+            failure = smtplib.SMTPDataError(*data_reply)
+        if failure is not None:
+            if len(replies) == len(commands) and data_reply[0] == 354:
+                # DATA was accepted anyway, terminate the empty message
+                server.send(b'.\r\n')
+                server.getreply()
+            server.rset()
+            raise failure
+        return refused
+
+    def _send_chunks(self, from_addr, to_addrs, chunks):
+        if isinstance(to_addrs, str):
+            to_addrs = [to_addrs]
+        server = self._connection()
+        refused = self._envelope(server, from_addr, to_addrs)
+        deadline = self._get_deadline()
+        for chunk in chunks:
+            # Socket timeouts bound each write, a relay reading slowly could still outlast the deadline
+            deadline.check('the rest of the SMTP DATA')
+            server.send(chunk)
+        server.send(b'.\r\n')
+        code, resp = server.getreply()
+        self._last_used = time.monotonic()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, resp)
+        return refused
+
+    def send(self, from_addr, to_addrs, message):
+        """Send one message, reconnecting once if the relay dropped the connection
+
+        Args:
+            from_addr: str -> Envelope sender
+            to_addrs: str|list() -> Envelope recipients
+            message: str|bytes -> Rendered message, e.g. msg.as_string()
+        Returns:
+            refused: dict() -> Refused recipients
+        """
+        data = to_smtp_data(message)
+        with self._lock, span('smtp_send'):
+            try:
+                try:
+                    return self._send_chunks(from_addr, to_addrs, [data])
+                except smtplib.SMTPServerDisconnected:
+                    self._server = None
+                    return self._send_chunks(from_addr, to_addrs, [data])
+            except (smtplib.SMTPException, OSError):
+                # Maybe mid-DATA, e.g. when the deadline passed, never reuse the connection
+                self._abort()
+                raise
+
+    def send_streamed(self, from_addr, to_addrs, chunks):
+        """Send a message chunk by chunk straight onto the connection
+
+        Args:
+            from_addr: str -> Envelope sender
+            to_addrs: str|list() -> Envelope recipients
+            chunks: iterable -> CRLF terminated, dot-stuffed message bytes
+        Returns:
+            refused: dict() -> Refused recipients
+        """
+        with self._lock, span('smtp_send'):
+            try:
+                return self._send_chunks(from_addr, to_addrs, chunks)
+            except (smtplib.SMTPException, OSError):
+                # The connection is mid-DATA, never reuse it
+                self._abort()
+                raise
+
+    def enqueue(self, from_addr, to_addrs, message):
+        """Queue a message for the next flush
+        """
+        with self._lock:
+            self._queue.append((from_addr, to_addrs, message))
+
+    def flush(self):
+        """Send all queued messages back to back over one connection
+
+        Returns:
+            failures: list() -> (message tuple, exception) for messages that could not be sent
+        """
+        with self._lock:
+            queued, self._queue = self._queue, []
+            failures = []
+            for item in queued:
+                try:
+                    self.send(*item)
+                except (smtplib.SMTPException, OSError) as ex:
+                    failures.append((item, ex))
+            return failures
+
+    def close(self):
+        """Flush queued messages and close the connection
+        """
+        with self._lock:
+            if self._queue:
+                self.flush()
+            self._close_quietly()
+
+
+_transport = None
+_transport_lock = threading.Lock()
+
+
+def get_transport():
+    """Return the process wide mail transport, creating it on first use
+    """
+    global _transport
+    with _transport_lock:
+        if _transport is None:
+            _transport = MailTransport()
+            atexit.register(_transport.close)
+        return _transport
@@ -0,0 +1,209 @@
+import atexit
+import functools
+import json
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+from token_cache import file_lock
+
+
+"""Per-phase latency metrics
+
+Timing spans and counters recorded in-process, exported as JSONL trace
+events ($METRICS_TRACE_FILE) and as a Prometheus textfile
+($METRICS_TEXTFILE, e.g. in the node_exporter textfile collector dir).
+The textfile accumulates across step processes through a JSON state file
+next to it, so histograms cover every run on the host.
+"""
+
+# Latency histogram bucket bounds in secs
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+PHASE_DURATION = 'servicenow_phase_duration_seconds'
+PHASE_FAILURES = 'servicenow_phase_failures_total'
+
+HELP = {
+    PHASE_DURATION: 'Duration of ServiceNow step phases',
+    PHASE_FAILURES: 'Failed ServiceNow step phases',
+    'servicenow_http_requests_total': 'HTTP requests sent, by method and status',
+    'servicenow_http_retries_total': 'HTTP requests retried, by method',
+    'servicenow_circuit_rejected_total': 'Requests rejected by an open circuit breaker, by host',
+    'servicenow_cr_cache_reads_total': 'CR reads through the local cache, by result',
+    'servicenow_http_bytes_saved_total': 'Bytes compression kept off the wire, by direction',
+}
+
+
+def _labels_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _render_labels(labels, extra=None):
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    return '{' + ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs) + '}'
+
+
+class Metrics:
+    """Registry of histograms and counters for one process
+    """
+
+    def __init__(self, trace_file=None, textfile=None, buckets=LATENCY_BUCKETS):
+        """Initialise instance variables
+        Args:
+            trace_file: str -> JSONL file trace events are appended to, None to disable
+            textfile: str -> Prometheus textfile written on flush, None to disable
+            buckets: tuple() -> Histogram bucket upper bounds
+        """
+        self.trace_file = trace_file
+        self.textfile = textfile
+        self.buckets = tuple(buckets)
+        self.histograms = dict()
+        self.counters = dict()
+        self._lock = threading.Lock()
+
+    def observe(self, name, value, **labels):
+        """Add a value to a histogram
+        """
+        key = (name, _labels_key(labels))
+        with self._lock:
+            histogram = self.histograms.setdefault(key, [[0] * (len(self.buckets) + 1), 0.0, 0])
+            index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+            histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def increment(self, name, value=1, **labels):
+        """Increase a counter
+        """
+        key = (name, _labels_key(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def trace(self, name, start, duration, ok, **labels):
+        """Append one trace event to the JSONL trace file
+        """
+        if not self.trace_file:
+            return
+        event = {'ts': round(start, 6), 'name': name, 'duration_ms': round(duration * 1000, 3),
+                 'ok': ok, 'pid': os.getpid(), 'thread': threading.current_thread().name, 'labels': labels}
+        line = json.dumps(event) + '\n'
+        with self._lock:
+            with open(self.trace_file, 'a') as trace_file:
+                trace_file.write(line)
+
+    @contextmanager
+    def span(self, name, **labels):
+        """Time the enclosed block as phase name
+        """
+        start = time.time()
+        started = time.monotonic()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            duration = time.monotonic() - started
+            self.observe(PHASE_DURATION, duration, phase=name, **labels)
+            if not ok:
+                self.increment(PHASE_FAILURES, phase=name, **labels)
+            self.trace(name, start, duration, ok, **labels)
+
+    def timed(self, name):
+        """Decorator running the wrapped function inside span(name)
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def _drain(self):
+        with self._lock:
+            histograms, self.histograms = self.histograms, dict()
+            counters, self.counters = self.counters, dict()
+        return histograms, counters
+
+    def flush(self):
+        """Merge this process's metrics into the shared state and rewrite the textfile
+        """
+        if not self.textfile:
+            return
+        histograms, counters = self._drain()
+        state_path = self.textfile + '.state.json'
+        with file_lock(self.textfile + '.lock'):
+            try:
+                with open(state_path) as state_file:
+                    state = json.load(state_file)
+            except (OSError, ValueError):
+                state = {'histograms': [], 'counters': []}
+            merged_histograms = {(name, tuple(map(tuple, labels))): [counts, total, count]
+                                 for name, labels, counts, total, count in state['histograms']}
+            merged_counters = {(name, tuple(map(tuple, labels))): value for name, labels, value in state['counters']}
+            for key, (counts, total, count) in histograms.items():
+                current = merged_histograms.setdefault(key, [[0] * len(counts), 0.0, 0])
+                current[0] = [a + b for a, b in zip(current[0], counts)]
+                current[1] += total
+                current[2] += count
+            for key, value in counters.items():
+                merged_counters[key] = merged_counters.get(key, 0) + value
+            state = {'histograms': [[name, labels, counts, total, count]
+                                    for (name, labels), (counts, total, count) in merged_histograms.items()],
+                     'counters': [[name, labels, value] for (name, labels), value in merged_counters.items()]}
+            self._write_atomic(state_path, json.dumps(state))
+            self._write_atomic(self.textfile, self.render(merged_histograms, merged_counters))
+
+    def render(self, histograms, counters):
+        """Render histograms and counters in the Prometheus text format
+        """
+        lines = []
+        for name in sorted(set(key[0] for key in histograms)):
+            lines.append('# HELP %s %s' % (name, HELP.get(name, name)))
+            lines.append('# TYPE %s histogram' % name)
+            for (metric, labels), (counts, total, count) in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += bucket_count
+                    lines.append('%s_bucket%s %d' % (name, _render_labels(labels, ('le', bound)), cumulative))
+                lines.append('%s_sum%s %f' % (name, _render_labels(labels), total))
+                lines.append('%s_count%s %d' % (name, _render_labels(labels), count))
+        for name in sorted(set(key[0] for key in counters)):
+            lines.append('# HELP %s %s' % (name, HELP.get(name, name)))
+            lines.append('# TYPE %s counter' % name)
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append('%s%s %s' % (name, _render_labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+    def _write_atomic(self, path, content):
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'w') as tmp_file:
+            tmp_file.write(content)
+        os.replace(tmp_path, path)
+
+
+_metrics = Metrics(trace_file=os.environ.get('METRICS_TRACE_FILE'), textfile=os.environ.get('METRICS_TEXTFILE'))
+atexit.register(_metrics.flush)
+
+
+def get_metrics():
+    """Return the process wide metrics registry
+    """
+    return _metrics
+
+
+def span(name, **labels):
+    return _metrics.span(name, **labels)
+
+
+def timed(name):
+    return _metrics.timed(name)
+
+
+def increment(name, value=1, **labels):
+    _metrics.increment(name, value, **labels)
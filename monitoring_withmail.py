@@ -1,13 +1,20 @@
-import datetime
-import urllib.parse
-import requests
+import collections
+import os
+import socket
+import sys
 import json
 import time
-import smtplib
+import urllib.parse
 
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from functools import reduce
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from alert_state import AlertState
+from cr_cache import READ_BYPASS, READ_STRICT
+from deadline import start_deadline
+from http_client import (DEFAULT_POOL_CONNECTIONS, DEFAULT_POOL_MAXSIZE, HttpRequestError, configure_client,
+                         get_client)
+from metrics import get_metrics, span, timed
+from servicenow_core import (BaseServiceNowApi, TokenAuth, first_record, lookup_params, request_token, send_request,
+                              split_cr_numbers, to_snake_case)
 
 
 """ServiceNow monitoring module
@@ -19,131 +26,109 @@ MAIL_ARGS['auth_tokens'] = 'NA'
 MAIL_ARGS['fetch_cr'] = 'NA'
 MAIL_ARGS['other_errors'] = 'NA'
 
-class CRCreationError(Exception):
-    """Raised when http status is other than 200"""
-
+# Daemon mode defaults: secs between ticks, probe threads, probe results kept per target
+DAEMON_INTERVAL = 60
+DAEMON_WORKERS = 8
+STATUS_HISTORY = 60
+# The probe only reads these CR fields
+PROBE_FIELDS = ('number', 'state')
+# Secs state changes are collected into one digest mail, 0 mails each change at once
+DIGEST_WINDOW = 0
+# notify() settings, read once at startup by run()
+NOTIFY_ARGS = {'digest_window': DIGEST_WINDOW}
+MAIL_SUBJECT = "Octopus-ServiceNow connectivity monitoring"
 
 class Authenticator:
     """ServiceNow API authentication helper
     """
 
-    def __init__(self, params):
+    def __init__(self, params, client=None):
         """Initialise instance variables
         Args:
             params: dict() -> ServiceNow Authentication parameters
+            client: HttpClient -> Pooled HTTP client, defaults to the shared one
         """
         self.params = params
-        self.headers = {"Content-Type": "application/x-www-form-urlencoded"}
+        self.client = client or get_client()
 
+    def request_token(self):
+        """Returns time bound token, raising KeyError or HttpRequestError on failure
+        """
+        return request_token(self.params, self.client)
+
+    @timed('get_token')
     def get_token(self):
         """Returns time bound token
         """
         print('BEGIN: Fetching authentication token')
-        payload = dict()
         token_data = ""
         try:
-            token_url = self.params['url'].split('/api/')[0] + "/oauth_token.do"
-            payload['grant_type'] = self.params['auth_grant_type']
-            payload['client_id'] = self.params['auth_client_id']
-            payload['client_secret'] = self.params['auth_client_secret']
-            payload['username'] = self.params['auth_username']
-            payload['password'] = self.params['auth_password']
-            payload_str='&'.join([k + "=" + urllib.parse.quote(v) for k,v in payload.items()])
-
-            token_data = request_with_retry('POST', token_url, headers=self.headers, data=payload_str)
+            token_data = self.request_token()
             MAIL_ARGS['connectivity'] = 'SUCCESS'
+            MAIL_ARGS['auth_tokens'] = 'SUCCESS'
         except KeyError as ke:
             MAIL_ARGS['other_errors'] = 'Config key - {} doesnt exist'.format(ke)
+        except HttpRequestError as he:
+            MAIL_ARGS['other_errors'] = str(he)
         except Exception as ex:
             template = "An exception of type {0} occurred. Arguments:\n{1!r}"
             message = template.format(type(ex).__name__, ex.args)
             MAIL_ARGS['other_errors'] = message
         finally:
             if MAIL_ARGS['other_errors'] and MAIL_ARGS['other_errors'] != 'NA':
-                mailer()
+                notify(ok=False)
                 failstep(MAIL_ARGS['other_errors'])
         print('END: Fetching authentication token')
         return token_data
 
 
-class ServiceNowApi:
+class ServiceNowApi(BaseServiceNowApi):
     """ServiceNow API helper class
     """
 
-    def __init__(self, params):
+    def __init__(self, params, client=None):
         """Initialize instance variables
+        Args:
+            params: dict() -> ServiceNow API parameters
+            client: HttpClient -> Pooled HTTP client, defaults to the shared one
         """
-        self.cr_get_url = params['url'] + "/number"
-        self.authenticator = Authenticator(params).get_token()
-        self.headers = {
-            'Authorization': ' '.join([self.authenticator['token_type'], self.authenticator['access_token']]),
-            'content-type': 'application/json'
-        }
+        client = client or get_client()
+        super().__init__(params, Authenticator(params, client).get_token(), request_with_retry, client)
 
-
-    def get_change_request(self, data):
-        """Method for running patch requests on Change Request
-        Args:
-            data: dict() -> Change request data dictionary
+    def get_change_request(self, data, fields=None, read=READ_STRICT):
+        """Fetch a Change Request, recording the fetch for the status mail
         """
-        print('BEGIN: Get change request')
-        cr_response = None
-        result = None
-        cr_response = request_with_retry('GET', self.cr_get_url + "/" + data['cr_number'], headers=self.headers)
-        
-        if cr_response and 'result' in cr_response:
-            result = cr_response['result']
+        result = super().get_change_request(data, fields=fields, read=read)
+        if result:
             MAIL_ARGS['fetch_cr'] = 'SUCCESS'
             printhighlight('Received response for CR: %s' % data['cr_number'])
-            
-        print('END: Get change request')
         return result
 
 
-def request_with_retry(method=None, url=None, headers={}, data=None):
-    """Run HTTP requests with upto 3 attempts and waits for 5 secs between each attempt
-
-    Args:
-        method: HTTP methods - POST, PATCH etc.
-        url: Request URL
-        headers: Request headers
-        data: Request payload
+def request_with_retry(method=None, url=None, headers={}, data=None, client=None, policy=None, params=None,
+                       conditional=False, stream=False, compress=False, auth=None):
+    """Run HTTP requests via send_request, mail the failure and fail the step once retries are exhausted
 
     Returns:
         response: for successful request
         (or) exit with error
     """
-    retry_count = 0
-    response = None
-    while True:
-        try:
-            retry_count = retry_count + 1
-            response = requests.request(method, url, headers=headers, data=data)
-            # Check for HTTP codes other than 200
-            if response.status_code >= 400: 
-                raise CRCreationError
-            MAIL_ARGS['auth_tokens'] = 'SUCCESS'
-        except (CRCreationError, Exception) as ex:
-            if retry_count < 3:
-                print('Retrying API - %s operation for URL - %s' % (method, url))
-                time.sleep(5)
-                continue
-            else:
-                printwarning('Maximum retries exceeded, exiting..')
-                if response:
-                    MAIL_ARGS['other_errors'] = 'Status: {}, Headers: {}, Error Response: {}'.format(response.status_code, response.headers, response.content)
-                else:
-                    template = "An exception of type {0} occurred. Arguments:\n{1!r}"
-                    message = template.format(type(ex).__name__, ex.args)
-                    MAIL_ARGS['other_errors'] = message
-        finally:
-            if MAIL_ARGS['other_errors'] and MAIL_ARGS['other_errors'] != 'NA':
-                mailer()
-                failstep(MAIL_ARGS['other_errors'])
-        break
-    return json.loads(response.content, encoding='utf-8')
-
-
+    try:
+        response = send_request(method, url, headers=headers, data=data, client=client, policy=policy,
+                                params=params, conditional=conditional, stream=stream, compress=compress,
+                                auth=auth)
+        MAIL_ARGS['auth_tokens'] = 'SUCCESS'
+    except HttpRequestError as ex:
+        printwarning('Retries exhausted, exiting..')
+        MAIL_ARGS['other_errors'] = str(ex)
+    finally:
+        if MAIL_ARGS['other_errors'] and MAIL_ARGS['other_errors'] != 'NA':
+            notify(ok=False)
+            failstep(MAIL_ARGS['other_errors'])
+    return response
+
+
+@timed('read_octopus_vars')
 def read_octopus_vars():
     """Read Octopus variables
     Format:
@@ -171,7 +156,7 @@ def read_octopus_vars():
             MAIL_ARGS['other_errors'] = message
         finally:
             if MAIL_ARGS['other_errors'] and MAIL_ARGS['other_errors'] != 'NA':
-                mailer()
+                notify(ok=False)
                 failstep(MAIL_ARGS['other_errors'])
 
     octopus_vars = {to_snake_case(var): return_if_var_exists(var) for var in required_vars}
@@ -179,40 +164,7 @@ def read_octopus_vars():
     return octopus_vars
 
 
-def to_snake_case(camel_str):
-    """Convert a given string to snake case
-
-    Args:
-        camel_str: str -> Eg: ServiceNow.Cr.Template
-    Returns:
-        snake_str: str -> Eg: cr_template
-    """
-    slist = []
-    if len(camel_str.split('.')[1:]) > 0:
-        slist = camel_str.split('.')[1:]
-    else:
-        slist = camel_str.split('.')[:]
-    slist_snake_case = [reduce(lambda x, y: x + ('_' if y.isupper() else '') + y, var_part).lower() 
-                        for var_part in slist]
-    return '_'.join(slist_snake_case)
-
-
-def mailer():
-    print('BEGIN: Sending email')
-    from_addr = get_octopusvariable('Mail.From')
-    to_addr = get_octopusvariable('Mail.To')
-    octopus_server = get_octopusvariable('env:COMPUTERNAME')
-
-    msg = MIMEMultipart()
-    msg['From'] = from_addr
-    msg['To'] = to_addr
-    msg['Subject'] = "Octopus-ServiceNow connectivity monitoring"
-    html_body = """
-    <html>
-        <head>
-        </head>
-        <body>
-            <p>Octopus-ServiceNow monitoring update</p>
+STATUS_TABLE = """
             <table border=2>
                 <tbody>
                     <tr>
@@ -237,32 +189,363 @@ def mailer():
                     </tr>
                 </tbody>
             </table>
+"""
+
+
+def render_status_html(server, statuses):
+    """Render the monitoring mail body
+
+    Args:
+        server: str -> Name of the probing server
+        statuses: list() -> (title, status) pairs, status holding the MAIL_ARGS keys;
+                            title is printed above the table unless None
+    """
+    tables = ''
+    for title, status in statuses:
+        if title:
+            tables += '<p>{}</p>'.format(title)
+        tables += STATUS_TABLE.format(server=server, connectivity=status['connectivity'],
+                                      auth_tokens=status['auth_tokens'], fetch_cr=status['fetch_cr'],
+                                      other_errors=status['other_errors'])
+    return """
+    <html>
+        <head>
+        </head>
+        <body>
+            <p>Octopus-ServiceNow monitoring update</p>
+            {tables}
         </body>
     </html>
-    """.format(server=octopus_server, connectivity=MAIL_ARGS['connectivity'], auth_tokens=MAIL_ARGS['auth_tokens'], 
-               fetch_cr=MAIL_ARGS['fetch_cr'], other_errors=MAIL_ARGS['other_errors'])
+    """.format(tables=tables)
+
+
+def render_alert_html(server, events):
+    """Render a mail body listing target state changes
+
+    Args:
+        server: str -> Name of the probing server
+        events: list() -> State changes as returned by AlertState.record
+    """
+    statuses = []
+    for event in events:
+        title = '{}: {} at {}'.format(event['target'], 'recovered' if event['ok'] else 'FAILING',
+                                      time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(event['ts'])))
+        if event['ok'] and event['since']:
+            title += ', after {:.0f} min down'.format((event['ts'] - event['since']) / 60)
+        statuses.append((title, event['phases']))
+    return render_status_html(server, statuses)
+
+
+def alert_subject(events):
+    """Mail subject summarising state changes
+    """
+    failing = len(set(event['target'] for event in events if not event['ok']))
+    recovered = len(set(event['target'] for event in events if event['ok']))
+    parts = (['{} failing'.format(failing)] if failing else []) + (['{} recovered'.format(recovered)] if recovered else [])
+    return '{}: {}'.format(MAIL_SUBJECT, ', '.join(parts))
+
 
+def render_status_mail(from_addr, to_addr, html_body, subject=MAIL_SUBJECT):
+    """Return a monitoring mail as a MIME message string
+    """
+    # Only failing runs send mail, keep the email stack off the healthy path
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+
+    msg = MIMEMultipart()
+    msg['From'] = from_addr
+    msg['To'] = to_addr
+    msg['Subject'] = subject
     msg_body = MIMEText(html_body, 'html')
     msg.attach(msg_body)
+    return msg.as_string()
+
+
+def send_status_mail(from_addr, to_addr, html_body, subject=MAIL_SUBJECT):
+    """Send a monitoring mail through the shared transport
+    """
+    from mail_transport import get_transport
 
     print('Sending mail..')
-    server = smtplib.SMTP('atom.paypalcorp.com', 25)
-    text = msg.as_string()
-    server.sendmail(from_addr, to_addr, text)
-    server.quit()
-    printhighlight('Mail sent successfully!!')
+    get_transport().send(from_addr, to_addr, render_status_mail(from_addr, to_addr, html_body, subject))
+
+
+def mailer(events):
+    print('BEGIN: Sending email')
+    from mail_queue import get_mail_queue
+
+    from_addr = get_octopusvariable('Mail.From')
+    to_addr = get_octopusvariable('Mail.To')
+    octopus_server = get_octopusvariable('env:COMPUTERNAME')
+
+    html_body = render_alert_html(octopus_server, events)
+    text = render_status_mail(from_addr, to_addr, html_body, subject=alert_subject(events))
+    # Sent in the background and flushed at exit, failstep never waits on the relay
+    get_mail_queue().submit(from_addr, to_addr, text)
+    printhighlight('Mail queued for sending')
+
+
+@timed('notify')
+def notify(ok):
+    """Record this run's status and mail the state changes that are due
+
+    Only a change of state of the step's ServiceNow instance is mailed, not
+    every failing run; Mail.DigestWindow (secs) batches changes into one mail.
+    """
+    # Called from finally blocks, nothing may escape and mask the step outcome
+    try:
+        alerts = AlertState(digest_window=NOTIFY_ARGS['digest_window'])
+        target = octopusvariables.get('ServiceNow.Url') or 'ServiceNow'
+        events = alerts.record([(target, ok, dict(MAIL_ARGS))])
+        if not events:
+            print('Monitoring status unchanged, no mail sent')
+            return
+        try:
+            # Relay failures end up in the mail spool, this only fails before the mail is queued
+            mailer(events)
+        except Exception:
+            # Mailed by the next run instead
+            alerts.requeue(events)
+            raise
+    except Exception as ex:
+        printwarning('Sending monitoring mail failed: %s' % ex)
+
+
+def read_digest_window():
+    """Return Mail.DigestWindow in secs, DIGEST_WINDOW when it is not set
+    """
+    value = octopusvariables.get('Mail.DigestWindow')
+    if not value:
+        return DIGEST_WINDOW
+    try:
+        digest_window = float(value)
+    except ValueError:
+        digest_window = None
+    # Also rejects nan
+    if digest_window is None or not digest_window >= 0:
+        failstep('Mail.DigestWindow must be a number of secs, 0 or more, not "%s"' % value)
+    return digest_window
+
+
+class TargetStatus:
+    """Rolling probe status of one monitoring target
+    """
+
+    def __init__(self, name, history=STATUS_HISTORY):
+        """Initialise instance variables
+        Args:
+            name: str -> Target name
+            history: int -> Number of probe results kept
+        """
+        self.name = name
+        self.results = collections.deque(maxlen=history)
+        self.phases = {'connectivity': 'NA', 'auth_tokens': 'NA', 'fetch_cr': 'NA', 'other_errors': 'NA'}
+        self.cr_state = None
+        self.consecutive_failures = 0
+        self.last_probe = None
+
+    @property
+    def ok(self):
+        return self.phases['other_errors'] == 'NA'
+
+    @property
+    def availability(self):
+        """Share of successful probes in the rolling window
+        """
+        if not self.results:
+            return None
+        return sum(1 for _, ok, _ in self.results if ok) / len(self.results)
+
+    def record(self, phases, cr_state, elapsed):
+        """Record the outcome of one probe
+        """
+        self.phases = phases
+        self.cr_state = cr_state
+        self.last_probe = time.time()
+        self.results.append((self.last_probe, self.ok, elapsed))
+        self.consecutive_failures = 0 if self.ok else self.consecutive_failures + 1
+
+
+def probe_target(target, client=None):
+    """Probe one target: token, then CR fetch, without failing the step
+
+    Args:
+        target: dict() -> url, auth_* and cr_number keys, as read_octopus_vars returns them
+        client: HttpClient -> Pooled HTTP client, defaults to the shared one
+    Returns:
+        phases: dict() -> Same keys as MAIL_ARGS
+        cr_state: str -> CR state, None when the fetch failed
+    """
+    client = client or get_client()
+    phases = {'connectivity': 'NA', 'auth_tokens': 'NA', 'fetch_cr': 'NA', 'other_errors': 'NA'}
+    cr_state = None
+    try:
+        auth = TokenAuth(target, client)
+        phases['connectivity'] = 'SUCCESS'
+        phases['auth_tokens'] = 'SUCCESS'
+        # A token revoked between ticks is renewed on the 401 instead of failing every probe until it expires
+        cr_response = send_request('GET', target['url'] + "/number/" + target['cr_number'],
+                                   params=lookup_params(PROBE_FIELDS), client=client, conditional=True, auth=auth)
+        cr_state = cr_response['result'][0]['state']
+        phases['fetch_cr'] = 'SUCCESS'
+    except KeyError as ke:
+        phases['other_errors'] = 'Config key - {} doesnt exist'.format(ke)
+    except HttpRequestError as he:
+        phases['other_errors'] = str(he)
+    except Exception as ex:
+        template = "An exception of type {0} occurred. Arguments:\n{1!r}"
+        phases['other_errors'] = template.format(type(ex).__name__, ex.args)
+    return phases, cr_state
+
+
+class MonitorDaemon:
+    """Probes many ServiceNow targets on an interval from one long running process
+
+    Connections and tokens are reused across ticks through the shared HTTP
+    client, sized to the targets, and the token cache.
+    """
+
+    def __init__(self, targets, interval=DAEMON_INTERVAL, workers=DAEMON_WORKERS,
+                 mail_from=None, mail_to=None, server=None, alerts=None):
+        """Initialise instance variables
+        Args:
+            targets: list() -> Target dicts, each with a 'name' plus probe_target keys
+            interval: float -> Secs between tick starts
+            workers: int -> Probes run concurrently
+            mail_from: str -> Alert sender, alerts are disabled when unset
+            mail_to: str -> Alert recipient
+            server: str -> Name shown as the probing server, defaults to the host name
+            alerts: AlertState -> Last known target status, defaults to the shared state file
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.targets = targets
+        self.interval = interval
+        self.mail_from = mail_from
+        self.mail_to = mail_to
+        self.server = server or socket.gethostname()
+        # One cached pool per target host, with fewer the adapter evicts pools and reconnects every tick
+        hosts = set(urllib.parse.urlsplit(target['url']).netloc for target in targets)
+        self.client = configure_client(pool_connections=max(len(hosts), DEFAULT_POOL_CONNECTIONS),
+                                       pool_maxsize=max(workers, DEFAULT_POOL_MAXSIZE))
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        # Alerts go out from their own thread, a slow relay never delays a tick
+        self.mail_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='alert-mail')
+        self.alerts = alerts or AlertState()
+        self.status = {target['name']: TargetStatus(target['name']) for target in targets}
+
+    def _probe(self, target):
+        start = time.monotonic()
+        with span('probe', target=target['name']):
+            phases, cr_state = probe_target(target, self.client)
+        self.status[target['name']].record(phases, cr_state, time.monotonic() - start)
+
+    def _send_alerts(self, events):
+        try:
+            send_status_mail(self.mail_from, self.mail_to, render_alert_html(self.server, events),
+                             subject=alert_subject(events))
+        except Exception as ex:
+            # Retried with the next state change or digest
+            self.alerts.requeue(events)
+            print('Sending monitoring mail failed: %s' % ex)
+
+    def tick(self):
+        """Probe all targets once and mail the targets that changed state
+        """
+        list(self.executor.map(self._probe, self.targets))
+        failing = [status for status in self.status.values() if not status.ok]
+        for status in self.status.values():
+            print('%s: %s, CR state: %s, availability: %.0f%%' % (
+                status.name, 'OK' if status.ok else 'FAIL', status.cr_state, 100 * status.availability))
+        events = self.alerts.record([(status.name, status.ok, status.phases) for status in self.status.values()])
+        for event in events:
+            print('%s changed to %s' % (event['target'], 'OK' if event['ok'] else 'FAIL'))
+        if events and self.mail_from and self.mail_to:
+            self.mail_executor.submit(self._send_alerts, events)
+        get_metrics().flush()
+        return failing
+
+    def close(self):
+        """Stop the probe workers and wait for alerts still being sent
+        """
+        self.executor.shutdown(wait=False)
+        self.mail_executor.shutdown(wait=True)
+
+    def run_forever(self):
+        """Tick every interval until interrupted
+        """
+        try:
+            while True:
+                start = time.monotonic()
+                self.tick()
+                time.sleep(max(0, self.interval - (time.monotonic() - start)))
+        except KeyboardInterrupt:
+            print('Stopping monitoring daemon')
+        finally:
+            self.close()
+
+
+def run_daemon(argv=None):
+    """Daemon mode entry point
+
+    Config file format:
+        {"interval": 60, "workers": 8,
+         "mail": {"from": "...", "to": "...", "digest_window": 0},
+         "targets": [{"name": "...", "url": "...", "auth_grant_type": "password",
+                      "auth_client_id": "...", "auth_client_secret": "...",
+                      "auth_username": "...", "auth_password": "...", "cr_number": "..."}]}
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(description='ServiceNow multi-target monitoring daemon')
+    parser.add_argument('config', help='JSON file listing the targets to probe')
+    parser.add_argument('--once', action='store_true', help='Probe every target once and exit')
+    args = parser.parse_args(argv)
+    with open(args.config) as config_file:
+        config = json.load(config_file)
+    mail = config.get('mail', dict())
+    daemon = MonitorDaemon(config['targets'],
+                           interval=config.get('interval', DAEMON_INTERVAL),
+                           workers=config.get('workers', DAEMON_WORKERS),
+                           mail_from=mail.get('from'), mail_to=mail.get('to'),
+                           alerts=AlertState(digest_window=mail.get('digest_window', DIGEST_WINDOW)))
+    if args.once:
+        failing = daemon.tick()
+        daemon.close()
+        sys.exit(1 if failing else 0)
+    daemon.run_forever()
 
 
 def run():
     """Script entry point runner method
     """
+    start_deadline(octopusvariables.get('ServiceNow.StepTimeout'))
+    NOTIFY_ARGS['digest_window'] = read_digest_window()
     octopus_vars = read_octopus_vars()
     context = octopus_vars 
     api = ServiceNowApi(context)
-    cr_details = api.get_change_request(context)[0]
-    printhighlight('CR %s state: %s' % (cr_details['number'], cr_details['state']))
+    cr_numbers = split_cr_numbers(context['cr_number'])
+    if len(cr_numbers) > 1:
+        # One CR per site of a multi-site release, probed concurrently and revalidated, never from the cache
+        results = api.get_change_requests(cr_numbers, fields=PROBE_FIELDS)
+        failed = [result for result in results if result['error']]
+        if failed:
+            MAIL_ARGS['other_errors'] = '; '.join('CR {}: {}'.format(result['cr_number'], result['error'])
+                                                  for result in failed)
+            notify(ok=False)
+            failstep(MAIL_ARGS['other_errors'])
+        MAIL_ARGS['fetch_cr'] = 'SUCCESS'
+        cr_details = [first_record(result) for result in results]
+    else:
+        # A probe checks the instance, never answer it from the cache
+        cr_details = api.get_change_request(context, fields=PROBE_FIELDS, read=READ_BYPASS)
+    for cr in cr_details:
+        printhighlight('CR %s state: %s' % (cr['number'], cr['state']))
+    notify(ok=True)
     
     
 
 if __name__ == "<run_path>":
     run()
+elif __name__ == "__main__":
+    run_daemon()
@@ -0,0 +1,165 @@
+import collections
+import random
+import threading
+import time
+
+
+"""Retry policies for ServiceNow API calls
+"""
+
+# Status codes worth another attempt, everything else >= 400 is fatal
+RETRYABLE_STATUS = frozenset([408, 425, 429, 500, 502, 503, 504])
+# Status codes whose Retry-After header is honoured
+RETRY_AFTER_STATUS = frozenset([429, 503])
+
+
+class RetryBudget:
+    """Per-process cap on retries
+
+    Allows min_retries plus ratio * requests retries within a rolling window,
+    so a flaky ServiceNow node degrades to fail-fast instead of every caller
+    retrying in lock-step.
+    """
+
+    def __init__(self, ratio=0.2, min_retries=10, window=60.0):
+        """Initialise instance variables
+        Args:
+            ratio: float -> Retries allowed per request sent in the window
+            min_retries: int -> Retries always allowed in the window
+            window: float -> Rolling window in seconds
+        """
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.window = window
+        self._requests = collections.deque()
+        self._retries = collections.deque()
+        self._lock = threading.Lock()
+
+    def _expire(self, now):
+        for events in (self._requests, self._retries):
+            while events and now - events[0] > self.window:
+                events.popleft()
+
+    def record_request(self):
+        """Record a first attempt
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._expire(now)
+            self._requests.append(now)
+
+    def try_spend(self):
+        """Take one retry from the budget
+        Returns:
+            allowed: bool -> False once the budget is spent
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._expire(now)
+            if len(self._retries) >= self.min_retries + self.ratio * len(self._requests):
+                return False
+            self._retries.append(now)
+            return True
+
+
+class RetryPolicy:
+    """Exponential backoff with full jitter
+
+    Subclass and override is_retryable / next_delay to plug in a different
+    strategy.
+    """
+
+    def __init__(self, max_attempts=3, base_delay=2.0, max_delay=30.0, max_retry_after=120.0,
+                 retryable_status=RETRYABLE_STATUS, budget=None):
+        """Initialise instance variables
+        Args:
+            max_attempts: int -> Attempts including the first one
+            base_delay: float -> Backoff ceiling for the first retry in seconds
+            max_delay: float -> Upper bound of the backoff ceiling in seconds
+            max_retry_after: float -> Upper bound for a server supplied Retry-After
+            retryable_status: set() -> HTTP status codes that may be retried
+            budget: RetryBudget -> Shared retry budget, None for unlimited
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+        self.retryable_status = retryable_status
+        self.budget = budget
+
+    def is_retryable(self, response=None, exception=None):
+        """Whether a failed attempt is worth repeating
+        Args:
+            response: requests.Response -> Response with status >= 400, if any
+            exception: Exception -> Transport error, if any
+        """
+        if response is not None:
+            return response.status_code in self.retryable_status
+        return exception is not None
+
+    def retry_after(self, response):
+        """Seconds requested by the server via Retry-After, or None
+        """
+        if response is None or response.status_code not in RETRY_AFTER_STATUS:
+            return None
+        value = response.headers.get('Retry-After')
+        if not value:
+            return None
+        try:
+            delay = float(value)
+        except ValueError:
+            # HTTP-date form, rare enough not to load the email package up front
+            import email.utils
+
+            retry_at = email.utils.parsedate_to_datetime(value)
+            if retry_at is None:
+                return None
+            delay = retry_at.timestamp() - time.time()
+        return min(max(delay, 0.0), self.max_retry_after)
+
+    def next_delay(self, attempt, response=None):
+        """Seconds to sleep before the next attempt
+        Args:
+            attempt: int -> Number of the attempt that just failed, starting at 1
+            response: requests.Response -> Failed response, if any
+        """
+        delay = self.retry_after(response)
+        if delay is not None:
+            return delay
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def should_retry(self, attempt, response=None, exception=None):
+        """Whether another attempt should be made
+        Returns:
+            retry: bool
+            reason: str -> Why not, when retry is False
+        """
+        if not self.is_retryable(response, exception):
+            return False, 'non-retryable error'
+        if attempt >= self.max_attempts:
+            return False, 'maximum retries exceeded'
+        if self.budget is not None and not self.budget.try_spend():
+            return False, 'retry budget exhausted'
+        return True, None
+
+
+_policy = None
+_policy_lock = threading.Lock()
+
+
+def get_retry_policy():
+    """Return the process wide retry policy, creating it on first use
+    """
+    global _policy
+    with _policy_lock:
+        if _policy is None:
+            _policy = RetryPolicy(budget=RetryBudget())
+        return _policy
+
+
+def set_retry_policy(policy):
+    """Replace the process wide retry policy
+    """
+    global _policy
+    with _policy_lock:
+        _policy = policy
@@ -0,0 +1,397 @@
+import threading
+import urllib.parse
+
+from cr_cache import READ_STRICT, get_cr_cache
+from functools import reduce
+from http_client import VERSION_FIELDS, HttpRequestError, get_client, send_conditional, send_streaming, send_with_retry
+from metrics import span, timed
+from token_cache import get_token_cache, refresh_grant
+
+
+"""Shared core of the ServiceNow step scripts
+
+Helpers and the CR read API every step needs, kept free of Octopus
+harness globals and of anything heavy to import. Failing the step is
+left to the scripts: the API gets their request_with_retry. Mail,
+argument parsing and thread pools are imported by the scripts only on
+the paths that use them.
+"""
+
+TOKEN_PATH = '/oauth_token.do'
+TOKEN_HEADERS = {"Content-Type": "application/x-www-form-urlencoded"}
+# Concurrent lookups for get_change_requests, kept within the per-host pool size
+BULK_LOOKUP_WORKERS = 8
+# Records per page of a paged query
+QUERY_PAGE_SIZE = 500
+# Offset paging needs a total order, sys_id breaks sys_created_on ties
+QUERY_ORDER = 'ORDERBYsys_created_on^ORDERBYsys_id'
+
+
+def to_snake_case(camel_str):
+    """Convert a given string to snake case
+
+    Args:
+        camel_str: str -> Eg: ServiceNow.Cr.Template
+    Returns:
+        snake_str: str -> Eg: cr_template
+    """
+    slist = []
+    if len(camel_str.split('.')[1:]) > 0:
+        slist = camel_str.split('.')[1:]
+    else:
+        slist = camel_str.split('.')[:]
+    slist_snake_case = [reduce(lambda x, y: x + ('_' if y.isupper() else '') + y, var_part).lower()
+                        for var_part in slist]
+    return '_'.join(slist_snake_case)
+
+
+def token_url(api_url):
+    """Return the OAuth token endpoint of the instance serving api_url
+    """
+    return api_url.split('/api/')[0] + TOKEN_PATH
+
+
+def request_token(params, client, send=send_with_retry):
+    """Return a time bound token, from the token cache shared with other steps when still valid
+
+    Args:
+        params: dict() -> ServiceNow Authentication parameters
+        client: HttpClient -> Pooled HTTP client
+        send: callable -> send_with_retry compatible function posting the password grant
+    Returns:
+        token_data: dict() -> Token response
+    Raises:
+        KeyError: for a missing authentication parameter
+    """
+    url = token_url(params['url'])
+    payload = dict()
+    payload['grant_type'] = params['auth_grant_type']
+    payload['client_id'] = params['auth_client_id']
+    payload['client_secret'] = params['auth_client_secret']
+    payload['username'] = params['auth_username']
+    payload['password'] = params['auth_password']
+    payload_str = '&'.join([k + "=" + urllib.parse.quote(v) for k, v in payload.items()])
+
+    return get_token_cache().get_token(
+        url, payload['client_id'],
+        fetch=lambda: send('POST', url, headers=TOKEN_HEADERS, data=payload_str, client=client),
+        refresh=lambda refresh_token: refresh_grant(client, url, payload['client_id'],
+                                                    payload['client_secret'], refresh_token),
+        username=payload['username'])
+
+
+def auth_headers(token_data):
+    """Return JSON request headers authorised with token_data
+    """
+    return {
+        'Authorization': ' '.join([token_data['token_type'], token_data['access_token']]),
+        'content-type': 'application/json'
+    }
+
+
+class TokenAuth:
+    """Token authorising a step's ServiceNow calls, renewed once the instance rejects it
+    """
+
+    def __init__(self, params, client=None, token_data=None, send=send_with_retry):
+        """Initialise instance variables
+        Args:
+            params: dict() -> ServiceNow Authentication parameters
+            client: HttpClient -> Pooled HTTP client, defaults to the shared one
+            token_data: dict() -> Token response already obtained, requested when None
+            send: callable -> send_with_retry compatible function posting the password grant
+        """
+        self.params = params
+        self.client = client or get_client()
+        self.send = send
+        self.token_data = token_data or request_token(params, self.client, send)
+        self._lock = threading.Lock()
+
+    def renew(self, rejected):
+        """Replace a token the instance answered 401 to with one from a new grant
+
+        The cached token is dropped only while it is still the rejected one,
+        and concurrent calls rejected with the same token share one grant.
+
+        Args:
+            rejected: dict() -> Token response the rejected call was sent with
+        Returns:
+            token_data: dict() -> Token response to resend with
+        """
+        with self._lock:
+            if self.token_data is rejected:
+                get_token_cache().invalidate(token_url(self.params['url']), self.params['auth_client_id'],
+                                             username=self.params['auth_username'],
+                                             access_token=rejected['access_token'])
+                self.token_data = request_token(self.params, self.client, self.send)
+            return self.token_data
+
+
+def lookup_params(fields=None):
+    """Query parameters projecting a CR lookup to fields
+    Args:
+        fields: list() -> Record fields the caller needs, None for the full record
+    Returns:
+        params: dict() -> sysparm_* parameters, None for the full record
+    """
+    if not fields:
+        return None
+    # Version fields let the next poll revalidate the cached record
+    fields = list(fields) + [field for field in VERSION_FIELDS if field not in fields]
+    return {'sysparm_fields': ','.join(fields), 'sysparm_exclude_reference_link': 'true'}
+
+
+def split_cr_numbers(value):
+    """Return the CR numbers of a ServiceNow.Cr.Number value
+
+    A multi-site release publishes one CR per site, comma separated in
+    WebSiteName order.
+    """
+    return [number.strip() for number in value.split(',') if number.strip()]
+
+
+def first_record(cr_response):
+    """Return the record of a /number/{cr} lookup response, or None
+    """
+    result = cr_response.get('result') if cr_response else None
+    if isinstance(result, list):
+        return result[0] if result else None
+    return result
+
+
+def page_params(query, offset, limit, fields=None):
+    """Query parameters for one page of an offset paged query
+    Args:
+        query: str -> sysparm_query, ordered by QUERY_ORDER unless it has its own ORDERBY
+        offset: int -> Records to skip
+        limit: int -> Records per page
+        fields: list() -> Record fields the caller needs, None for the full record
+    Returns:
+        params: dict() -> sysparm_* parameters
+    """
+    if 'ORDERBY' not in query:
+        query = '^'.join(term for term in (query, QUERY_ORDER) if term)
+    params = dict(lookup_params(fields) or dict())
+    params.update({'sysparm_query': query, 'sysparm_limit': limit, 'sysparm_offset': offset})
+    return params
+
+
+def iter_pages(fetch_page, page_size=QUERY_PAGE_SIZE):
+    """Yield the records of an offset paged query, page after page
+
+    The next page is fetched on a background worker while the caller
+    processes the current one; a page shorter than page_size is the last.
+
+    Args:
+        fetch_page: callable -> fetch_page(offset, limit) returning the records of one page
+        page_size: int -> Records per page
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='page-prefetch')
+    try:
+        offset = 0
+        future = executor.submit(fetch_page, offset, page_size)
+        while future is not None:
+            page = future.result()
+            offset += len(page)
+            future = executor.submit(fetch_page, offset, page_size) if len(page) >= page_size else None
+            yield from page
+    finally:
+        # The caller may stop early, don't wait for a page nobody reads
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def send_request(method=None, url=None, headers={}, data=None, client=None, policy=None, params=None,
+                 conditional=False, stream=False, compress=False, auth=None):
+    """Run HTTP requests with retries per the retry policy, the way the step scripts send them
+
+    A 401 is not retried by the policy; with auth the token is renewed
+    and the request sent once more, a revoked or rotated token then only
+    costs one grant instead of failing every step until it expires.
+
+    Args:
+        method: HTTP methods - POST, PATCH etc.
+        url: Request URL
+        headers: Request headers
+        data: Request payload
+        client: HttpClient -> Pooled HTTP client, defaults to the shared one
+        policy: RetryPolicy -> Retry policy, defaults to the shared one
+        params: dict() -> Query string parameters
+        conditional: bool -> Revalidate the previous response of a GET instead of downloading it again
+        stream: bool -> Return a generator decoding the 'result' records as they arrive
+        compress: bool -> Gzip a large payload, see send_with_retry_raw
+        auth: TokenAuth -> Authorises the request, overriding an Authorization header
+
+    Returns:
+        response: for successful request
+        (or) raises HttpRequestError
+    """
+    for renewed in (False, True):
+        token_data = auth.token_data if auth is not None else None
+        request_headers = dict(headers, **auth_headers(token_data)) if auth is not None else headers
+        try:
+            if conditional and method == 'GET':
+                return send_conditional(url, headers=request_headers, params=params, client=client, policy=policy)
+            if stream:
+                return send_streaming(method, url, headers=request_headers, data=data, client=client, policy=policy,
+                                      params=params)
+            return send_with_retry(method, url, headers=request_headers, data=data, client=client, policy=policy,
+                                   params=params, compress=compress)
+        except HttpRequestError as ex:
+            if auth is None or renewed or ex.status_code != 401:
+                raise
+            print('%s %s was rejected with status 401, renewing the token' % (method, url))
+            auth.renew(token_data)
+
+
+class BaseServiceNowApi:
+    """CR reads shared by the step scripts' ServiceNow API helper classes
+    """
+
+    def __init__(self, params, token_data, request, client=None):
+        """Initialize instance variables
+        Args:
+            params: dict() -> ServiceNow API parameters
+            token_data: dict() -> Token response authorising the calls
+            request: callable -> The script's request_with_retry, send_request failing the step on error;
+                                 it also runs the grant when the instance rejects the token
+            client: HttpClient -> Pooled HTTP client, defaults to the shared one
+        """
+        self.client = client or get_client()
+        self.request = request
+        self.cr_query_url = params['url']
+        self.cr_get_url = params['url'] + "/number"
+        self.auth = TokenAuth(params, self.client, token_data, send=request)
+
+    @property
+    def headers(self):
+        """JSON request headers authorised with the current token
+        """
+        return auth_headers(self.auth.token_data)
+
+    @timed('get_change_request')
+    def get_change_request(self, data, fields=None, read=READ_STRICT):
+        """Method for fetching a Change Request, from the CR cache while fresh enough
+        Args:
+            data: dict() -> Change request data dictionary
+            fields: list() -> Only fetch these fields, revalidating the previous
+                              response instead of downloading it again
+            read: str -> CR cache mode, READ_STRICT, READ_STALE or READ_BYPASS
+        Returns:
+            result: list() -> The CR record, None when there is none
+        """
+        print('BEGIN: Get change request')
+        url = self.cr_get_url + "/" + data['cr_number']
+        params = lookup_params(fields)
+
+        def fetch():
+            return first_record(self.request('GET', url, headers=self.headers, client=self.client,
+                                             params=params, conditional=bool(fields), auth=self.auth))
+
+        def refresh():
+            # Runs in the background, errors are raised instead of failing the step
+            return first_record(send_request('GET', url, headers=self.headers, client=self.client, params=params,
+                                             auth=self.auth))
+
+        record = get_cr_cache().read(self.cr_query_url, data['cr_number'], fetch, fields=fields, mode=read,
+                                     refresh=refresh)
+        print('END: Get change request')
+        return [record] if record is not None else None
+
+    @timed('query_change_requests')
+    def query_change_requests(self, query, fields=None):
+        """Method for streaming the Change Requests matching an encoded query
+        Args:
+            query: str -> sysparm_query, e.g. 'state=scheduled^cmdb_ci=...'
+            fields: list() -> Only fetch these fields
+        Returns:
+            records: generator -> CR records, decoded one by one as the response arrives
+        """
+        params = dict(lookup_params(fields) or dict(), sysparm_query=query)
+        return self.request('GET', self.cr_query_url, headers=self.headers, client=self.client,
+                            params=params, stream=True, auth=self.auth)
+
+    def iter_change_requests(self, query, fields=None, page_size=QUERY_PAGE_SIZE):
+        """Method for walking all Change Requests matching an encoded query, page by page
+        Args:
+            query: str -> sysparm_query, e.g. 'state=scheduled^cmdb_ci=...'
+            fields: list() -> Only fetch these fields
+            page_size: int -> sysparm_limit per request
+        Returns:
+            records: generator -> CR records, the next page is fetched while the caller works on the current one
+        """
+        def fetch_page(offset, limit):
+            with span('query_change_requests_page'):
+                cr_response = self.request('GET', self.cr_query_url, headers=self.headers, client=self.client,
+                                           params=page_params(query, offset, limit, fields), auth=self.auth)
+            return cr_response['result'] if cr_response and 'result' in cr_response else []
+
+        return iter_pages(fetch_page, page_size)
+
+    @timed('get_change_requests')
+    def get_change_requests(self, numbers, max_workers=BULK_LOOKUP_WORKERS, fields=None):
+        """Method for fetching many Change Requests concurrently
+        Args:
+            numbers: list() -> CR numbers
+            max_workers: int -> Maximum lookups in flight
+            fields: list() -> Only fetch these fields, revalidating previous responses
+        Returns:
+            results: list() -> One dict per CR number, in input order, with
+                               'cr_number', 'result' and 'error' (None on success)
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        print('BEGIN: Get change requests')
+        params = lookup_params(fields)
+
+        def lookup(cr_number):
+            try:
+                cr_response = send_request('GET', self.cr_get_url + "/" + cr_number, headers=self.headers,
+                                           client=self.client, params=params, conditional=bool(fields),
+                                           auth=self.auth)
+                result = cr_response['result'] if cr_response and 'result' in cr_response else None
+                return {'cr_number': cr_number, 'result': result, 'error': None}
+            except Exception as ex:
+                return {'cr_number': cr_number, 'result': None, 'error': str(ex)}
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(lookup, numbers))
+        failed = [r['cr_number'] for r in results if r['error']]
+        if failed:
+            print('Failed to fetch %d of %d CRs: %s' % (len(failed), len(results), ', '.join(failed)))
+        print('END: Get change requests')
+        return results
+
+
+def run_phases(phases):
+    """Run dependent phases concurrently, each as soon as the phases it needs have finished
+
+    The critical path becomes the slowest chain of phases instead of the
+    sum of all of them. Once every phase has ended, the error of the first
+    listed phase that failed is raised; phases needing a failed one fail
+    with its error.
+
+    Args:
+        phases: dict() -> Phase name to (callable, list() of phase names it needs), each listed
+                          after the phases it needs; the callable gets their results as keyword arguments
+    Returns:
+        results: dict() -> Phase name to the result of its callable
+    Raises:
+        ValueError: for a phase needing one not listed before it
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    futures = dict()
+
+    def run_phase(func, needs):
+        return func(**{name: futures[name].result() for name in needs})
+
+    with ThreadPoolExecutor(max_workers=len(phases), thread_name_prefix='phase') as executor:
+        for name, (func, needs) in phases.items():
+            unknown = [need for need in needs if need not in futures]
+            if unknown:
+                raise ValueError('Phase %s needs %s, not listed before it' % (name, ', '.join(unknown)))
+            # One worker per phase, a phase blocked on its dependencies never starves them
+            futures[name] = executor.submit(run_phase, func, needs)
+    return {name: future.result() for name, future in futures.items()}
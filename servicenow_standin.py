@@ -0,0 +1,365 @@
+import argparse
+import base64
+import gzip
+import hashlib
+import itertools
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+"""Local ServiceNow stand-in server
+
+Emulates the endpoints the step scripts use, for load tests and local runs:
+    POST  /oauth_token.do                 -> token response
+    POST  /api/<path>                     -> create CR
+    GET   /api/<path>?sysparm_query=...   -> query CRs, field=value terms joined by ^,
+                                             paged by sysparm_limit / sysparm_offset
+    GET   /api/<path>/number/<cr_number>  -> fetch CR
+    PATCH /api/<path>/number/<cr_number>  -> update CR
+    POST  /api/now/v1/batch               -> Now Batch API over the above
+with configurable latency, 5xx error rate and 429 throttling. Only tokens
+it issued are accepted, until revoke_tokens. Gzipped
+request bodies are accepted and larger responses gzipped when the client
+accepts it, unless gzip is disabled; gzipped bodies then get a 415.
+
+Usage:
+    python servicenow_standin.py --port 8080 --latency 50 --error-rate 0.05
+"""
+
+BATCH_PATH = '/api/now/v1/batch'
+# Responses from this many bytes on are gzipped for clients accepting it
+GZIP_MIN_SIZE = 1024
+
+
+class StandinConfig:
+    """Behaviour knobs of the stand-in, adjustable while it runs
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, throttle_rate=0.0, retry_after=1,
+                 ready_delay=0.0, token_ttl=1800, batch_enabled=True, etag_enabled=True, gzip_enabled=True):
+        """Initialise instance variables
+        Args:
+            latency: float -> Base response latency in secs
+            jitter: float -> Random extra latency up to this many secs
+            error_rate: float -> Share of requests answered with 503
+            throttle_rate: float -> Share of requests answered with 429
+            retry_after: int -> Retry-After secs sent with 429/503
+            ready_delay: float -> Secs before a new CR reports scheduled
+            token_ttl: int -> expires_in of issued tokens
+            batch_enabled: bool -> Serve the batch endpoint, answer 400 like an instance without it otherwise
+            etag_enabled: bool -> Send ETags on CR reads and answer If-None-Match with 304
+            gzip_enabled: bool -> Take gzipped request bodies and gzip responses, answer gzipped bodies with 415 otherwise
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.ready_delay = ready_delay
+        self.token_ttl = token_ttl
+        self.batch_enabled = batch_enabled
+        self.etag_enabled = etag_enabled
+        self.gzip_enabled = gzip_enabled
+
+
+class StandinState:
+    """In-memory CR store and request counters
+    """
+
+    def __init__(self):
+        self.change_requests = dict()
+        self.requests = dict()
+        self.tokens = set()
+        self._sequence = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def count(self, key):
+        with self._lock:
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+    def issue_token(self):
+        with self._lock:
+            access_token = 'standin-%x' % random.getrandbits(64)
+            self.tokens.add(access_token)
+            return access_token
+
+    def is_authorised(self, authorization):
+        with self._lock:
+            return authorization.startswith('Bearer ') and authorization[len('Bearer '):] in self.tokens
+
+    def revoke_tokens(self):
+        """Reject every token issued so far, like a rotated OAuth client secret
+        """
+        with self._lock:
+            self.tokens.clear()
+
+    def create(self, data, ready_delay):
+        with self._lock:
+            cr_number = 'CHG%07d' % next(self._sequence)
+            record = dict(data)
+            record['number'] = cr_number
+            record['requested_state'] = data.get('state', 'scheduled')
+            record['state'] = 'new'
+            record['ready_at'] = time.time() + ready_delay
+            record['sys_updated_on'] = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+            record['sys_mod_count'] = 0
+            self.change_requests[cr_number] = record
+            return cr_number
+
+    def get(self, cr_number):
+        with self._lock:
+            record = self.change_requests.get(cr_number)
+            if record is None:
+                return None
+            if record['state'] == 'new' and time.time() >= record['ready_at']:
+                record['state'] = record['requested_state']
+            return {k: v for k, v in record.items() if k not in ('ready_at', 'requested_state')}
+
+    def query(self, terms):
+        """Return the CRs matching every (field, value) term, in creation order
+        """
+        with self._lock:
+            numbers = list(self.change_requests)
+        records = (self.get(cr_number) for cr_number in numbers)
+        return [record for record in records
+                if record is not None and all(str(record.get(field)) == value for field, value in terms)]
+
+    def update(self, cr_number, data):
+        with self._lock:
+            record = self.change_requests.get(cr_number)
+            if record is None:
+                return False
+            record.update(data)
+            record['sys_updated_on'] = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+            record['sys_mod_count'] += 1
+            return True
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    """Request handler, config and state live on the server
+    """
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes, don't let Nagle delay the body
+    disable_nagle_algorithm = True
+    number_path = re.compile(r'^(/api/.+)/number/([^/?]+)')
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _reply(self, status, body=None, headers=None):
+        payload = json.dumps(body).encode('utf-8') if body is not None else b''
+        headers = dict(headers or dict())
+        if self.server.config.gzip_enabled and len(payload) >= GZIP_MIN_SIZE and \
+                'gzip' in self.headers.get('Accept-Encoding', ''):
+            payload = gzip.compress(payload)
+            headers['Content-Encoding'] = 'gzip'
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _inject_faults(self):
+        """Sleep for the configured latency and maybe answer with 429/503
+
+        Returns:
+            handled: bool -> True when a fault response was sent
+        """
+        config = self.server.config
+        delay = config.latency + random.uniform(0, config.jitter)
+        if delay:
+            time.sleep(delay)
+        roll = random.random()
+        if roll < config.throttle_rate:
+            self.server.state.count('429')
+            self._reply(429, {'error': {'message': 'Too many requests'}},
+                        {'Retry-After': str(config.retry_after)})
+            return True
+        if roll < config.throttle_rate + config.error_rate:
+            self.server.state.count('503')
+            self._reply(503, {'error': {'message': 'Service unavailable'}},
+                        {'Retry-After': str(config.retry_after)})
+            return True
+        return False
+
+    def _dispatch(self, method, path, body):
+        """Handle one API call
+
+        Returns:
+            status: int -> HTTP status
+            payload: dict() -> JSON response body
+            headers: dict() -> Extra response headers, optional
+        """
+        if method == 'POST' and path.startswith('/oauth_token.do'):
+            self.server.state.count('token')
+            return 200, {'access_token': self.server.state.issue_token(),
+                         'refresh_token': 'standin-refresh-%x' % random.getrandbits(64),
+                         'scope': 'useraccount', 'token_type': 'Bearer',
+                         'expires_in': self.server.config.token_ttl}
+        if not path.startswith('/api/'):
+            return 404, {'error': {'message': 'No such endpoint'}}
+        if not self.server.state.is_authorised(self.headers.get('Authorization', '')):
+            self.server.state.count('401')
+            return 401, {'error': {'message': 'User Not Authenticated'}}
+        if method == 'POST' and path.startswith(BATCH_PATH):
+            return self._batch(json.loads(body or b'{}'))
+        match = self.number_path.match(path)
+        if method == 'POST' and not match:
+            self.server.state.count('create')
+            cr_number = self.server.state.create(json.loads(body or b'{}'), self.server.config.ready_delay)
+            return 201, {'result': {'status': 'success', 'record_id': cr_number}}
+        if method == 'GET' and not match:
+            self.server.state.count('query')
+            query = urllib.parse.parse_qs(urllib.parse.urlsplit(path).query)
+            terms = [term.split('=', 1) for term in query.get('sysparm_query', [''])[0].split('^')
+                     if '=' in term and not term.startswith('ORDERBY')]
+            records = self.server.state.query(terms)
+            offset = int(query.get('sysparm_offset', ['0'])[0])
+            if 'sysparm_limit' in query:
+                records = records[offset:offset + int(query['sysparm_limit'][0])]
+            else:
+                records = records[offset:]
+            if 'sysparm_fields' in query:
+                fields = query['sysparm_fields'][0].split(',')
+                records = [{k: v for k, v in record.items() if k in fields} for record in records]
+            return 200, {'result': records}
+        if method == 'GET' and match:
+            self.server.state.count('fetch')
+            record = self.server.state.get(match.group(2))
+            if record is None:
+                return 404, {'error': {'message': 'No Record found'}}
+            query = urllib.parse.parse_qs(urllib.parse.urlsplit(path).query)
+            if 'sysparm_fields' in query:
+                fields = query['sysparm_fields'][0].split(',')
+                record = {k: v for k, v in record.items() if k in fields}
+            if not self.server.config.etag_enabled:
+                return 200, {'result': [record]}
+            etag = '"%s"' % hashlib.sha1(json.dumps(record, sort_keys=True).encode('utf-8')).hexdigest()
+            if self.headers.get('If-None-Match') == etag:
+                self.server.state.count('not_modified')
+                return 304, None, {'ETag': etag}
+            return 200, {'result': [record]}, {'ETag': etag}
+        if method == 'PATCH' and match:
+            self.server.state.count('update')
+            if self.server.state.update(match.group(2), json.loads(body or b'{}')):
+                return 200, {'result': {'status': 'success'}}
+            return 404, {'error': {'message': 'No Record found'}}
+        return 404, {'error': {'message': 'No such endpoint'}}
+
+    def _batch(self, batch):
+        """Serve a Now Batch API request, bodies are base64 encoded both ways
+        """
+        self.server.state.count('batch')
+        serviced = []
+        for item in batch.get('rest_requests', []):
+            body = base64.b64decode(item.get('body') or '')
+            status, payload = self._dispatch(item['method'].upper(), item['url'], body)[:2]
+            serviced.append({'id': item['id'], 'status_code': status,
+                             'status_text': HTTPStatus(status).phrase,
+                             'headers': [{'name': 'Content-Type', 'value': 'application/json'}],
+                             'body': base64.b64encode(json.dumps(payload).encode('utf-8')).decode('ascii'),
+                             'execution_time': 0})
+        return 200, {'batch_request_id': batch.get('batch_request_id'),
+                     'serviced_requests': serviced, 'unserviced_requests': []}
+
+    def _handle(self, method):
+        body = self._read_body()
+        if self._inject_faults():
+            return
+        if self.headers.get('Content-Encoding', '').lower() == 'gzip':
+            if not self.server.config.gzip_enabled:
+                self.server.state.count('415')
+                self._reply(415, {'error': {'message': 'Unsupported Content-Encoding: gzip'}})
+                return
+            self.server.state.count('gzip_body')
+            body = gzip.decompress(body)
+        if method == 'POST' and self.path.startswith(BATCH_PATH) and not self.server.config.batch_enabled:
+            self._reply(400, {'error': {'message': 'Requested URI does not represent any resource'}})
+            return
+        self._reply(*self._dispatch(method, self.path, body))
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_PATCH(self):
+        self._handle('PATCH')
+
+
+class StandinServer(ThreadingHTTPServer):
+    """Threaded stand-in server
+    """
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), config=None, verbose=False):
+        ThreadingHTTPServer.__init__(self, address, StandinHandler)
+        self.config = config or StandinConfig()
+        self.state = StandinState()
+        self.verbose = verbose
+
+    @property
+    def base_url(self):
+        return 'http://%s:%d' % self.server_address[:2]
+
+    @property
+    def api_url(self):
+        """URL to use as ServiceNow.Url
+        """
+        return self.base_url + '/api/now/change_request'
+
+    def start(self):
+        """Serve on a background thread
+        """
+        thread = threading.Thread(target=self.serve_forever, name='servicenow-standin', daemon=True)
+        thread.start()
+        return self
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Local ServiceNow stand-in server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0, help='Base latency in ms')
+    parser.add_argument('--jitter', type=float, default=0, help='Random extra latency in ms')
+    parser.add_argument('--error-rate', type=float, default=0, help='Share of requests failing with 503')
+    parser.add_argument('--throttle-rate', type=float, default=0, help='Share of requests failing with 429')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After secs for 429/503')
+    parser.add_argument('--ready-delay', type=float, default=0, help='Secs before a new CR is scheduled')
+    parser.add_argument('--no-batch', action='store_true', help='Disable the batch endpoint')
+    parser.add_argument('--no-etag', action='store_true', help='Do not send ETags on CR reads')
+    parser.add_argument('--no-gzip', action='store_true', help='Reject gzipped bodies, send responses uncompressed')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args(argv)
+    config = StandinConfig(latency=args.latency / 1000.0, jitter=args.jitter / 1000.0,
+                           error_rate=args.error_rate, throttle_rate=args.throttle_rate,
+                           retry_after=args.retry_after, ready_delay=args.ready_delay,
+                           batch_enabled=not args.no_batch, etag_enabled=not args.no_etag,
+                           gzip_enabled=not args.no_gzip)
+    server = StandinServer((args.host, args.port), config, verbose=args.verbose)
+    print('ServiceNow stand-in listening, ServiceNow.Url = %s' % server.api_url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+import hashlib
+import json
+import os
+import re
+import tempfile
+import time
+
+from http_client import HttpClient, HttpRequestError, count_saved_bytes, iter_body
+from token_cache import file_lock
+
+
+"""Incremental reader for Octopus raw task logs
+
+Keeps a local copy of each task's raw log and fetches only the bytes
+appended since the last read, with an HTTP Range request when the server
+honours it and by skipping the known prefix of a full download when it
+does not. Named cursors remember how far each consumer has read, so
+repeated notifications and log shipping only handle the delta.
+
+Copies can reach hundreds of MB. A copy is dropped once its task has
+completed and every cursor has read all of it, and copies untouched for
+LOG_RETENTION secs are purged whenever a TaskLog is created.
+"""
+
+# Bytes read per chunk from the server and from the local copy
+LOG_CHUNK_SIZE = 64 * 1024
+# Secs between polls while following a running task
+FOLLOW_INTERVAL = 2
+# Secs after the last sync or read a log copy is kept
+LOG_RETENTION = 3 * 24 * 3600
+
+LOG_SUFFIXES = ('.log', '.json', '.lock')
+
+CONTENT_RANGE = re.compile(r'bytes (\d+)-\d+/(\d+|\*)')
+UNSATISFIED_RANGE = re.compile(r'bytes \*/(\d+)')
+
+
+class TaskLog:
+    """Local, incrementally updated copies of Octopus task logs
+    """
+
+    def __init__(self, octopus_url, api_key, cache_dir=None, client=None, chunk_size=LOG_CHUNK_SIZE,
+                 retention=LOG_RETENTION):
+        """Initialise instance variables
+        Args:
+            octopus_url: str -> Octopus server URL
+            api_key: str -> Octopus API key
+            cache_dir: str -> Directory holding log copies, defaults to
+                              $OCTOPUS_TASK_LOG_DIR or the temp directory
+            client: HttpClient -> Pooled HTTP client, defaults to a non-verifying one for the Octopus server
+            chunk_size: int -> Bytes read at a time
+            retention: float -> Secs an untouched log copy is kept, None to keep copies
+        """
+        self.octopus_url = octopus_url.rstrip('/')
+        self.headers = {'X-Octopus-ApiKey': api_key}
+        self.cache_dir = cache_dir or os.environ.get('OCTOPUS_TASK_LOG_DIR') or \
+            os.path.join(tempfile.gettempdir(), 'octopus-task-log')
+        self.client = client or HttpClient(verify=False)
+        self.chunk_size = chunk_size
+        os.makedirs(self.cache_dir, exist_ok=True)
+        if retention is not None:
+            self.purge_expired(retention)
+
+    def _paths(self, task_id):
+        key = hashlib.sha256('|'.join([self.octopus_url, task_id]).encode('utf-8')).hexdigest()
+        base = os.path.join(self.cache_dir, key)
+        return base + '.log', base + '.json', base + '.lock'
+
+    def _read_cursors(self, path):
+        try:
+            with open(path) as state_file:
+                return json.load(state_file)
+        except (OSError, ValueError):
+            return dict()
+
+    def _write_cursors(self, path, cursors):
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'w') as tmp_file:
+            json.dump(cursors, tmp_file)
+        os.replace(tmp_path, path)
+
+    def _download(self, task_id, log_path, offset):
+        """Append the log bytes past offset to log_path
+
+        Returns:
+            size: int -> Size of the local copy afterwards
+        """
+        url = '/'.join([self.octopus_url, 'api/tasks', task_id, 'raw'])
+        headers = dict(self.headers)
+        if offset:
+            # Ranges count encoded bytes, keep the body uncompressed so they match the log;
+            # the first, full download takes the negotiated compression
+            headers['Accept-Encoding'] = 'identity'
+            headers['Range'] = 'bytes=%d-' % offset
+        with self.client.request('GET', url, headers=headers, stream=True) as response:
+            if response.status_code == 416:
+                match = UNSATISFIED_RANGE.match(response.headers.get('Content-Range', ''))
+                if match and int(match.group(1)) < offset:
+                    # The log shrank, it is not the one we copied
+                    return self._restart(task_id, log_path)
+                return offset
+            if response.status_code >= 400:
+                raise HttpRequestError('Status: {}, Error Response: {}'.format(response.status_code,
+                                                                              response.content), response)
+            skip = offset
+            if response.status_code == 206:
+                match = CONTENT_RANGE.match(response.headers.get('Content-Range', ''))
+                start = int(match.group(1)) if match else 0
+                if start > offset:
+                    raise HttpRequestError('Range response starts at {}, expected {}'.format(start, offset),
+                                           response)
+                skip = offset - start
+            elif offset and int(response.headers.get('Content-Length') or offset) < offset:
+                return self._restart(task_id, log_path)
+            decoded_size = 0
+            with open(log_path, 'ab') as log_file:
+                for chunk in iter_body(response, self.chunk_size, 'the rest of the task log'):
+                    decoded_size += len(chunk)
+                    if skip:
+                        # Server ignored the Range, stream past what we already have
+                        dropped = min(skip, len(chunk))
+                        chunk = chunk[dropped:]
+                        skip -= dropped
+                    if chunk:
+                        log_file.write(chunk)
+                count_saved_bytes(response, decoded_size)
+                return log_file.tell()
+
+    def _restart(self, task_id, log_path):
+        open(log_path, 'wb').close()
+        self._write_cursors(self._paths(task_id)[1], dict())
+        return self._download(task_id, log_path, 0)
+
+    def sync(self, task_id):
+        """Bring the local copy of task_id's log up to date
+
+        Returns:
+            size: int -> Bytes of the log held locally
+        """
+        log_path, _, lock_path = self._paths(task_id)
+        with file_lock(lock_path):
+            offset = os.path.getsize(log_path) if os.path.exists(log_path) else 0
+            return self._download(task_id, log_path, offset)
+
+    def open_log(self, task_id):
+        """Sync task_id's log and open the whole local copy for binary reading
+        """
+        self.sync(task_id)
+        return open(self._paths(task_id)[0], 'rb')
+
+    def read_new(self, task_id, cursor='default'):
+        """Yield the log bytes cursor has not seen yet, then advance it
+
+        The cursor only moves once every chunk was consumed, so an
+        interrupted reader gets the same bytes again next time.
+
+        Args:
+            task_id: str -> Octopus task id, e.g. ServerTasks-123
+            cursor: str -> Consumer name, each keeps its own position
+        """
+        size = self.sync(task_id)
+        log_path, state_path, lock_path = self._paths(task_id)
+        start = self._read_cursors(state_path).get(cursor, 0)
+        if start > size:
+            start = 0
+        with open(log_path, 'rb') as log_file:
+            log_file.seek(start)
+            remaining = size - start
+            while remaining > 0:
+                chunk = log_file.read(min(self.chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+        with file_lock(lock_path):
+            cursors = self._read_cursors(state_path)
+            cursors[cursor] = size
+            self._write_cursors(state_path, cursors)
+
+    def release(self, task_id):
+        """Drop the local copy of a task's log once every cursor has read all of it
+
+        Only call it for a completed task, a running one would be downloaded
+        again from the start by its next reader.
+
+        Returns:
+            released: bool -> Whether the copy was dropped
+        """
+        log_path, state_path, lock_path = self._paths(task_id)
+        if not os.path.exists(log_path):
+            return False
+        with file_lock(lock_path):
+            size = os.path.getsize(log_path) if os.path.exists(log_path) else 0
+            if any(position < size for position in self._read_cursors(state_path).values()):
+                return False
+            for path in (log_path, state_path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        return True
+
+    def purge_expired(self, retention=LOG_RETENTION):
+        """Remove log copies, cursors and locks untouched for retention secs
+
+        Returns:
+            purged: int -> Log copies removed
+        """
+        cutoff = time.time() - retention
+        touched = dict()
+        for name in os.listdir(self.cache_dir):
+            base, suffix = os.path.splitext(name)
+            if suffix not in LOG_SUFFIXES:
+                continue
+            try:
+                mtime = os.path.getmtime(os.path.join(self.cache_dir, name))
+            except OSError:
+                continue
+            touched[base] = max(touched.get(base, 0), mtime)
+        purged = 0
+        for base, mtime in touched.items():
+            if mtime >= cutoff:
+                continue
+            path = os.path.join(self.cache_dir, base)
+            with file_lock(path + '.lock'):
+                for suffix in ('.log', '.json'):
+                    try:
+                        os.remove(path + suffix)
+                    except OSError:
+                        pass
+            # Nobody synced the task for the whole retention period, its lock can go too
+            try:
+                os.remove(path + '.lock')
+            except OSError:
+                pass
+            purged += 1
+        return purged
+
+    def is_completed(self, task_id):
+        """Whether the Octopus task has finished
+        """
+        url = '/'.join([self.octopus_url, 'api/tasks', task_id])
+        response = self.client.request('GET', url, headers=self.headers)
+        if response.status_code >= 400:
+            raise HttpRequestError('Status: {}, Error Response: {}'.format(response.status_code, response.content),
+                                   response)
+        return bool(json.loads(response.content.decode('utf-8')).get('IsCompleted'))
+
+    def follow(self, task_id, cursor='default', interval=FOLLOW_INTERVAL):
+        """Yield new log bytes as the task writes them, until it completes
+
+        Args:
+            task_id: str -> Octopus task id
+            cursor: str -> Consumer name
+            interval: float -> Secs between polls while nothing new arrived
+        """
+        while True:
+            # Read the state first so output written just before completion is not missed
+            completed = self.is_completed(task_id)
+            received = False
+            for chunk in self.read_new(task_id, cursor):
+                received = True
+                yield chunk
+            if completed:
+                # Nothing more will be written, other consumers may still need the copy
+                self.release(task_id)
+                return
+            if not received:
+                time.sleep(interval)
@@ -0,0 +1,139 @@
+import hashlib
+import json
+import os
+import threading
+
+
+"""Indexed CR template store
+
+Parses the site template file once into a site -> environment index with
+the plan texts already cleandoc-ed, and re-parses only when the file
+changes. Optionally keeps a JSON snapshot of the index next to it for
+cold starts; it is plain data, checked for shape before use, so a
+tampered or stale snapshot is rebuilt from the template file instead of
+being trusted.
+"""
+
+# Template fields holding free text plans
+PLAN_FIELDS = ('Install Plan', 'Testing Plan', 'Rollback')
+SNAPSHOT_VERSION = 2
+
+
+def compile_template(template):
+    """Return a copy of a template entry with plan fields cleandoc-ed and nested environments dropped
+    """
+    # Only needed on a snapshot miss, inspect is slow to import
+    from inspect import cleandoc
+
+    compiled = {k: v for k, v in template.items() if not isinstance(v, dict)}
+    for field in PLAN_FIELDS:
+        if isinstance(compiled.get(field), str):
+            compiled[field] = cleandoc(compiled[field])
+    return compiled
+
+
+def build_index(tdata):
+    """Build the site -> (site template, {environment: template}) index
+    """
+    index = dict()
+    for site, site_data in tdata.items():
+        environments = {env: compile_template(env_data) for env, env_data in site_data.items()
+                        if isinstance(env_data, dict)}
+        index[site] = (compile_template(site_data), environments)
+    return index
+
+
+def is_index(index):
+    """Whether a decoded snapshot index has the shape build_index returns, tuples read as lists
+    """
+    if not isinstance(index, dict):
+        return False
+    for entry in index.values():
+        if not isinstance(entry, (list, tuple)) or len(entry) != 2:
+            return False
+        site_template, environments = entry
+        if not isinstance(site_template, dict) or not isinstance(environments, dict):
+            return False
+        if not all(isinstance(template, dict) for template in environments.values()):
+            return False
+    return True
+
+
+class TemplateStore:
+    """Lazily loaded, change aware view of the CR template file
+    """
+
+    def __init__(self, path, snapshot_path=None):
+        """Initialise instance variables
+        Args:
+            path: str -> Template JSON file
+            snapshot_path: str -> Where to persist the compiled index, None to disable
+        """
+        self.path = path
+        self.snapshot_path = snapshot_path
+        self._signature = None
+        self._digest = None
+        self._index = None
+        self._lock = threading.Lock()
+
+    def _file_signature(self):
+        stat = os.stat(self.path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def _load_snapshot(self, signature):
+        if not self.snapshot_path:
+            return False
+        try:
+            with open(self.snapshot_path, 'rb') as snapshot_file:
+                snapshot = json.loads(snapshot_file.read().decode('utf-8'))
+        except (OSError, ValueError):
+            return False
+        if not isinstance(snapshot, dict) or snapshot.get('version') != SNAPSHOT_VERSION or \
+                snapshot.get('signature') != list(signature) or not isinstance(snapshot.get('digest'), str) or \
+                not is_index(snapshot.get('index')):
+            return False
+        self._signature, self._digest = signature, snapshot['digest']
+        self._index = {site: tuple(entry) for site, entry in snapshot['index'].items()}
+        return True
+
+    def _save_snapshot(self):
+        if not self.snapshot_path:
+            return
+        snapshot = {'version': SNAPSHOT_VERSION, 'signature': list(self._signature),
+                    'digest': self._digest, 'index': self._index}
+        tmp_path = '%s.%d.tmp' % (self.snapshot_path, os.getpid())
+        try:
+            with open(tmp_path, 'w') as snapshot_file:
+                json.dump(snapshot, snapshot_file)
+            os.replace(tmp_path, self.snapshot_path)
+        except OSError as ex:
+            print('Unable to write template snapshot %s: %s' % (self.snapshot_path, ex))
+
+    def _refresh(self):
+        signature = self._file_signature()
+        if signature == self._signature:
+            return
+        if self._index is None and self._load_snapshot(signature):
+            return
+        with open(self.path, 'rb') as template_file:
+            content = template_file.read()
+        digest = hashlib.sha256(content).hexdigest()
+        if digest != self._digest:
+            print('Loading CR templates from %s' % self.path)
+            self._index = build_index(json.loads(content.decode('utf-8')))
+            self._digest = digest
+        self._signature = signature
+        self._save_snapshot()
+
+    def get(self, web_site_name, environment_name=None):
+        """Return the template for a site, preferring its environment specific entry
+
+        Returns:
+            template: dict() -> Template with cleandoc-ed plans, None for unknown sites
+        """
+        with self._lock:
+            self._refresh()
+            if web_site_name not in self._index:
+                return None
+            site_template, environments = self._index[web_site_name]
+            return environments.get(environment_name, site_template)
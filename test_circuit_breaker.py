@@ -0,0 +1,102 @@
+import tempfile
+import unittest
+from unittest import mock
+
+from circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+
+
+"""Tests for the file backed circuit breaker
+"""
+
+HOST = 'example.service-now.com'
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def setUp(self):
+        state_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(state_dir.cleanup)
+        self.now = 1000.0
+        patcher = mock.patch('circuit_breaker.time.time', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breaker = CircuitBreaker(state_dir.name, failure_threshold=3, reset_timeout=30, probe_timeout=60)
+
+    def open_circuit(self):
+        for _ in range(3):
+            self.breaker.record_failure(HOST)
+
+    def test_closed_until_the_failure_threshold(self):
+        self.assertEqual(self.breaker.state(HOST), CLOSED)
+        self.assertEqual(self.breaker.record_failure(HOST), CLOSED)
+        self.assertEqual(self.breaker.record_failure(HOST), CLOSED)
+        self.assertEqual(self.breaker.allow(HOST), (True, False))
+        self.assertEqual(self.breaker.record_failure(HOST), OPEN)
+        self.assertEqual(self.breaker.state(HOST), OPEN)
+
+    def test_success_resets_the_failure_count(self):
+        self.breaker.record_failure(HOST)
+        self.breaker.record_failure(HOST)
+        self.breaker.record_success(HOST)
+        self.assertEqual(self.breaker.record_failure(HOST), CLOSED)
+        self.assertEqual(self.breaker.record_failure(HOST), CLOSED)
+
+    def test_open_rejects_until_the_reset_timeout(self):
+        self.open_circuit()
+        self.assertEqual(self.breaker.allow(HOST), (False, False))
+        self.now += 29
+        self.assertEqual(self.breaker.allow(HOST), (False, False))
+
+    def test_late_failure_keeps_the_reset_timer(self):
+        self.open_circuit()
+        self.now += 20
+        self.assertEqual(self.breaker.record_failure(HOST), OPEN)
+        self.now += 11
+        self.assertEqual(self.breaker.allow(HOST), (True, True))
+
+    def test_half_open_leases_a_single_probe(self):
+        self.open_circuit()
+        self.now += 30
+        self.assertEqual(self.breaker.allow(HOST), (True, True))
+        self.assertEqual(self.breaker.state(HOST), HALF_OPEN)
+        # Any other caller, in this process or another, is rejected while the lease runs
+        other = CircuitBreaker(self.breaker.state_dir, failure_threshold=3, reset_timeout=30, probe_timeout=60)
+        self.assertEqual(other.allow(HOST), (False, False))
+        self.assertEqual(self.breaker.allow(HOST), (False, False))
+
+    def test_expired_probe_lease_is_granted_again(self):
+        self.open_circuit()
+        self.now += 30
+        self.assertEqual(self.breaker.allow(HOST), (True, True))
+        self.now += 59
+        self.assertEqual(self.breaker.allow(HOST), (False, False))
+        self.now += 1
+        self.assertEqual(self.breaker.allow(HOST), (True, True))
+
+    def test_probe_success_closes(self):
+        self.open_circuit()
+        self.now += 30
+        self.breaker.allow(HOST)
+        self.breaker.record_success(HOST)
+        self.assertEqual(self.breaker.state(HOST), CLOSED)
+        self.assertEqual(self.breaker.allow(HOST), (True, False))
+        self.assertEqual(self.breaker.record_failure(HOST), CLOSED)
+
+    def test_probe_failure_reopens_for_another_reset_timeout(self):
+        self.open_circuit()
+        self.now += 30
+        self.breaker.allow(HOST)
+        self.assertEqual(self.breaker.record_failure(HOST), OPEN)
+        self.now += 29
+        self.assertEqual(self.breaker.allow(HOST), (False, False))
+        self.now += 1
+        self.assertEqual(self.breaker.allow(HOST), (True, True))
+
+    def test_hosts_are_independent(self):
+        self.open_circuit()
+        self.assertEqual(self.breaker.allow('other.service-now.com'), (True, False))
+        self.assertEqual(self.breaker.state('other.service-now.com'), CLOSED)
+
+
+if __name__ == '__main__':
+    unittest.main()
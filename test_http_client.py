@@ -0,0 +1,168 @@
+import gzip
+import socket
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+import requests
+
+from circuit_breaker import CLOSED, CircuitBreaker, set_circuit_breaker
+from deadline import Deadline
+from http_client import (DeadlineExceededError, HttpClient, PlainBodyHosts, compress_body, iter_body,
+                         send_with_retry)
+
+
+"""Tests for the shared HTTP client
+"""
+
+
+class StallingServer:
+    """One-connection HTTP server that sends the head of a chunked body, then stalls or hangs up
+
+    With drip, the body is sent that many secs per byte instead.
+    """
+
+    def __init__(self, body_start, hang_up=False, drip=None):
+        self.body_start = body_start
+        self.hang_up = hang_up
+        self.drip = drip
+        self.release = threading.Event()
+        self.sock = socket.create_server(('127.0.0.1', 0))
+        self.url = 'http://127.0.0.1:%d/' % self.sock.getsockname()[1]
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+        self.thread.start()
+
+    def _serve(self):
+        conn, _ = self.sock.accept()
+        with conn:
+            conn.recv(65536)
+            if self.drip is not None:
+                conn.sendall(b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n'
+                             b'Content-Length: %d\r\n\r\n' % len(self.body_start))
+                for i in range(len(self.body_start)):
+                    if self.release.wait(self.drip):
+                        return
+                    conn.sendall(self.body_start[i:i + 1])
+                return
+            conn.sendall(b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n'
+                         b'Transfer-Encoding: chunked\r\n\r\n' + self.body_start)
+            if not self.hang_up:
+                self.release.wait(10)
+
+    def close(self):
+        self.release.set()
+        self.thread.join(10)
+        self.sock.close()
+
+
+class GzipRejectingHandler(BaseHTTPRequestHandler):
+    """Answers 415 to a gzipped request body and echoes the size of a plain one
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            self.server.rejected += 1
+            reply, status = b'{"error": {"message": "Unsupported Media Type"}}', 415
+        else:
+            reply, status = b'{"result": {"size": %d}}' % len(body), 201
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(reply)))
+        self.end_headers()
+        self.wfile.write(reply)
+
+
+class IterBodyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = HttpClient(read_timeout=0.3)
+        self.addCleanup(self.client.close)
+
+    def serve(self, body_start, hang_up=False, drip=None):
+        server = StallingServer(body_start, hang_up, drip)
+        self.addCleanup(server.close)
+        return server
+
+    def test_stalled_chunked_body_raises_a_requests_error(self):
+        server = self.serve(b'5\r\n{"res\r\n')
+        response = self.client.request('GET', server.url, stream=True)
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            list(iter_body(response))
+
+    def test_connection_dropped_mid_body_raises_a_requests_error(self):
+        server = self.serve(b'20\r\n{"result": [', hang_up=True)
+        response = self.client.request('GET', server.url, stream=True)
+        with self.assertRaises(requests.exceptions.ChunkedEncodingError):
+            list(iter_body(response))
+
+    def test_dripping_body_is_bounded_by_the_run_deadline(self):
+        server = self.serve(b'{"result": []}' + b' ' * 100, drip=0.05)
+        start = time.monotonic()
+        with mock.patch('http_client.get_deadline', return_value=Deadline(0.5)):
+            with self.assertRaises(DeadlineExceededError):
+                send_with_retry('GET', server.url, client=self.client)
+        self.assertLess(time.monotonic() - start, 2)
+
+
+
+class CompressFallbackTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), GzipRejectingHandler)
+        self.server.rejected = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.host = '127.0.0.1:%d' % self.server.server_address[1]
+        self.url = 'http://%s/api/now/table/change_request' % self.host
+        self.client = HttpClient()
+        self.addCleanup(self.client.close)
+        state_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(state_dir.cleanup)
+        self.breaker = CircuitBreaker(state_dir.name, failure_threshold=1, reset_timeout=0)
+        set_circuit_breaker(self.breaker)
+        self.addCleanup(set_circuit_breaker, None)
+        plain_body_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(plain_body_dir.cleanup)
+        self.plain_body_hosts = PlainBodyHosts(plain_body_dir.name)
+        patcher = mock.patch('http_client._plain_body_hosts', self.plain_body_hosts)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.data = '{"short_description": "%s"}' % ('x' * 4096)
+
+    def test_half_open_probe_resends_plain_under_its_own_lease(self):
+        self.breaker.record_failure(self.host)
+        response = send_with_retry('POST', self.url, data=self.data, client=self.client, compress=True)
+        self.assertEqual(response, {'result': {'size': len(self.data)}})
+        self.assertEqual(self.server.rejected, 1)
+        self.assertEqual(self.breaker.state(self.host), CLOSED)
+
+    def test_rejecting_host_gets_plain_bodies_in_later_steps(self):
+        send_with_retry('POST', self.url, data=self.data, client=self.client, compress=True)
+        # A later step reads the record from the shared directory
+        self.assertIn(self.host, PlainBodyHosts(self.plain_body_hosts.state_dir))
+        send_with_retry('POST', self.url, data=self.data, client=self.client, compress=True)
+        self.assertEqual(self.server.rejected, 1)
+        self.assertNotIn(self.host, PlainBodyHosts(self.plain_body_hosts.state_dir, ttl=0))
+
+    def test_compressed_size_counts_encoded_bytes(self):
+        data = '{"short_description": "%s"}' % ('Größe ✓ ' * 512)
+        body, size = compress_body(self.url, data)
+        self.assertEqual(gzip.decompress(body), data.encode('utf-8'))
+        self.assertEqual(size, len(data.encode('utf-8')))
+        self.assertGreater(size, len(data))
+        # The size threshold counts bytes as well
+        self.assertIsNotNone(compress_body(self.url, 'ü' * 600, min_size=1024)[0])
+        self.assertEqual(compress_body(self.url, 'u' * 600, min_size=1024), (None, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import json
+import unittest
+
+from json_stream import iter_items
+
+
+"""Tests for the incremental Table API response decoder
+"""
+
+RECORDS = [
+    {'number': 'CHG0000001', 'state': 'scheduled', 'sys_mod_count': 0},
+    {'number': 'CHG0000002', 'short_description': 'Ümlaut, "quoted" and {braces} [brackets]', 'risk': 2.5},
+    {'number': 'CHG0000003', 'tags': [], 'assigned_to': None, 'approved': True, 'impact': -12},
+]
+
+
+def split(body, size):
+    """Cut body into chunks of size bytes, mid token and mid character included
+    """
+    return [body[i:i + size] for i in range(0, len(body), size)]
+
+
+class IterItemsTest(unittest.TestCase):
+
+    def test_any_chunk_split_decodes_the_same_records(self):
+        body = json.dumps({'result': RECORDS}, ensure_ascii=False).encode('utf-8')
+        for size in range(1, len(body) + 1):
+            with self.subTest(size=size):
+                self.assertEqual(list(iter_items(split(body, size))), RECORDS)
+
+    def test_number_cut_at_a_chunk_boundary_is_not_decoded_early(self):
+        self.assertEqual(list(iter_items([b'{"result": [12', b'.5, 3', b'e2]}'])), [12.5, 300.0])
+
+    def test_other_members_are_skipped(self):
+        body = json.dumps({'meta': {'result': ['nested']}, 'result': RECORDS[:1], 'count': 1}).encode('utf-8')
+        self.assertEqual(list(iter_items(split(body, 7))), RECORDS[:1])
+
+    def test_single_record_is_the_only_item(self):
+        body = json.dumps({'result': RECORDS[0]}).encode('utf-8')
+        self.assertEqual(list(iter_items(split(body, 3))), RECORDS[:1])
+
+    def test_empty_results(self):
+        for body in (b'{}', b'{"result": []}', b' { "result" : [ ] } ', b'{"result": null}'):
+            with self.subTest(body=body):
+                self.assertEqual(list(iter_items(split(body, 1))), [])
+
+    def test_records_are_yielded_before_the_body_ends(self):
+        def chunks():
+            yield b'{"result": [{"number": "CHG0000001"}, '
+            raise AssertionError('read past the first record')
+
+        self.assertEqual(next(iter_items(chunks())), {'number': 'CHG0000001'})
+
+    def test_truncated_body_raises(self):
+        body = json.dumps({'result': RECORDS}).encode('utf-8')
+        for cut in (1, len(body) // 2, len(body) - 1):
+            with self.subTest(cut=cut):
+                with self.assertRaises(json.JSONDecodeError):
+                    list(iter_items(split(body[:cut], 5)))
+
+    def test_malformed_body_raises(self):
+        for body in (b'[1, 2]', b'{"result": [1 2]}', b'{"result" [1]}'):
+            with self.subTest(body=body):
+                with self.assertRaises(json.JSONDecodeError):
+                    list(iter_items([body]))
+
+
+if __name__ == '__main__':
+    unittest.main()
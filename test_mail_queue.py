@@ -0,0 +1,134 @@
+import glob
+import os
+import smtplib
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from mail_queue import CLAIM_SUFFIX, SPOOL_SUFFIX, MailQueue, drain, spool_message
+
+
+"""Tests for the background mail queue and its spool
+"""
+
+
+class FakeTransport:
+    """Records sent messages; send blocks while hold is clear and raises when error is set
+    """
+
+    def __init__(self, error=None):
+        self.sent = []
+        self.error = error
+        self.hold = threading.Event()
+        self.hold.set()
+        self.started = threading.Event()
+        self.deadline = None
+        self.closed = False
+
+    def send(self, from_addr, to_addrs, message):
+        self.started.set()
+        self.hold.wait(5)
+        if self.error:
+            raise self.error
+        self.sent.append((from_addr, to_addrs, message))
+
+    def close(self):
+        self.closed = True
+
+
+class MailQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        spool_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(spool_dir.cleanup)
+        self.spool_dir = spool_dir.name
+
+    def spooled(self):
+        return sorted(glob.glob(os.path.join(self.spool_dir, '*' + SPOOL_SUFFIX)))
+
+    def test_flush_waits_for_queued_mail(self):
+        transport = FakeTransport()
+        mail_queue = MailQueue(transport, self.spool_dir)
+        self.assertTrue(mail_queue.submit('a@x', ['b@x'], 'one'))
+        self.assertTrue(mail_queue.submit('a@x', ['b@x'], 'two'))
+        self.assertEqual(mail_queue.flush(timeout=5), 0)
+        self.assertEqual([item[2] for item in transport.sent], ['one', 'two'])
+        self.assertTrue(transport.closed)
+        self.assertEqual(self.spooled(), [])
+
+    def test_flush_deadline_spools_unsent_mail(self):
+        transport = FakeTransport()
+        transport.hold.clear()
+        self.addCleanup(transport.hold.set)
+        mail_queue = MailQueue(transport, self.spool_dir)
+        mail_queue.submit('a@x', ['b@x'], 'in flight')
+        self.assertTrue(transport.started.wait(5))
+        mail_queue.submit('a@x', ['b@x'], 'queued')
+        start = time.monotonic()
+        self.assertEqual(mail_queue.flush(timeout=0.2), 2)
+        self.assertLess(time.monotonic() - start, 2)
+        # The hung send keeps the transport, the worker closes nothing under it
+        self.assertFalse(transport.closed)
+        self.assertEqual(len(self.spooled()), 2)
+        # Mail after the flush goes straight to the spool
+        self.assertFalse(mail_queue.submit('a@x', ['b@x'], 'late'))
+        self.assertEqual(len(self.spooled()), 3)
+
+        resend = FakeTransport()
+        self.assertEqual(drain(self.spool_dir, resend), (3, 0))
+        self.assertEqual([item[2] for item in resend.sent], ['in flight', 'queued', 'late'])
+        self.assertEqual(os.listdir(self.spool_dir), [])
+
+    def test_refused_mail_is_spooled(self):
+        transport = FakeTransport(error=smtplib.SMTPRecipientsRefused({}))
+        mail_queue = MailQueue(transport, self.spool_dir)
+        mail_queue.submit('a@x', ['b@x'], 'refused')
+        self.assertEqual(mail_queue.flush(timeout=5), 0)
+        self.assertEqual(len(self.spooled()), 1)
+
+    def test_full_queue_spools(self):
+        transport = FakeTransport()
+        transport.hold.clear()
+        self.addCleanup(transport.hold.set)
+        mail_queue = MailQueue(transport, self.spool_dir, maxsize=1)
+        mail_queue.submit('a@x', ['b@x'], 'in flight')
+        self.assertTrue(transport.started.wait(5))
+        self.assertTrue(mail_queue.submit('a@x', ['b@x'], 'queued'))
+        self.assertFalse(mail_queue.submit('a@x', ['b@x'], 'overflow'))
+        self.assertEqual(len(self.spooled()), 1)
+
+    def test_drain_keeps_what_it_could_not_send(self):
+        spool_message(self.spool_dir, 'a@x', ['b@x'], 'one')
+        spool_message(self.spool_dir, 'a@x', ['b@x'], 'two')
+        self.assertEqual(drain(self.spool_dir, FakeTransport(error=OSError('relay down'))), (0, 2))
+        self.assertEqual(len(self.spooled()), 2)
+        self.assertEqual(glob.glob(os.path.join(self.spool_dir, '*' + CLAIM_SUFFIX)), [])
+        resend = FakeTransport()
+        self.assertEqual(drain(self.spool_dir, resend), (2, 0))
+        self.assertEqual([item[2] for item in resend.sent], ['one', 'two'])
+
+    def test_drain_skips_fresh_claims(self):
+        path = spool_message(self.spool_dir, 'a@x', ['b@x'], 'claimed')
+        os.replace(path, path[:-len(SPOOL_SUFFIX)] + CLAIM_SUFFIX)
+        self.assertEqual(drain(self.spool_dir, FakeTransport()), (0, 0))
+
+    def test_drain_skips_claims_removed_meanwhile(self):
+        spool_message(self.spool_dir, 'a@x', ['b@x'], 'spooled')
+        path = spool_message(self.spool_dir, 'a@x', ['b@x'], 'claimed')
+        os.replace(path, path[:-len(SPOOL_SUFFIX)] + CLAIM_SUFFIX)
+
+        def getmtime(path):
+            # Another drain sends the claimed message between the listing and this call
+            os.remove(path)
+            raise FileNotFoundError(path)
+
+        resend = FakeTransport()
+        with mock.patch('mail_queue.os.path.getmtime', getmtime):
+            self.assertEqual(drain(self.spool_dir, resend), (1, 0))
+        self.assertEqual([item[2] for item in resend.sent], ['spooled'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,221 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import urllib.parse
+
+from contextlib import contextmanager
+
+
+"""Cross-process OAuth token cache
+
+Tokens are stored one file per (token URL, client id, username) under a
+shared cache directory so concurrent Octopus steps on one Tentacle reuse
+the same token instead of each running a password grant.
+"""
+
+# Tokens with less than this many seconds left are never handed out
+DEFAULT_MIN_VALIDITY = 60
+# Fraction of the token lifetime after which a background refresh starts
+DEFAULT_REFRESH_AFTER = 0.75
+
+
+class TokenRefreshError(Exception):
+    """Raised when a refresh_token grant is rejected"""
+
+
+@contextmanager
+def file_lock(path):
+    """Hold an exclusive lock on path for the duration of the block
+
+    Uses msvcrt on Windows Tentacles and fcntl elsewhere.
+    """
+    with open(path, 'a+') as lock_file:
+        if os.name == 'nt':
+            import msvcrt
+            lock_file.seek(0)
+            while True:
+                try:
+                    # LK_LOCK retries for ~10 secs before raising
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+            try:
+                yield
+            finally:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def refresh_grant(client, token_url, client_id, client_secret, refresh_token):
+    """Run a refresh_token grant against oauth_token.do
+
+    Args:
+        client: HttpClient -> Pooled HTTP client
+        token_url: str -> ServiceNow oauth_token.do URL
+        client_id: str -> OAuth client id
+        client_secret: str -> OAuth client secret
+        refresh_token: str -> Refresh token from an earlier grant
+    Returns:
+        token_data: dict() -> Token response
+    """
+    payload = {
+        'grant_type': 'refresh_token',
+        'client_id': client_id,
+        'client_secret': client_secret,
+        'refresh_token': refresh_token
+    }
+    payload_str = '&'.join([k + "=" + urllib.parse.quote(v) for k, v in payload.items()])
+    response = client.request('POST', token_url, data=payload_str,
+                              headers={"Content-Type": "application/x-www-form-urlencoded"})
+    if response.status_code >= 400:
+        raise TokenRefreshError('Status: {}, Error Response: {}'.format(response.status_code, response.content))
+    return json.loads(response.content)
+
+
+class TokenCache:
+    """File backed OAuth token cache shared between processes
+    """
+
+    def __init__(self, cache_dir=None, min_validity=DEFAULT_MIN_VALIDITY, refresh_after=DEFAULT_REFRESH_AFTER):
+        """Initialise instance variables
+        Args:
+            cache_dir: str -> Directory holding token files, defaults to
+                              $SERVICENOW_TOKEN_CACHE_DIR or the temp directory
+            min_validity: int -> Seconds of validity a cached token must have left
+            refresh_after: float -> Lifetime fraction after which a background refresh starts
+        """
+        self.cache_dir = cache_dir or os.environ.get('SERVICENOW_TOKEN_CACHE_DIR') or \
+            os.path.join(tempfile.gettempdir(), 'servicenow-token-cache')
+        self.min_validity = min_validity
+        self.refresh_after = refresh_after
+        self._refreshing = set()
+        self._refreshing_lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _paths(self, token_url, client_id, username):
+        key = hashlib.sha256('|'.join([token_url, client_id, username or '']).encode('utf-8')).hexdigest()
+        base = os.path.join(self.cache_dir, key)
+        return base + '.json', base + '.lock'
+
+    def _read(self, path):
+        try:
+            with open(path) as token_file:
+                return json.load(token_file)
+        except (OSError, ValueError):
+            return None
+
+    def _write(self, path, token_data):
+        entry = dict(token_data)
+        now = time.time()
+        entry['obtained_at'] = now
+        entry['expires_at'] = now + int(token_data.get('expires_in', 0))
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as token_file:
+            json.dump(entry, token_file)
+        os.replace(tmp_path, path)
+        return entry
+
+    def _is_valid(self, entry, now):
+        return entry is not None and entry.get('expires_at', 0) - now > self.min_validity
+
+    def _wants_refresh(self, entry, now):
+        lifetime = entry['expires_at'] - entry.get('obtained_at', entry['expires_at'])
+        return bool(entry.get('refresh_token')) and \
+            now - entry.get('obtained_at', now) >= lifetime * self.refresh_after
+
+    def get_token(self, token_url, client_id, fetch, refresh=None, username=None):
+        """Return a valid token, fetching or refreshing it as needed
+
+        Args:
+            token_url: str -> ServiceNow oauth_token.do URL
+            client_id: str -> OAuth client id
+            fetch: callable() -> Runs a full grant and returns the token response
+            refresh: callable(refresh_token) -> Runs a refresh_token grant
+            username: str -> Grant user, kept apart so users never share tokens
+        Returns:
+            token_data: dict() -> Token response
+        """
+        token_path, lock_path = self._paths(token_url, client_id, username)
+        with file_lock(lock_path):
+            now = time.time()
+            entry = self._read(token_path)
+            if not self._is_valid(entry, now):
+                token_data = None
+                if refresh and entry and entry.get('refresh_token'):
+                    try:
+                        token_data = refresh(entry['refresh_token'])
+                    except Exception as ex:
+                        print('Token refresh failed, requesting a new token: %s' % ex)
+                if token_data is None:
+                    token_data = fetch()
+                return self._write(token_path, token_data)
+
+        if refresh and self._wants_refresh(entry, now):
+            self._refresh_in_background(token_path, lock_path, refresh)
+        return entry
+
+    def _refresh_in_background(self, token_path, lock_path, refresh):
+        with self._refreshing_lock:
+            if token_path in self._refreshing:
+                return
+            self._refreshing.add(token_path)
+
+        def worker():
+            try:
+                with file_lock(lock_path):
+                    entry = self._read(token_path)
+                    # Another process may have refreshed it already
+                    if entry is None or not self._wants_refresh(entry, time.time()):
+                        return
+                    self._write(token_path, refresh(entry['refresh_token']))
+            except Exception as ex:
+                print('Background token refresh failed: %s' % ex)
+            finally:
+                with self._refreshing_lock:
+                    self._refreshing.discard(token_path)
+
+        threading.Thread(target=worker, name='token-refresh', daemon=True).start()
+
+    def invalidate(self, token_url, client_id, username=None, access_token=None):
+        """Drop the cached token, e.g. after the API rejects it with 401
+
+        Args:
+            access_token: str -> Only drop the cached token while it is this one; another
+                                 step may already have replaced the rejected token
+        """
+        token_path, lock_path = self._paths(token_url, client_id, username)
+        with file_lock(lock_path):
+            if access_token is not None:
+                entry = self._read(token_path)
+                if entry is None or entry.get('access_token') != access_token:
+                    return
+            try:
+                os.remove(token_path)
+            except OSError:
+                pass
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_token_cache():
+    """Return the process wide token cache, creating it on first use
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = TokenCache()
+        return _cache